@@ -14,6 +14,7 @@ Functions
 ---------
 `demucs.api.save_audio`: Save an audio
 `demucs.api.list_models`: Get models list
+`demucs.api.preload_models`: Load models ahead of time
 
 Examples
 --------
@@ -25,14 +26,13 @@ import subprocess
 import torch as th
 import torchaudio as ta
 
-from dora.log import fatal
 from pathlib import Path
 from typing import Optional, Callable, Dict, Tuple, Union
 
 from .apply import apply_model, _replace_dict
-from .audio import AudioFile, convert_audio, save_audio
-from .pretrained import get_model, _parse_remote_files, REMOTE_ROOT
-from .repo import RemoteRepo, LocalRepo, ModelOnlyRepo, BagOnlyRepo
+from .audio import AudioFile, PeakMeter, convert_audio, save_audio
+from .pretrained import list_models as _list_models
+from .registry import registry
 
 
 class LoadAudioError(Exception):
@@ -113,13 +113,16 @@ class Separator:
         - `state`: Could be `"start"` or `"end"`.
         - `audio_length`: Length of the audio (in "frame" of the tensor).
         - `models`: Count of submodels in the model.
+
+        Models are shared between all the separators using the same model, repo and device,
+        through `demucs.registry.registry`, and only loaded once.
         """
         self._name = model
         self._repo = repo
-        self._load_model()
         self.update_parameter(device=device, shifts=shifts, overlap=overlap, split=split,
                               segment=segment, jobs=jobs, progress=progress, callback=callback,
                               callback_arg=callback_arg)
+        self._load_model(th.device("cpu") if self._device is None else th.device(self._device))
 
     def update_parameter(
         self,
@@ -200,10 +203,13 @@ class Separator:
         if not isinstance(callback_arg, _NotProvided):
             self._callback_arg = callback_arg
 
-    def _load_model(self):
-        self._model = get_model(name=self._name, repo=self._repo)
-        if self._model is None:
+    def _load_model(self, device: th.device):
+        self.close()
+        model = registry.acquire(self._name, self._repo, device)
+        if model is None:
             raise LoadModelError("Failed to load model")
+        self._model = model
+        self._model_device = device
         self._audio_channels = self._model.audio_channels
         self._samplerate = self._model.samplerate
 
@@ -239,7 +245,7 @@ class Separator:
         return wav
 
     def separate_tensor(
-        self, wav: th.Tensor, sr: Optional[int] = None
+        self, wav: th.Tensor, sr: Optional[int] = None, peaks: Optional[Dict[str, float]] = None
     ) -> Tuple[th.Tensor, Dict[str, th.Tensor]]:
         """
         Separate a loaded tensor.
@@ -251,6 +257,9 @@ class Separator:
             e.g. `tuple(wav.shape) == (2, 884000)` means the audio has 2 channels.
         sr: Sample rate of the original audio, the wave will be resampled if it doesn't match the \
             model.
+        peaks: If provided, filled with the maximum absolute value of each stem, recorded \
+            during the separation. It can be passed to `demucs.audio.save_audio` to save the \
+            stems without another pass over them when preventing clipping.
 
         Returns
         -------
@@ -267,6 +276,11 @@ class Separator:
         ref = wav.mean(0)
         wav -= ref.mean()
         wav /= ref.std() + 1e-8
+        device = wav.device if self._device is None else th.device(self._device)
+        if device != self._model_device:
+            # The shared model is never moved, use the one for this device instead.
+            self._load_model(device)
+        meters = [PeakMeter() for _ in self._model.sources]
         out = apply_model(
                 self._model,
                 wav[None],
@@ -274,29 +288,37 @@ class Separator:
                 shifts=self._shifts,
                 split=self._split,
                 overlap=self._overlap,
-                device=self._device,
+                device=device,
                 num_workers=self._jobs,
                 callback=self._callback,
                 callback_arg=_replace_dict(
                     self._callback_arg, ("audio_length", wav.shape[1])
                 ),
                 progress=self._progress,
+                meters=meters,
             )
         if out is None:
             raise KeyboardInterrupt
         out *= ref.std() + 1e-8
         out += ref.mean()
+        if peaks is not None:
+            scale = ref.std().item() + 1e-8
+            offset = ref.mean().item()
+            for source, meter in zip(self._model.sources, meters):
+                peaks[source] = meter.scaled(scale, offset)
         wav *= ref.std() + 1e-8
         wav += ref.mean()
         return (wav, dict(zip(self._model.sources, out[0])))
 
-    def separate_audio_file(self, file: Path):
+    def separate_audio_file(self, file: Path, peaks: Optional[Dict[str, float]] = None):
         """
         Separate an audio file. The method will automatically read the file.
 
         Parameters
         ----------
         wav: Path of the file to be separated.
+        peaks: If provided, filled with the maximum absolute value of each stem, \
+            see `separate_tensor`.
 
         Returns
         -------
@@ -304,7 +326,24 @@ class Separator:
         are the name of stems and values are separated waves. The original wave will have already
         been resampled.
         """
-        return self.separate_tensor(self._load_audio(file), self.samplerate)
+        return self.separate_tensor(self._load_audio(file), self.samplerate, peaks)
+
+    def close(self):
+        """
+        Release the model, which stays loaded for other separators, or to be quickly reused
+        by a new one, within the memory budget of `demucs.registry.registry`. The separator
+        cannot be used anymore afterwards. This is also done when the separator is deleted.
+        """
+        if hasattr(self, "_model"):
+            del self._model
+            registry.release(self._name, self._repo, self._model_device)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            # Can happen at interpreter shutdown.
+            pass
 
     @property
     def samplerate(self):
@@ -319,6 +358,22 @@ class Separator:
         return self._model
 
 
+def preload_models(models: Tuple[str, ...] = ("htdemucs",), repo: Optional[Path] = None,
+                   device: str = "cuda" if th.cuda.is_available() else "cpu"):
+    """
+    Load models ahead of time, e.g. when starting a service, so that creating a `Separator`
+    with any of them is immediate. The models stay loaded as long as the memory budget of
+    `demucs.registry.registry` allows it, see `demucs.registry.ModelRegistry.set_budget`.
+
+    Parameters
+    ----------
+    models: Names or signatures of the models to load.
+    repo: Folder containing the models, or None for the pre-trained models.
+    device: Device the separators using the models will run on.
+    """
+    registry.preload(models, repo, device)
+
+
 def list_models(repo: Optional[Path] = None) -> Dict[str, Dict[str, Union[str, Path]]]:
     """
     List the available models. Please remember that not all the returned models can be
@@ -333,17 +388,7 @@ def list_models(repo: Optional[Path] = None) -> Dict[str, Dict[str, Union[str, P
     A dict with two keys ("single" for single models and "bag" for bag of models). The values are
     lists whose components are strs.
     """
-    model_repo: ModelOnlyRepo
-    if repo is None:
-        models = _parse_remote_files(REMOTE_ROOT / 'files.txt')
-        model_repo = RemoteRepo(models)
-        bag_repo = BagOnlyRepo(REMOTE_ROOT, model_repo)
-    else:
-        if not repo.is_dir():
-            fatal(f"{repo} must exist and be a directory.")
-        model_repo = LocalRepo(repo)
-        bag_repo = BagOnlyRepo(repo, model_repo)
-    return {"single": model_repo.list_model(), "bag": bag_repo.list_model()}
+    return _list_models(repo)
 
 
 if __name__ == "__main__":
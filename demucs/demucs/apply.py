@@ -18,6 +18,7 @@ from torch import nn
 from torch.nn import functional as F
 import tqdm
 
+from .audio import PeakMeter
 from .demucs import Demucs
 from .hdemucs import HDemucs
 from .htdemucs import HTDemucs
@@ -150,7 +151,8 @@ def apply_model(model: tp.Union[BagOfModels, Model],
                 num_workers: int = 0, segment: tp.Optional[float] = None,
                 pool=None, lock=None,
                 callback: tp.Optional[tp.Callable[[dict], None]] = None,
-                callback_arg: tp.Optional[dict] = None) -> th.Tensor:
+                callback_arg: tp.Optional[dict] = None,
+                meters: tp.Optional[tp.Sequence[PeakMeter]] = None) -> th.Tensor:
     """
     Apply model to a given mixture.
 
@@ -170,6 +172,11 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         num_workers (int): if non zero, device is 'cpu', how many threads to
             use in parallel.
         segment (float or None): override the model segment parameter.
+        meters (list of PeakMeter or None): if provided, one `PeakMeter` per source, updated
+            with the estimates of each source. With `split=True`, and no shifts or bag
+            of models to average, this is done chunk by chunk, as soon as the overlapping
+            chunks have been added up, so that the peaks are known without another pass
+            over the estimates.
     """
     if device is None:
         device = mix.device
@@ -226,6 +233,7 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         assert isinstance(estimates, th.Tensor)
         for k in range(estimates.shape[1]):
             estimates[:, k, :, :] /= totals[k]
+        _update_meters(meters, estimates)
         return estimates
 
     if "models" not in callback_arg:
@@ -253,6 +261,7 @@ def apply_model(model: tp.Union[BagOfModels, Model],
             out += shifted_out[..., max_shift - offset:]
         out /= shifts
         assert isinstance(out, th.Tensor)
+        _update_meters(meters, out)
         return out
     elif split:
         kwargs['split'] = False
@@ -275,6 +284,7 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         # transition_power is 1.
         weight = (weight / weight.max())**transition_power
         futures = []
+        done = 0
         for offset in offsets:
             chunk = TensorChunk(mix, offset, segment_length)
             future = pool.submit(apply_model, model, chunk, **kwargs, callback_arg=callback_arg,
@@ -295,6 +305,11 @@ def apply_model(model: tp.Union[BagOfModels, Model],
             out[..., offset:offset + segment_length] += (
                 weight[:chunk_length] * chunk_out).to(mix.device)
             sum_weight[offset:offset + segment_length] += weight[:chunk_length].to(mix.device)
+            if meters is not None:
+                # Later chunks start after `offset + stride`, so everything before is final.
+                end = min(offset + stride, length)
+                _update_meters(meters, out[..., done:end] / sum_weight[done:end])
+                done = end
         assert sum_weight.min() > 0
         out /= sum_weight
         assert isinstance(out, th.Tensor)
@@ -319,4 +334,14 @@ def apply_model(model: tp.Union[BagOfModels, Model],
             if callback is not None:
                 callback(_replace_dict(callback_arg, ("state", "end")))  # type: ignore
         assert isinstance(out, th.Tensor)
-        return center_trim(out, length)
+        trimmed = center_trim(out, length)
+        _update_meters(meters, trimmed)
+        return trimmed
+
+
+def _update_meters(meters: tp.Optional[tp.Sequence[PeakMeter]], estimates: th.Tensor):
+    if meters is None:
+        return
+    assert len(meters) == estimates.shape[1], "There must be one meter per source."
+    for k, meter in enumerate(meters):
+        meter.update(estimates[:, k])
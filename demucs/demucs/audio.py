@@ -3,7 +3,10 @@
 #
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
+from concurrent.futures import Future, ProcessPoolExecutor
 import json
+import math
+import os
 import subprocess as sp
 from pathlib import Path
 
@@ -11,6 +14,7 @@ import lameenc
 import julius
 import numpy as np
 import torch
+from torch.nn import functional as F
 import torchaudio as ta
 import typing as tp
 
@@ -139,6 +143,206 @@ class AudioFile:
             wav = wav[0]
         return wav
 
+    def reader(self, stream=0, samplerate=None, channels=None, backend=None):
+        """
+        Return an :class:`AudioReader` over the given stream, reusing the already
+        parsed file info. See :class:`AudioReader` for the meaning of the arguments.
+        """
+        return AudioReader(self, stream=stream, samplerate=samplerate,
+                           channels=channels, backend=backend)
+
+
+class AudioReader:
+    """
+    Keeps a decoder open on a single audio stream, and serves successive or random
+    windowed reads from it, without spawning a new process or parsing the file header
+    for each read, unlike :method:`AudioFile.read`.
+
+    Two backends are supported:
+        - `soundfile`: used by default when `soundfile` is installed, the format is
+            supported by libsndfile and no resampling is required. Seeking is exact and free.
+        - `ffmpeg`: a single ffmpeg process decodes the stream and is only restarted
+            (with an accurate input seek) when reading backward, or further forward than
+            `max_skip` seconds. Smaller forward jumps are served by decoding and dropping
+            samples, so that successive windows stay sample accurate.
+
+    Offsets and lengths are always expressed in samples at the output sample rate.
+
+    Args:
+        path (Path, str or AudioFile): file to read from.
+        stream (int): index of the audio stream to read.
+        samplerate (int or None): if provided, resample on the fly (ffmpeg only).
+        channels (int or None): if provided, convert to the given number of channels,
+            see :func:`convert_audio_channels`.
+        backend (str or None): force either `soundfile` or `ffmpeg`.
+        max_skip (float): maximum forward jump in seconds served by dropping samples
+            rather than restarting ffmpeg.
+
+    Can be used as a context manager, which will close the decoder on exit.
+    """
+    def __init__(self, path, stream=0, samplerate=None, channels=None,
+                 backend=None, max_skip=10.):
+        if isinstance(path, AudioFile):
+            self._file = path
+        else:
+            self._file = AudioFile(path)
+        self.path = self._file.path
+        self.stream = stream
+        self.channels = channels
+        self.max_skip = max_skip
+        self.backend = backend
+        self._sf = None
+        self._process = None
+        self._pid = None
+        self._position = 0
+        self._src_channels = None
+        self._src_samplerate = None
+
+        if backend is None or backend == 'soundfile':
+            self._open_soundfile(samplerate, required=backend == 'soundfile')
+        if self._sf is None:
+            if backend not in [None, 'ffmpeg']:
+                raise ValueError(f"Invalid backend {backend}")
+            self.backend = 'ffmpeg'
+            self._src_channels = self._file.channels(stream)
+            self._src_samplerate = self._file.samplerate(stream)
+        self.samplerate = samplerate or self._src_samplerate
+
+    def _open_soundfile(self, samplerate, required=False):
+        try:
+            import soundfile
+        except ImportError:
+            if required:
+                raise
+            return
+        try:
+            handle = soundfile.SoundFile(str(self.path))
+        except RuntimeError:
+            if required:
+                raise
+            return
+        if self.stream != 0 or (samplerate is not None and samplerate != handle.samplerate):
+            handle.close()
+            if required:
+                raise ValueError("soundfile backend can only read the first stream, "
+                                 "without resampling.")
+            return
+        self._sf = handle
+        self.backend = 'soundfile'
+        self._src_channels = handle.channels
+        self._src_samplerate = handle.samplerate
+
+    def __repr__(self):
+        return (f"AudioReader(path={self.path}, backend={self.backend}, "
+                f"samplerate={self.samplerate}, position={self._position})")
+
+    def __len__(self):
+        """Number of samples at the output sample rate (approximate for ffmpeg)."""
+        if self._sf is not None:
+            return self._sf.frames
+        return int(round(self._file.duration * self.samplerate))
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int):
+        """Move to the given offset (in samples at the output sample rate)."""
+        offset = max(0, int(offset))
+        if self._sf is not None:
+            offset = min(offset, self._sf.frames)
+            self._sf.seek(offset)
+        elif self._process is not None and 0 <= offset - self._position <= \
+                self.max_skip * self.samplerate:
+            while self._position < offset:
+                dropped = self._read_ffmpeg(min(offset - self._position, 2**16))
+                if dropped.shape[-1] == 0:
+                    break
+        else:
+            self._start(offset)
+        self._position = offset
+
+    def _start(self, offset):
+        self._stop()
+        command = ['ffmpeg', '-loglevel', 'panic']
+        if offset:
+            command += ['-ss', f"{offset / self.samplerate:.6f}"]
+        command += ['-i', str(self.path)]
+        command += ['-map', f'0:{self._file._audio_streams[self.stream]}']
+        command += ['-threads', '1', '-f', 'f32le']
+        if self.samplerate != self._src_samplerate:
+            command += ['-ar', str(self.samplerate)]
+        command += ['-']
+        self._process = sp.Popen(command, stdout=sp.PIPE, stdin=sp.DEVNULL)
+        self._pid = os.getpid()
+
+    def _stop(self):
+        if self._process is not None:
+            # After a fork, the decoder still belongs to the parent process,
+            # and is only released in the child.
+            if self._pid == os.getpid():
+                self._process.kill()
+            self._process.stdout.close()
+            if self._pid == os.getpid():
+                self._process.wait()
+            self._process = None
+
+    def _read_ffmpeg(self, num_frames):
+        if self._process is None:
+            self._start(self._position)
+        frame_size = 4 * self._src_channels
+        remaining = None if num_frames < 0 else num_frames * frame_size
+        chunks = []
+        while remaining is None or remaining > 0:
+            chunk = self._process.stdout.read(remaining if remaining is not None else 2**20)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+        data = b''.join(chunks)
+        data = data[:len(data) - len(data) % frame_size]
+        wav = torch.from_numpy(np.frombuffer(data, dtype=np.float32).copy())
+        wav = wav.view(-1, self._src_channels).t()
+        self._position += wav.shape[-1]
+        return wav
+
+    def read(self, num_frames: int = -1, offset: tp.Optional[int] = None):
+        """
+        Read `num_frames` samples (or up to the end of the stream if -1), starting
+        from `offset` if provided, or from the current position otherwise.
+        Returns a tensor of shape `[C, T]`, with `T` smaller than `num_frames`
+        only if the end of the stream was reached.
+        """
+        if offset is not None:
+            self.seek(offset)
+        if self._sf is not None:
+            data = self._sf.read(num_frames, dtype='float32', always_2d=True)
+            wav = torch.from_numpy(data).t()
+            self._position += wav.shape[-1]
+        else:
+            wav = self._read_ffmpeg(num_frames)
+        if self.channels is not None:
+            wav = convert_audio_channels(wav, self.channels)
+        return wav
+
+    def close(self):
+        self._stop()
+        if self._sf is not None:
+            self._sf.close()
+            self._sf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
 
 def convert_audio_channels(wav, channels=2):
     """Convert audio to the given number of channels."""
@@ -175,7 +379,7 @@ def convert_audio(wav, from_samplerate, to_samplerate, channels) -> torch.Tensor
 def i16_pcm(wav):
     """Convert audio to 16 bits integer PCM format."""
     if wav.dtype.is_floating_point:
-        return (wav.clamp_(-1, 1) * (2**15 - 1)).short()
+        return (wav.clamp(-1, 1) * (2**15 - 1)).short()
     else:
         return wav
 
@@ -196,10 +400,13 @@ def as_dtype_pcm(wav, dtype):
         return i16_pcm(wav)
 
 
-def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=False):
-    """Save given audio as mp3. This should work on all OSes."""
+def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=False,
+               chunk=2**16, clip='none', peak=None):
+    """Save given audio as mp3. This should work on all OSes.
+    The audio is converted and encoded by chunks of `chunk` samples, so that
+    no full size copy of it is ever made. `clip` and `peak` are passed
+    to `prevent_clip` for each chunk, see `clip_blocks`."""
     C, T = wav.shape
-    wav = i16_pcm(wav)
     encoder = lameenc.Encoder()
     encoder.set_bit_rate(bitrate)
     encoder.set_in_sample_rate(samplerate)
@@ -207,27 +414,148 @@ def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=Fals
     encoder.set_quality(quality)  # 2-highest, 7-fastest
     if not verbose:
         encoder.silence()
-    wav = wav.data.cpu()
-    wav = wav.transpose(0, 1).numpy()
-    mp3_data = encoder.encode(wav.tobytes())
-    mp3_data += encoder.flush()
+    wav = wav.detach().cpu()
     with open(path, "wb") as f:
-        f.write(mp3_data)
+        for block in clip_blocks(wav, clip, chunk, peak):
+            # Interleaved 16 bits samples, as expected by the encoder.
+            pcm = i16_pcm(block).t().contiguous().numpy()
+            f.write(encoder.encode(pcm))
+        f.write(encoder.flush())
 
 
-def prevent_clip(wav, mode='rescale'):
+class PeakMeter:
+    def __init__(self):
+        """
+        Running extrema of some audio, processed block by block, e.g. as it is being
+        produced by `demucs.apply.apply_model`. Once all the blocks have been seen, the peak can
+        be given to `prevent_clip(mode='rescale')`, which can then be applied to each block
+        independently when streaming them to disk.
+        """
+        self.low = math.inf
+        self.high = -math.inf
+
+    def update(self, block: torch.Tensor):
+        if block.numel():
+            self.low = min(self.low, block.min().item())
+            self.high = max(self.high, block.max().item())
+
+    @property
+    def peak(self) -> float:
+        """Maximum absolute value of the audio seen so far."""
+        return self.scaled()
+
+    def scaled(self, scale: float = 1., offset: float = 0.) -> float:
+        """Maximum absolute value of `scale * wav + offset`, for the audio `wav` seen so far,
+        e.g. to get the peak of the audio once denormalized."""
+        if self.low > self.high:
+            return 0.
+        return max(abs(scale * self.low + offset), abs(scale * self.high + offset))
+
+
+class Limiter:
+    def __init__(self, threshold: float = 0.99, lookahead: int = 256):
+        """
+        Lookahead peak limiter, processing audio block by block with a latency
+        of `lookahead - 1` samples.
+
+        The gain needed to keep each sample below `threshold` is held over `lookahead`
+        samples, then smoothed by a moving average of the same length, so that the gain
+        decreases linearly before a peak, and recovers linearly after it. Unlike
+        `mode='rescale'`, only the parts of the audio that would clip are attenuated.
+
+        Args:
+            threshold (float): maximum absolute value of the output.
+            lookahead (int): length in samples of the attack and release of the gain.
+        """
+        assert lookahead >= 1
+        self.threshold = threshold
+        self.lookahead = lookahead
+        # Last `lookahead - 1` input samples, required gains and held gains.
+        self._delay: tp.Optional[torch.Tensor] = None
+        self._gains: tp.Optional[torch.Tensor] = None
+        self._held: tp.Optional[torch.Tensor] = None
+        # Samples still to drop from the output, to compensate for the latency.
+        self._skip = lookahead - 1
+
+    def __call__(self, wav: torch.Tensor) -> torch.Tensor:
+        """
+        Process a block `wav` of shape `[C, T]`. Returns the output samples available
+        so far, which lag `lookahead - 1` samples behind the input. The output for the
+        last samples is obtained with :method:`flush`.
+        """
+        L = self.lookahead
+        T = wav.shape[-1]
+        if self._delay is None:
+            self._delay = wav.new_zeros(wav.shape[0], L - 1)
+            self._gains = wav.new_ones(L - 1)
+            self._held = wav.new_ones(L - 1)
+        assert self._gains is not None and self._held is not None
+        peak = wav.abs().amax(dim=0)
+        gains = torch.cat([self._gains, (self.threshold / peak).clamp(max=1)])
+        held = torch.cat([self._held, -F.max_pool1d(-gains[None], L, stride=1)[0]])
+        smooth = F.avg_pool1d(held[None], L, stride=1)[0]
+        delayed = torch.cat([self._delay, wav], dim=-1)
+        self._gains = gains[T:]
+        self._held = held[T:]
+        self._delay = delayed[:, T:]
+
+        out = delayed[:, :T] * smooth
+        skip = min(self._skip, T)
+        self._skip -= skip
+        return out[:, skip:]
+
+    def flush(self) -> torch.Tensor:
+        """Return the output for the last `lookahead - 1` input samples."""
+        if self._delay is None:
+            return torch.zeros(0, 0)
+        return self(self._delay.new_zeros(self._delay.shape[0], self.lookahead - 1))
+
+
+def clip_blocks(wav: torch.Tensor, mode='rescale', chunk: int = 2**16,
+                peak: tp.Optional[float] = None) -> tp.Iterator[torch.Tensor]:
     """
-    different strategies for avoiding raw clipping.
+    Apply `prevent_clip` to `wav` by blocks of `chunk` samples, without ever copying all
+    of `wav`. For `mode='rescale'`, the peak is first measured over all the blocks,
+    unless it is given with `peak`, e.g. as recorded by a `PeakMeter` during separation.
+    For `mode='limiter'`, a single `Limiter` processes all the blocks.
+    """
+    T = wav.shape[-1]
+    if mode == 'rescale' and peak is None:
+        meter = PeakMeter()
+        for offset in range(0, T, chunk):
+            meter.update(wav[:, offset: offset + chunk])
+        peak = meter.peak
+    limiter = Limiter() if mode == 'limiter' else None
+    for offset in range(0, T, chunk):
+        block = wav[:, offset: offset + chunk]
+        if limiter is None:
+            yield prevent_clip(block, mode, peak)
+        else:
+            yield limiter(block)
+    if limiter is not None:
+        yield limiter.flush()
+
+
+def prevent_clip(wav, mode='rescale', peak=None):
+    """
+    different strategies for avoiding raw clipping. For `mode='rescale'`,
+    `peak` can be given if the maximum absolute value of `wav` is already known,
+    e.g. when `wav` is only a block of a longer signal. `mode='limiter'` uses a `Limiter`.
     """
     if mode is None or mode == 'none':
         return wav
     assert wav.dtype.is_floating_point, "too late for clipping"
     if mode == 'rescale':
-        wav = wav / max(1.01 * wav.abs().max(), 1)
+        if peak is None:
+            peak = wav.abs().max()
+        wav = wav / max(1.01 * peak, 1)
     elif mode == 'clamp':
         wav = wav.clamp(-0.99, 0.99)
     elif mode == 'tanh':
         wav = torch.tanh(wav)
+    elif mode == 'limiter':
+        limiter = Limiter()
+        wav = torch.cat([limiter(wav), limiter.flush()], dim=-1)
     else:
         raise ValueError(f"Invalid mode {mode}")
     return wav
@@ -237,21 +565,46 @@ def save_audio(wav: torch.Tensor,
                path: tp.Union[str, Path],
                samplerate: int,
                bitrate: int = 320,
-               clip: tp.Literal["rescale", "clamp", "tanh", "none"] = 'rescale',
+               clip: tp.Literal["rescale", "clamp", "tanh", "limiter", "none"] = 'rescale',
                bits_per_sample: tp.Literal[16, 24, 32] = 16,
                as_float: bool = False,
-               preset: tp.Literal[2, 3, 4, 5, 6, 7] = 2):
+               preset: tp.Literal[2, 3, 4, 5, 6, 7] = 2,
+               peak: tp.Optional[float] = None):
     """Save audio file, automatically preventing clipping if necessary
     based on the given `clip` strategy. If the path ends in `.mp3`, this
     will save as mp3 with the given `bitrate`. Use `preset` to set mp3 quality:
-    2 for highest quality, 7 for fastest speed
+    2 for highest quality, 7 for fastest speed. Clipping is then prevented
+    while encoding, block by block. `peak` is passed to `prevent_clip`, e.g. as recorded
+    by a `PeakMeter` during separation. When `soundfile` is installed, `.wav` and `.flac`
+    files are also written block by block, otherwise `torchaudio` needs a clipped copy
+    of the entire audio.
     """
-    wav = prevent_clip(wav, mode=clip)
     path = Path(path)
     suffix = path.suffix.lower()
     if suffix == ".mp3":
-        encode_mp3(wav, path, samplerate, bitrate, preset, verbose=True)
-    elif suffix == ".wav":
+        encode_mp3(wav, path, samplerate, bitrate, preset, verbose=True, clip=clip, peak=peak)
+        return
+    if suffix not in [".wav", ".flac"]:
+        raise ValueError(f"Invalid suffix for path: {suffix}")
+    try:
+        import soundfile
+    except ImportError:
+        pass
+    else:
+        if as_float and suffix == ".wav":
+            subtype = 'FLOAT'
+        else:
+            subtype = f'PCM_{bits_per_sample}'
+        wav = wav.detach().cpu()
+        with soundfile.SoundFile(str(path), 'w', samplerate, wav.shape[0], subtype) as f:
+            for block in clip_blocks(wav, clip, peak=peak):
+                if subtype != 'FLOAT':
+                    # libsndfile does not clip out of range values when converting to integers.
+                    block = block.clamp(-1, 1)
+                f.write(block.t().contiguous().numpy())
+        return
+    wav = prevent_clip(wav, mode=clip, peak=peak)
+    if suffix == ".wav":
         if as_float:
             bits_per_sample = 32
             encoding = 'PCM_F'
@@ -261,5 +614,232 @@ def save_audio(wav: torch.Tensor,
                 encoding=encoding, bits_per_sample=bits_per_sample)
     elif suffix == ".flac":
         ta.save(str(path), wav, sample_rate=samplerate, bits_per_sample=bits_per_sample)
-    else:
-        raise ValueError(f"Invalid suffix for path: {suffix}")
+
+
+def _stems_codec(codec, bitrate, bits_per_sample, as_float):
+    # ffmpeg arguments for the audio codec of `save_stems`.
+    if codec == 'pcm':
+        if as_float:
+            return ['-c:a', 'pcm_f32le']
+        return ['-c:a', 'pcm_s24le' if bits_per_sample == 24 else 'pcm_s16le']
+    elif codec in ['flac', 'alac']:
+        sample_fmt = 's16' if bits_per_sample == 16 else 's32'
+        if codec == 'alac':
+            sample_fmt += 'p'
+        return ['-c:a', codec, '-sample_fmt', sample_fmt]
+    elif codec in ['mp3', 'aac']:
+        encoder = 'libmp3lame' if codec == 'mp3' else 'aac'
+        return ['-c:a', encoder, '-b:a', f'{bitrate}k']
+    raise ValueError(f"Invalid codec {codec}")
+
+
+def save_stems(stems: tp.Dict[str, torch.Tensor],
+               path: tp.Union[str, Path],
+               samplerate: int,
+               codec: tp.Literal["pcm", "flac", "alac", "mp3", "aac"] = 'flac',
+               bitrate: int = 320,
+               clip: tp.Literal["rescale", "clamp", "tanh", "limiter", "none"] = 'rescale',
+               bits_per_sample: tp.Literal[16, 24, 32] = 16,
+               as_float: bool = False,
+               chunk: int = 2**16,
+               peaks: tp.Optional[tp.Dict[str, float]] = None):
+    """
+    Save all the stems of a track as the audio streams of a single file, e.g. `.mka`
+    (any codec) or `.mp4` (`alac`, `aac`, `mp3` or `flac`), each stream being named after
+    its stem. The stems are interleaved by blocks of `chunk` samples into a single
+    ffmpeg process, which splits them into streams and encodes them in one pass.
+    Clipping is prevented for each stem independently, as `save_audio` does.
+    The file can be read back with :class:`StemsFile`.
+
+    Args:
+        stems (dict): mapping from the stem names to their audio, of shape `[C, T]`.
+        path (Path or str): output file, the container is given by its suffix.
+        samplerate (int): sample rate of the stems.
+        codec (str): audio codec for all the streams.
+        bitrate (int): bitrate in kbps for `mp3` and `aac`.
+        clip (str): clipping prevention strategy, see `prevent_clip`.
+        bits_per_sample (int): bit depth for `pcm`, `flac` and `alac`.
+        as_float (bool): use float 32 bits samples for `pcm`.
+        chunk (int): number of samples sent to ffmpeg at once.
+        peaks (dict or None): known peak of some of the stems, see `save_audio`.
+    """
+    path = Path(path)
+    names = list(stems)
+    wavs = [stems[name].detach().cpu().float() for name in names]
+    if peaks is None:
+        peaks = {}
+    channels = wavs[0].shape[0]
+    assert all(wav.shape == wavs[0].shape for wav in wavs), "All stems must have the same shape."
+    layout = {1: 'mono', 2: 'stereo'}.get(channels, f'{channels}c')
+    # The input has the channels of all the stems, each stream takes its own.
+    filters = []
+    for index in range(len(names)):
+        mapping = '|'.join(str(index * channels + channel) for channel in range(channels))
+        filters.append(f'[0:a]channelmap=map={mapping}:channel_layout={layout}[s{index}]')
+    command = ['ffmpeg', '-y', '-loglevel', 'error']
+    command += ['-f', 'f32le', '-ar', str(samplerate), '-ac', str(len(names) * channels)]
+    command += ['-i', '-', '-filter_complex', ';'.join(filters)]
+    for index, name in enumerate(names):
+        command += ['-map', f'[s{index}]', f'-metadata:s:a:{index}', f'title={name}']
+        if path.suffix.lower() in ['.mp4', '.m4a', '.mov']:
+            # The stream titles are not stored in MP4, but the handler names are.
+            command += [f'-metadata:s:a:{index}', f'handler_name={name}']
+    command += _stems_codec(codec, bitrate, bits_per_sample, as_float)
+    if codec == 'flac' and samplerate % 10 == 0:
+        # Matroska timestamps are in milliseconds, so that seeking is only sample accurate
+        # if each frame lasts a whole number of milliseconds.
+        command += ['-frame_size', str(samplerate // 10)]
+    command += [str(path)]
+
+    process = sp.Popen(command, stdin=sp.PIPE)
+    assert process.stdin is not None
+    try:
+        streams = [clip_blocks(wav, clip, chunk, peaks.get(name)) for name, wav in zip(names, wavs)]
+        for blocks in zip(*streams):
+            block = torch.cat(blocks).t().contiguous().numpy()
+            process.stdin.write(block.data)
+    except BrokenPipeError:
+        # ffmpeg failed, the error is reported below.
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+    if process.returncode:
+        raise sp.CalledProcessError(process.returncode, command)
+
+
+class StemsFile(AudioFile):
+    """
+    Audio file with one stream per stem, as written by :func:`save_stems`, giving access
+    to the stems by name, from the title (or for MP4, the handler name) of each stream.
+    Streams without a name are named after their index.
+
+    Any stem can be read without decoding the others, either with :method:`read_stems`,
+    or with :method:`stem_reader` for successive or random windowed reads.
+    """
+    @property
+    def sources(self) -> tp.List[str]:
+        names: tp.List[str] = []
+        for index in self._audio_streams:
+            tags = self.info['streams'][index].get('tags', {})
+            tags = {key.lower(): value for key, value in tags.items()}
+            names.append(tags.get('title') or tags.get('handler_name') or str(len(names)))
+        return names
+
+    def stream(self, source: str) -> int:
+        """Index of the audio stream containing `source`."""
+        try:
+            return self.sources.index(source)
+        except ValueError:
+            raise KeyError(f"No stem {source} in {self.path}, "
+                           f"available stems are {', '.join(self.sources)}.")
+
+    def read_stems(self,
+                   sources: tp.Optional[tp.Sequence[str]] = None,
+                   seek_time=None,
+                   duration=None,
+                   samplerate=None,
+                   channels=None) -> tp.Dict[str, torch.Tensor]:
+        """
+        Read the given stems, or all of them if `sources` is None, with a single ffmpeg
+        process. Returns a dict mapping the stem names to tensors of shape `[C, T]`.
+        See :method:`AudioFile.read` for the other arguments.
+        """
+        if sources is None:
+            sources = self.sources
+        wavs = self.read(seek_time=seek_time, duration=duration,
+                         streams=[self.stream(source) for source in sources],
+                         samplerate=samplerate, channels=channels)
+        return dict(zip(sources, wavs))
+
+    def stem_reader(self, source: str, samplerate=None, channels=None) -> 'AudioReader':
+        """Return an :class:`AudioReader` over the stream of the given stem."""
+        return self.reader(self.stream(source), samplerate=samplerate, channels=channels)
+
+
+def _init_writer():
+    # Each worker encodes a single file at a time.
+    torch.set_num_threads(1)
+
+
+def _save_array(wav: np.ndarray, path: Path, kwargs: dict):
+    save_audio(torch.from_numpy(wav), path, **kwargs)
+
+
+def _save_stems_arrays(stems: tp.Dict[str, np.ndarray], path: Path, kwargs: dict):
+    save_stems({name: torch.from_numpy(wav) for name, wav in stems.items()}, path, **kwargs)
+
+
+class AudioWriter:
+    def __init__(self, workers: int = 4):
+        """
+        Save audio files with `save_audio` in a pool of processes, so that the stems
+        of a track are encoded concurrently, while the next track is being separated.
+
+        At most one set of files is pending at any time: calling :method:`save`
+        while the previous one is still being encoded first waits for it, which also
+        bounds the memory used by the pending audio.
+
+        Args:
+            workers (int): number of processes. If 0, :method:`save` blocks until
+                everything is written, as calling `save_audio` directly would.
+        """
+        self._pool = ProcessPoolExecutor(workers, initializer=_init_writer) if workers else None
+        self._pending: tp.List[Future] = []
+
+    def save(self, files: tp.Sequence[tp.Tuple[torch.Tensor, tp.Union[str, Path]]],
+             peaks: tp.Optional[tp.Sequence[tp.Optional[float]]] = None, **kwargs):
+        """
+        Save each pair `(wav, path)` in `files`, with the extra arguments
+        to `save_audio` given as keyword arguments. `peaks` optionally gives the `peak`
+        argument of `save_audio` for each file.
+        """
+        self.wait()
+        if peaks is None:
+            peaks = [None] * len(files)
+        assert len(peaks) == len(files)
+        for (wav, path), peak in zip(files, peaks):
+            if self._pool is None:
+                save_audio(wav, path, peak=peak, **kwargs)
+            else:
+                array = wav.detach().cpu().numpy()
+                self._pending.append(self._pool.submit(
+                    _save_array, array, Path(path), dict(kwargs, peak=peak)))
+
+    def save_stems(self, stems: tp.Dict[str, torch.Tensor], path: tp.Union[str, Path], **kwargs):
+        """
+        Save all the `stems` of a track into a single file with `save_stems`, with its
+        extra arguments given as keyword arguments. This counts as one set of files.
+        """
+        self.wait()
+        if self._pool is None:
+            save_stems(stems, path, **kwargs)
+        else:
+            arrays = {name: wav.detach().cpu().numpy() for name, wav in stems.items()}
+            self._pending.append(self._pool.submit(_save_stems_arrays, arrays, Path(path), kwargs))
+
+    def wait(self):
+        """Wait for the pending files to be written,
+        raising any exception that happened while writing them."""
+        pending = self._pending
+        self._pending = []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """Wait for the pending files and stop the workers."""
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
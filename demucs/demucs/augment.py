@@ -6,7 +6,9 @@
 """Data augmentations.
 """
 
+import math
 import random
+import time
 import torch as th
 from torch import nn
 
@@ -109,3 +111,241 @@ class Scale(nn.Module):
             scales = th.empty(batch, streams, 1, 1, device=device).uniform_(self.min, self.max)
             wav *= scales
         return wav
+
+
+class Repitch(nn.Module):
+    def __init__(self, proba=0.2, max_pitch=2, max_tempo=12, tempo_std=5, same=True,
+                 n_fft=2048, hop_length=512):
+        """
+        Randomly change the pitch and tempo of examples within a batch, as done by
+        `demucs.repitch.RepitchedWrapper`, but in process and on the training device.
+
+        The tempo is changed with a phase vocoder, with a rate chosen for each signal,
+        followed by a linear interpolation resampling to change the pitch.
+        The output is always cropped to `(1 - max_tempo / 100)` times the input length,
+        including for examples that were left untouched.
+
+        Args:
+            proba (float): probability of changing the pitch and tempo of an example.
+            max_pitch (int): maximum pitch change in semitones.
+            max_tempo (float): maximum tempo change in percent.
+            tempo_std (float): std of the tempo change in percent.
+            same (bool): if True, all the sources of an example get the same change.
+            n_fft (int): size of the FFT used by the phase vocoder.
+            hop_length (int): hop length used by the phase vocoder.
+        """
+        super().__init__()
+        self.proba = proba
+        self.max_pitch = max_pitch
+        self.max_tempo = max_tempo
+        self.tempo_std = tempo_std
+        self.same = same
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def forward(self, wav):
+        batch, sources, channels, time = wav.size()
+        device = wav.device
+        out_length = int((1 - 0.01 * self.max_tempo) * time)
+        if not self.training:
+            return wav[..., :out_length]
+
+        selected = (th.rand(batch, device=device) < self.proba).nonzero()[:, 0]
+        if len(selected) == 0:
+            return wav[..., :out_length]
+        out = wav[..., :out_length].clone()
+        shape = (len(selected), 1 if self.same else sources, 1)
+        pitch = th.randint(-self.max_pitch, self.max_pitch + 1, shape, device=device)
+        tempo = th.randn(shape, device=device) * self.tempo_std
+        tempo = tempo.clamp(-self.max_tempo, self.max_tempo)
+        pitch = pitch.expand(-1, sources, channels).reshape(-1)
+        tempo = tempo.expand(-1, sources, channels).reshape(-1)
+        signals = wav[selected].reshape(-1, time)
+        changed = self._repitch(signals, pitch.to(wav.dtype), tempo, out_length)
+        out[selected] = changed.view(len(selected), sources, channels, out_length)
+        return out
+
+    def _repitch(self, signals, pitch, tempo, length):
+        # Change pitch and tempo of signals of shape `[N, T]`, given per signal
+        # pitch (in semitones) and tempo (in percent) changes, and return `[N, length]`.
+        device = signals.device
+        n_fft = self.n_fft
+        hop = self.hop_length
+        factor = 2 ** (pitch / 12)
+        rate = (1 + 0.01 * tempo) / factor
+
+        window = th.hann_window(n_fft, device=device, dtype=signals.dtype)
+        spec = th.stft(signals, n_fft, hop, window=window, return_complex=True)
+        _, freqs, frames = spec.shape
+        stretched = int(math.ceil(length * 2 ** (self.max_pitch / 12))) + 2
+        steps = int(math.ceil(stretched / hop)) + 1
+
+        # Phase vocoder with a different rate for each signal.
+        positions = th.arange(steps, device=device) * rate[:, None]
+        positions = positions.clamp(max=frames - 1.001)
+        first = positions.long()
+        alpha = (positions - first)[:, None]
+        first = first[:, None].expand(-1, freqs, -1)
+        magnitude = spec.abs()
+        phase = spec.angle()
+        mag_0 = magnitude.gather(2, first)
+        mag_1 = magnitude.gather(2, first + 1)
+        phase_0 = phase.gather(2, first)
+        phase_1 = phase.gather(2, first + 1)
+        magnitude = (1 - alpha) * mag_0 + alpha * mag_1
+
+        # Only accumulate the deviation from the expected phase advance, the latter
+        # is computed exactly with integer arithmetic to avoid precision loss.
+        bins = th.arange(freqs, device=device)[:, None]
+        advance = 2 * math.pi * bins * hop / n_fft
+        deviation = phase_1 - phase_0 - advance
+        deviation = deviation - 2 * math.pi * th.round(deviation / (2 * math.pi))
+        deviation = th.cat([th.zeros_like(deviation[..., :1]), deviation[..., :-1]], dim=-1)
+        expected = (bins * hop * th.arange(steps, device=device)) % n_fft
+        expected = 2 * math.pi * expected / n_fft
+        accumulated = phase_0[..., :1] + deviation.cumsum(-1) + expected
+
+        # Identity phase locking (Laroche and Dolson), each bin keeps its phase relative
+        # to the closest magnitude peak, to limit phasiness.
+        inner = (magnitude[:, 1:-1] > magnitude[:, :-2]) & (magnitude[:, 1:-1] >= magnitude[:, 2:])
+        edge = th.zeros_like(inner[:, :1])
+        is_peak = th.cat([edge, inner, edge], dim=1)
+        below = th.where(is_peak, bins, -1).cummax(1).values
+        above = th.where(is_peak, bins, freqs).flip(1).cummin(1).values.flip(1)
+        peak = th.where((below >= 0) & (bins - below <= above - bins), below, above)
+        peak = th.where(peak == freqs, bins, peak)
+        phase = accumulated.gather(1, peak) + phase_0 - phase_0.gather(1, peak)
+        spec = th.polar(magnitude, phase)
+        stretched_wav = th.istft(spec, n_fft, hop, window=window, length=hop * (steps - 1))
+
+        # Resampling to change the pitch.
+        positions = th.arange(length, device=device) * factor[:, None]
+        positions = positions.clamp(max=stretched_wav.shape[-1] - 1.001)
+        first = positions.long()
+        alpha = positions - first
+        wav_0 = stretched_wav.gather(1, first)
+        wav_1 = stretched_wav.gather(1, first + 1)
+        return wav_0 + alpha * (wav_1 - wav_0)
+
+
+class FusedAugment(nn.Module):
+    def __init__(self, shift=8192, shift_same=False, flip=True,
+                 scale_proba=0., scale_min=0.25, scale_max=1.25,
+                 remix_proba=0., remix_group_size=4, seed=None, profile=False):
+        """
+        Same augmentations as `Shift`, `FlipChannels`, `FlipSign`, `Scale` and `Remix`
+        applied in that order, but with all the random parameters drawn up front,
+        then applied with a single gather over a strided view of the input,
+        followed by a single in place multiplication for the sign and gain.
+
+        Args:
+            shift, shift_same: see `Shift`.
+            flip (bool): apply `FlipChannels` and `FlipSign`.
+            scale_proba, scale_min, scale_max: see `Scale`, disabled if `scale_proba` is 0.
+            remix_proba, remix_group_size: see `Remix`, disabled if `remix_proba` is 0.
+            seed (int or None): seed for the generator used for all random parameters.
+            profile (bool): if True, record the time (and CUDA memory) of each stage,
+                see :method:`report`.
+        """
+        super().__init__()
+        self.shift = shift
+        self.shift_same = shift_same
+        self.flip = flip
+        self.scale_proba = scale_proba
+        self.scale_min = scale_min
+        self.scale_max = scale_max
+        self.remix_proba = remix_proba
+        self.remix_group_size = remix_group_size
+        self.generator = th.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.profile = profile
+        self.stats = {}
+
+    def _sample(self, batch, sources, channels):
+        # Returns, for each output `[B, S, C]`, the row of the input `[B * S * C, T]`
+        # to read from, along with the time offset `[B, S]` and the gain `[B, S]`.
+        gen = self.generator
+        shape = (batch, sources)
+        offsets = th.zeros(shape, dtype=th.long)
+        if self.shift > 0:
+            srcs = 1 if self.shift_same else sources
+            offsets = th.randint(self.shift, (batch, srcs), generator=gen).expand(shape)
+        gains = th.ones(shape)
+        chans = th.arange(channels).expand(batch, sources, channels)
+        if self.flip:
+            if channels == 2:
+                left = th.randint(2, shape, generator=gen)
+                chans = th.stack([left, 1 - left], dim=-1)
+            gains = gains * (2 * th.randint(2, shape, generator=gen) - 1)
+        if self.scale_proba and th.rand(1, generator=gen).item() < self.scale_proba:
+            gains = gains * th.empty(shape).uniform_(self.scale_min, self.scale_max, generator=gen)
+
+        examples = th.arange(batch)[:, None].expand(shape)
+        if self.remix_proba and th.rand(1, generator=gen).item() < self.remix_proba:
+            group_size = self.remix_group_size or batch
+            if batch % group_size != 0:
+                raise ValueError(f"Batch size {batch} must be divisible by group size {group_size}")
+            groups = batch // group_size
+            permutations = th.argsort(th.rand(groups, group_size, sources, generator=gen), dim=1)
+            permutations = permutations + group_size * th.arange(groups)[:, None, None]
+            examples = permutations.view(shape)
+
+        # The remix picks, for each source, the example it comes from, along with
+        # all the parameters drawn for that example and source.
+        source_idx = th.arange(sources)[None]
+        rows = (examples * sources + source_idx)[..., None] * channels
+        rows = rows + chans[examples, source_idx]
+        return rows, offsets[examples, source_idx], gains[examples, source_idx]
+
+    def _stage(self, name, begin, device):
+        if device.type == 'cuda':
+            th.cuda.synchronize(device)
+        now = time.time()
+        stats = self.stats.setdefault(name, {'count': 0, 'time': 0., 'memory': 0})
+        stats['count'] += 1
+        stats['time'] += now - begin
+        if device.type == 'cuda':
+            stats['memory'] = max(stats['memory'], th.cuda.max_memory_allocated(device))
+            th.cuda.reset_peak_memory_stats(device)
+        return now
+
+    def forward(self, wav):
+        batch, sources, channels, frames = wav.size()
+        length = frames - self.shift
+        if not self.training:
+            return wav[..., :length]
+        device = wav.device
+        if self.profile:
+            if device.type == 'cuda':
+                th.cuda.synchronize(device)
+                th.cuda.reset_peak_memory_stats(device)
+            begin = time.time()
+        rows, offsets, gains = self._sample(batch, sources, channels)
+        rows = rows.to(device, non_blocking=True)
+        offsets = offsets.to(device, non_blocking=True)
+        gains = gains.to(device=device, dtype=wav.dtype, non_blocking=True)
+        if self.profile:
+            begin = self._stage('sample', begin, device)
+
+        # `windows[row, offset]` is the shifted signal for a given row, without any copy.
+        windows = wav.reshape(batch * sources * channels, frames).unfold(1, length, 1)
+        out = windows[rows, offsets[..., None].expand_as(rows)]
+        if self.profile:
+            begin = self._stage('gather', begin, device)
+        out *= gains[..., None, None]
+        if self.profile:
+            self._stage('gain', begin, device)
+        return out
+
+    def report(self):
+        """Return a summary of the average time and peak CUDA memory for each stage."""
+        lines = []
+        for name, stats in self.stats.items():
+            line = f"{name}: {1000 * stats['time'] / stats['count']:.2f}ms"
+            if stats['memory']:
+                line += f", peak {stats['memory'] / 2**20:.1f}MB"
+            lines.append(line)
+        return " | ".join(lines)
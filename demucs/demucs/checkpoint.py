@@ -0,0 +1,124 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Background writer for training checkpoints.
+
+Saving a checkpoint only blocks training for the time needed to copy the tensors
+to host memory. Serialization and writing then happen in a separate thread,
+using `write_and_rename` so that a checkpoint is never left half written.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+import logging
+import os
+from pathlib import Path
+import shutil
+import typing as tp
+
+from dora.utils import write_and_rename
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot(obj, memo: tp.Optional[dict] = None):
+    """
+    Return a copy of `obj` that will not change while training continues,
+    with all tensors copied to the CPU. Containers are copied recursively,
+    and a tensor appearing more than once is only copied once, so that
+    packages sharing tensors can be snapshotted together with the same `memo`.
+    """
+    if memo is None:
+        memo = {}
+    if isinstance(obj, torch.Tensor):
+        key = id(obj)
+        if key not in memo:
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    elif isinstance(obj, dict):
+        return obj.__class__((key, snapshot(value, memo)) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(value, memo) for value in obj)
+    else:
+        return copy.deepcopy(obj)
+
+
+def _link(source: Path, target: Path):
+    # Hard link when possible, as the source is only ever replaced by renaming.
+    tmp = Path(str(target) + ".tmp")
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, target)
+
+
+class CheckpointWriter:
+    def __init__(self, asynchronous: bool = True):
+        """
+        Write checkpoints with `torch.save`, possibly in a background thread.
+
+        At most one set of checkpoints is pending at any time: calling :method:`save`
+        while the previous one is still being written first waits for it, which also
+        bounds the host memory used by the snapshots.
+
+        Args:
+            asynchronous (bool): if False, :method:`save` blocks until everything
+                is written, as a plain `torch.save` would.
+        """
+        self.asynchronous = asynchronous
+        self._pool = ThreadPoolExecutor(1) if asynchronous else None
+        self._pending: tp.Optional[Future] = None
+
+    def save(self, files: tp.Sequence[tp.Tuple[tp.Any, tp.Sequence[Path]]]):
+        """
+        Snapshot and write a number of packages. Each entry of `files` is a pair
+        `(package, paths)`: the package is serialized once to the first path,
+        and then linked (or copied) to the other ones.
+        Tensors shared between packages are only copied once to host memory.
+        """
+        self.wait()
+        memo: dict = {}
+        files = [(snapshot(package, memo), [Path(path) for path in paths])
+                 for package, paths in files]
+        if self._pool is None:
+            self._write(files)
+        else:
+            self._pending = self._pool.submit(self._write, files)
+
+    def _write(self, files):
+        for package, paths in files:
+            first, *others = paths
+            with write_and_rename(first) as tmp:
+                torch.save(package, tmp)
+            for other in others:
+                _link(first, other)
+            logger.debug("Checkpoint saved to %s", first.resolve())
+
+    def wait(self):
+        """Wait for the pending checkpoints to be written,
+        raising any exception that happened while writing them."""
+        pending = self._pending
+        self._pending = None
+        if pending is not None:
+            pending.result()
+
+    def close(self):
+        """Wait for the pending checkpoints and stop the writer thread."""
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
@@ -13,7 +13,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from .states import capture_init
-from .utils import center_trim, unfold
+from .utils import activation_checkpoint, center_trim, unfold
 from .transformer import LayerScale
 
 
@@ -111,6 +111,7 @@ class DConv(nn.Module):
         """
 
         super().__init__()
+        self.checkpoint = False  # see `demucs.train.set_checkpointing`.
         assert kernel % 2 == 1
         self.channels = channels
         self.compress = compress
@@ -149,6 +150,11 @@ class DConv(nn.Module):
             self.layers.append(layer)
 
     def forward(self, x):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return activation_checkpoint(self._forward, x)
+        return self._forward(x)
+
+    def _forward(self, x):
         for layer in self.layers:
             x = x + layer(x)
         return x
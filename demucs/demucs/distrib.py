@@ -11,7 +11,7 @@ import pickle
 import numpy as np
 import torch
 from torch.utils.data.distributed import DistributedSampler
-from torch.utils.data import DataLoader, Subset
+from torch.utils.data import DataLoader, IterableDataset, Subset
 from torch.nn.parallel.distributed import DistributedDataParallel
 
 from dora import distrib as dora_distrib
@@ -86,6 +86,9 @@ def loader(dataset, *args, shuffle=False, klass=DataLoader, **kwargs):
     Create a dataloader properly in case of distributed training.
     If a gradient is going to be computed you must set `shuffle=True`.
     """
+    if isinstance(dataset, IterableDataset):
+        # Iterable datasets are in charge of their own sharding and shuffling.
+        return klass(dataset, *args, **kwargs)
     if world_size == 1:
         return klass(dataset, *args, shuffle=shuffle, **kwargs)
 
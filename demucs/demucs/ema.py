@@ -20,37 +20,62 @@ class ModelEMA:
         ema = ModelEMA(model)
         with ema.swap():
             # compute valid metrics with averaged model.
+
+    The averaged weights are stored in a single flat buffer on `device`, and updated
+    with fused multi-tensor operations. With `every=k`, only one call to `update`
+    out of `k` actually updates the weights, with the decay raised to the power `k`.
     """
-    def __init__(self, model, decay=0.9999, unbias=True, device='cpu'):
+    def __init__(self, model, decay=0.9999, unbias=True, device='cpu', every=1):
         self.decay = decay
         self.model = model
         self.state = {}
         self.count = 0
         self.device = device
         self.unbias = unbias
+        self.every = every
+        self._steps = 0
 
         self._init()
 
+    def _tensors(self):
+        return {key: val for key, val in self.model.state_dict().items()
+                if val.dtype == torch.float32}
+
     def _init(self):
-        for key, val in self.model.state_dict().items():
-            if val.dtype != torch.float32:
-                continue
-            device = self.device or val.device
-            if key not in self.state:
-                self.state[key] = val.detach().to(device, copy=True)
+        tensors = self._tensors()
+        if not tensors:
+            # Nothing to average, as only the float32 weights are.
+            self._flat = torch.zeros(0, device=self.device or 'cpu')
+            return
+        device = self.device or next(iter(tensors.values())).device
+        self._flat = torch.cat([val.detach().reshape(-1).to(device) for val in tensors.values()])
+        offset = 0
+        for key, val in tensors.items():
+            numel = val.numel()
+            self.state[key] = self._flat[offset: offset + numel].view_as(val)
+            offset += numel
 
     def update(self):
+        self._steps += 1
+        if self._steps % self.every:
+            return
+        decay = self.decay ** self.every
         if self.unbias:
-            self.count = self.count * self.decay + 1
+            self.count = self.count * decay + 1
             w = 1 / self.count
         else:
-            w = 1 - self.decay
-        for key, val in self.model.state_dict().items():
-            if val.dtype != torch.float32:
-                continue
-            device = self.device or val.device
-            self.state[key].mul_(1 - w)
-            self.state[key].add_(val.detach().to(device), alpha=w)
+            w = 1 - decay
+        averages = list(self.state.values())
+        if not averages:
+            return
+        values = [val.detach() for val in self._tensors().values()]
+        if values[0].device != self._flat.device:
+            values = [val.to(self._flat.device) for val in values]
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(averages, values, w)
+        else:
+            torch._foreach_mul_(averages, 1 - w)
+            torch._foreach_add_(averages, values, alpha=w)
 
     @contextmanager
     def swap(self):
@@ -58,9 +83,12 @@ class ModelEMA:
             yield
 
     def state_dict(self):
-        return {'state': self.state, 'count': self.count}
+        # Only moved to the CPU when saving a checkpoint.
+        return {'state': {key: val.cpu() for key, val in self.state.items()},
+                'count': self.count, 'steps': self._steps}
 
     def load_state_dict(self, state):
         self.count = state['count']
+        self._steps = state.get('steps', 0)
         for k, v in state['state'].items():
             self.state[k].copy_(v)
@@ -10,9 +10,17 @@ be reported as `nsdr` for `new sdr`).
 """
 
 from concurrent import futures
+import glob
+import hashlib
+import json
 import logging
+import os
+from pathlib import Path
+import re
+import time
 
 from dora.log import LogProgress
+from dora.utils import write_and_rename
 import numpy as np
 import musdb
 import museval
@@ -20,7 +28,8 @@ import torch as th
 
 from .apply import apply_model
 from .audio import convert_audio, save_audio
-from . import distrib
+from . import bsseval, distrib
+from .states import state_hash
 from .utils import DummyPoolExecutor
 
 
@@ -43,7 +52,52 @@ def new_sdr(references, estimates):
     return scores
 
 
-def eval_track(references, estimates, win, hop, compute_sdr=True):
+def framewise_sdr(references, estimates, window, hop=None, scale_invariant=False,
+                  silence=1e-10):
+    """
+    Compute the SDR with the MDX definition (see `new_sdr`), or the scale invariant SDR,
+    over windows of `window` samples with the given `hop` (default to `window`),
+    as museval does for the original SDR. Only full windows are used, unless
+    the signals are shorter than one window.
+
+    Args:
+        references (Tensor): of shape `[B, S, C, T]`.
+        estimates (Tensor): of shape `[B, S, C, T]`.
+        silence (float): a window is silent if the mean power of each channel, once the mean
+            of the window is removed, is below this threshold. This catches both the
+            digital silence museval ignores, and the constant signal a silent source
+            becomes once normalized with `dset.normalize`.
+
+    Returns:
+        Tensor of shape `[B, S, W]` on the same device, with `nan` for the windows
+        where any of the reference or estimated source is silent, as in museval.
+    """
+    assert references.dim() == 4
+    assert estimates.dim() == 4
+    delta = 1e-7  # avoid numerical errors
+    window = min(window, references.shape[-1])
+    hop = hop or window
+    references = references.unfold(-1, window, hop).transpose(2, 3).flatten(-2)
+    estimates = estimates.unfold(-1, window, hop).transpose(2, 3).flatten(-2)
+    silent = _is_silent(references, window, silence) | _is_silent(estimates, window, silence)
+    if scale_invariant:
+        scale = (estimates * references).sum(-1, keepdim=True)
+        scale = scale / (references.pow(2).sum(-1, keepdim=True) + delta)
+        references = scale * references
+    num = references.pow(2).sum(-1) + delta
+    den = (references - estimates).pow(2).sum(-1) + delta
+    scores = 10 * th.log10(num / den)
+    return scores.masked_fill(silent, float('nan'))
+
+
+def _is_silent(windows, window, silence):
+    # `windows` is of shape `[B, S, W, C * window]`, returns `[B, 1, W]`.
+    windows = windows.unflatten(-1, (-1, window))
+    power = windows.var(-1, unbiased=False)
+    return (power < silence).all(-1).any(1, keepdim=True)
+
+
+def eval_track(references, estimates, win, hop, compute_sdr=True, backend='museval'):
     references = references.transpose(1, 2).double()
     estimates = estimates.transpose(1, 2).double()
 
@@ -51,6 +105,9 @@ def eval_track(references, estimates, win, hop, compute_sdr=True):
 
     if not compute_sdr:
         return None, new_scores
+    elif backend == 'torch':
+        scores = bsseval.bss_eval(references, estimates, window=win, hop=hop)
+        return scores, new_scores
     else:
         references = references.numpy()
         estimates = estimates.numpy()
@@ -64,13 +121,120 @@ def eval_track(references, estimates, win, hop, compute_sdr=True):
         return scores, new_scores
 
 
+def assign_tracks(durations, world_size):
+    """
+    Split tracks between `world_size` workers, so that they all have about the same
+    total duration to process. Tracks are assigned from the longest to the shortest,
+    each one to the worker with the least total duration so far.
+    Returns, for each worker, the list of indexes of its tracks, longest first.
+    """
+    loads = [0.] * world_size
+    assignment = [[] for _ in range(world_size)]
+    order = sorted(range(len(durations)), key=lambda index: (-durations[index], index))
+    for index in order:
+        worker = min(range(world_size), key=lambda worker: (loads[worker], worker))
+        loads[worker] += durations[index]
+        assignment[worker].append(index)
+    return assignment
+
+
+def reference_folder(args, samplerate, channels):
+    """Folder for the cached references of the test set, resampled to `samplerate`
+    and converted to `channels`, under `dset.metadata`."""
+    root = str(Path(args.test.nonhq or args.dset.musdb).resolve())
+    key = json.dumps([root, samplerate, channels])
+    sig = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return Path(args.dset.metadata) / "references" / sig
+
+
+def _load_references(track, sources, src_rate, samplerate, channels, folder=None):
+    # References of shape `[S, C, T]` converted for the model. If `folder` is given,
+    # each one is cached there as a float32 npy file the first time, and memory mapped after.
+    if folder is not None:
+        files = [folder / track.name / f"{name}.npy" for name in sources]
+        if all(file.exists() for file in files):
+            return th.stack([th.from_numpy(np.load(file, mmap_mode='c')) for file in files])
+    references = th.stack(
+        [th.from_numpy(track.targets[name].audio).t() for name in sources])
+    if references.dim() == 2:
+        references = references[:, None]
+    references = convert_audio(references, src_rate, samplerate, channels)
+    if folder is None:
+        return references
+    references = references.float()
+    for file, reference in zip(files, references):
+        file.parent.mkdir(exist_ok=True, parents=True)
+        tmp = file.parent / (file.stem + ".tmp.npy")
+        np.save(tmp, reference.numpy())
+        os.rename(tmp, file)
+    return references
+
+
+def _load_track(track, sources, src_rate, samplerate, channels, cache=None):
+    # Load, normalize and resample the mixture and references of a track,
+    # run in a background thread while the previous track is being separated.
+    begin = time.time()
+    mix = th.from_numpy(track.audio).t().float()
+    if mix.dim() == 1:
+        mix = mix[None]
+    ref = mix.mean(dim=0)  # mono mixture
+    mix = (mix - ref.mean()) / ref.std()
+    mix = convert_audio(mix, src_rate, samplerate, channels)
+    references = _load_references(track, sources, src_rate, samplerate, channels, cache)
+    return (mix, ref.mean(), ref.std(), references), time.time() - begin
+
+
+def _cache_file(folder, track_name, model_hash, args):
+    # Results for a track are only reused for the same model and test time settings.
+    key = [model_hash, track_name, args.test.shifts, args.test.overlap, args.test.split,
+           args.test.nonhq or args.dset.musdb, args.dset.musdb_samplerate, args.test.bsseval]
+    sig = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+    return folder / f"{track_name}-{sig}.json"
+
+
+def _remove_stale(cache_file, track_name):
+    # Remove the results for the track from other models or settings than `cache_file`.
+    for file in cache_file.parent.glob(glob.escape(track_name) + "-*.json"):
+        sig = file.stem[len(track_name) + 1:]
+        if file != cache_file and re.fullmatch("[0-9a-f]{16}", sig):
+            file.unlink(missing_ok=True)
+
+
+def _load_cached(file, compute_sdr):
+    try:
+        with open(file) as f:
+            track = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if compute_sdr:
+        if any('SDR' not in metrics for metrics in track.values()):
+            return None
+        return track
+    return {target: {'nsdr': metrics['nsdr']} for target, metrics in track.items()}
+
+
+def _timed(func, *args, **kwargs):
+    # Return the output of `func` along with the time it took, e.g. in a worker process.
+    begin = time.time()
+    out = func(*args, **kwargs)
+    return out, time.time() - begin
+
+
 def evaluate(solver, compute_sdr=False):
     """
     Evaluate model using museval.
     compute_sdr=False means using only the MDX definition of the SDR, which
     is much faster to evaluate.
-    """
 
+    Results for each track are saved under `results/test` in the XP folder, and reused
+    when evaluating again the same model with the same settings, e.g. after preemption,
+    unless `test.save` is set and the estimates for the track were not saved.
+    The remaining tracks are split between workers according to their duration. On each worker,
+    the next track is loaded while the current one is separated, and scoring
+    and saving happen in the process pool. The time spent in each stage,
+    summed over all workers, is logged.
+    """
+    begin = time.time()
     args = solver.args
 
     output_dir = solver.folder / "results"
@@ -84,6 +248,8 @@ def evaluate(solver, compute_sdr=False):
     else:
         test_set = musdb.DB(args.test.nonhq, subsets=["test"], is_wav=False)
     src_rate = args.dset.musdb_samplerate
+    if args.test.bsseval not in ['museval', 'torch']:
+        raise ValueError(f"Invalid test.bsseval {args.test.bsseval}")
 
     eval_device = 'cpu'
 
@@ -91,51 +257,91 @@ def evaluate(solver, compute_sdr=False):
     win = int(1. * model.samplerate)
     hop = int(1. * model.samplerate)
 
-    indexes = range(distrib.rank, len(test_set), distrib.world_size)
-    indexes = LogProgress(logger, indexes, updates=args.misc.num_prints,
-                          name='Eval')
+    model_hash = state_hash(model.state_dict())
+    cache_files = [_cache_file(json_folder, track.name, model_hash, args)
+                   for track in test_set.tracks]
+    cached = {}
+    todo = []
+    if distrib.rank == 0:
+        # Only scanned on one worker, as others could be writing results in the meantime,
+        # so that all workers split the same remaining tracks.
+        missing_saves = 0
+        for index, (track, cache_file) in enumerate(zip(test_set.tracks, cache_files)):
+            track_result = _load_cached(cache_file, compute_sdr)
+            if track_result is not None and args.test.save:
+                folder = solver.folder / "wav" / track.name
+                if not all((folder / (name + ".mp3")).exists() for name in model.sources):
+                    missing_saves += 1
+                    track_result = None
+            if track_result is None:
+                todo.append(index)
+            else:
+                cached[track.name] = track_result
+        if cached:
+            logger.info("Reusing results for %d tracks out of %d",
+                        len(cached), len(test_set.tracks))
+        if missing_saves:
+            logger.info("Evaluating again %d tracks with results but without saved estimates",
+                        missing_saves)
+    cached, todo = distrib.share((cached, todo))
+
+    cache = None
+    if args.test.cache_references:
+        cache = reference_folder(args, model.samplerate, model.audio_channels)
+
+    durations = [test_set.tracks[index].duration for index in todo]
+    indexes = [todo[position]
+               for position in assign_tracks(durations, distrib.world_size)[distrib.rank]]
     pendings = []
+    saves = []
+    timing = {'load': 0., 'wait': 0., 'separate': 0., 'score': 0., 'save': 0.}
 
     pool = futures.ProcessPoolExecutor if args.test.workers else DummyPoolExecutor
-    with pool(args.test.workers) as pool:
-        for index in indexes:
+    with pool(args.test.workers) as pool, futures.ThreadPoolExecutor(1) as loader:
+        def _prefetch(position):
+            if position >= len(indexes):
+                return None
+            track = test_set.tracks[indexes[position]]
+            return loader.submit(_load_track, track, model.sources, src_rate,
+                                 model.samplerate, model.audio_channels, cache)
+
+        loading = _prefetch(0)
+        for position, index in enumerate(LogProgress(logger, indexes, name='Eval',
+                                                     updates=args.misc.num_prints)):
             track = test_set.tracks[index]
+            start = time.time()
+            (mix, mean, std, references), duration = loading.result()
+            timing['wait'] += time.time() - start
+            timing['load'] += duration
+            loading = _prefetch(position + 1)
 
-            mix = th.from_numpy(track.audio).t().float()
-            if mix.dim() == 1:
-                mix = mix[None]
-            mix = mix.to(solver.device)
-            ref = mix.mean(dim=0)  # mono mixture
-            mix = (mix - ref.mean()) / ref.std()
-            mix = convert_audio(mix, src_rate, model.samplerate, model.audio_channels)
-            estimates = apply_model(model, mix[None],
+            start = time.time()
+            estimates = apply_model(model, mix[None].to(solver.device),
                                     shifts=args.test.shifts, split=args.test.split,
                                     overlap=args.test.overlap)[0]
-            estimates = estimates * ref.std() + ref.mean()
+            estimates = estimates * std + mean
             estimates = estimates.to(eval_device)
+            timing['separate'] += time.time() - start
 
-            references = th.stack(
-                [th.from_numpy(track.targets[name].audio).t() for name in model.sources])
-            if references.dim() == 2:
-                references = references[:, None]
             references = references.to(eval_device)
-            references = convert_audio(references, src_rate,
-                                       model.samplerate, model.audio_channels)
             if args.test.save:
                 folder = solver.folder / "wav" / track.name
                 folder.mkdir(exist_ok=True, parents=True)
                 for name, estimate in zip(model.sources, estimates):
-                    save_audio(estimate.cpu(), folder / (name + ".mp3"), model.samplerate)
+                    saves.append(pool.submit(
+                        _timed, save_audio, estimate, folder / (name + ".mp3"), model.samplerate))
 
-            pendings.append((track.name, pool.submit(
-                eval_track, references, estimates, win=win, hop=hop, compute_sdr=compute_sdr)))
+            pendings.append((index, pool.submit(
+                _timed, eval_track, references, estimates, win=win, hop=hop,
+                compute_sdr=compute_sdr, backend=args.test.bsseval)))
 
         pendings = LogProgress(logger, pendings, updates=args.misc.num_prints,
                                name='Eval (BSS)')
         tracks = {}
-        for track_name, pending in pendings:
-            pending = pending.result()
-            scores, nsdrs = pending
+        for index, pending in pendings:
+            track_name = test_set.tracks[index].name
+            (scores, nsdrs), duration = pending.result()
+            timing['score'] += duration
             tracks[track_name] = {}
             for idx, target in enumerate(model.sources):
                 tracks[track_name][target] = {'nsdr': [float(nsdrs[idx])]}
@@ -149,10 +355,19 @@ def evaluate(solver, compute_sdr=False):
                         "SAR": sar[idx].tolist()
                     }
                     tracks[track_name][target].update(values)
+            with write_and_rename(cache_files[index], "w") as f:
+                json.dump(tracks[track_name], f)
+            _remove_stale(cache_files[index], track_name)
+        for pending in saves:
+            timing['save'] += pending.result()[1]
+        timing['total'] = time.time() - begin
 
-        all_tracks = {}
+        all_tracks = dict(cached)
+        all_timings = []
         for src in range(distrib.world_size):
-            all_tracks.update(distrib.share(tracks, src))
+            shared_tracks, shared_timing = distrib.share((tracks, timing), src)
+            all_tracks.update(shared_tracks)
+            all_timings.append(shared_timing)
 
         result = {}
         metric_names = next(iter(all_tracks.values()))[model.sources[0]]
@@ -171,4 +386,8 @@ def evaluate(solver, compute_sdr=False):
                 avg_of_medians += median / len(model.sources)
             result[metric_name.lower()] = avg
             result[metric_name.lower() + "_med"] = avg_of_medians
+        total_timing = {key: sum(timing[key] for timing in all_timings) for key in timing}
+        total_timing['total'] = max(timing['total'] for timing in all_timings)
+        logger.info("Eval timing | %s",
+                    " | ".join(f"{key}={value:.1f}s" for key, value in total_timing.items()))
         return result
@@ -0,0 +1,235 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Flat model format, which can be loaded without unpickling anything.
+
+A flat file starts with the size of a JSON header, encoded on 8 bytes (little endian),
+followed by the header itself, which contains the class and arguments of the model,
+along with the dtype, shape and offset of each tensor in its state. The tensors are stored
+after the header as raw little endian data, each aligned on `ALIGNMENT` bytes.
+
+When loading, the file is memory mapped and tensors are views on it, with no copy
+if the model uses the same dtype as the stored tensors. For this reason, floating point
+tensors are always stored as float32, like the model weights, even when the package to save
+is in half precision, e.g. as for `.th` files. Flat files are thus twice larger than
+half precision `.th` files. The model is also created without running the random
+initialization of its weights.
+
+Torch is only imported when needed, so that `FLAT_SUFFIX` can be used to scan repos
+without importing it.
+"""
+
+from contextlib import contextmanager
+from fractions import Fraction
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import mmap
+from pathlib import Path
+import struct
+import sys
+import threading
+import typing as tp
+
+if tp.TYPE_CHECKING:
+    import torch
+
+FLAT_SUFFIX = ".flat"
+ALIGNMENT = 64
+_ALLOWED_MODULES = ("demucs.",)
+
+
+def _encode(obj):
+    if isinstance(obj, Fraction):
+        return {"__fraction__": [obj.numerator, obj.denominator]}
+    elif hasattr(obj, "item"):
+        # numpy or torch scalars, e.g. in the metrics.
+        return obj.item()
+    raise TypeError(f"Cannot store {obj!r} of type {type(obj)} in a flat model.")
+
+
+def _decode(obj):
+    if "__fraction__" in obj:
+        return Fraction(*obj["__fraction__"])
+    return obj
+
+
+def _klass_name(klass) -> str:
+    return f"{klass.__module__}:{klass.__qualname__}"
+
+
+def _resolve_klass(name: str):
+    module, qualname = name.split(":")
+    if not module.startswith(_ALLOWED_MODULES):
+        raise ValueError(f"Refusing to load model class {name} from a flat file.")
+    obj: tp.Any = importlib.import_module(module)
+    for part in qualname.split("."):
+        obj = getattr(obj, part)
+    return obj
+
+
+def _as_stored(value):
+    value = value.detach().cpu().contiguous()
+    if value.is_floating_point():
+        value = value.float()
+    return value
+
+
+def save_flat(package: dict, path: tp.Union[str, Path]):
+    """
+    Save a package as returned by `demucs.states.serialize_model` to `path` in the flat format.
+    Quantized states are not supported. Floating point tensors are stored as float32.
+    """
+    import torch
+    state = package["state"]
+    if state.get("__quantized"):
+        raise ValueError("Quantized models cannot be stored in the flat format.")
+    state = {key: _as_stored(value) for key, value in state.items()}
+    tensors: tp.Dict[str, dict] = {}
+    offset = 0
+    for key, value in state.items():
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        nbytes = value.numel() * value.element_size()
+        tensors[key] = {"dtype": str(value.dtype).split(".")[-1],
+                        "shape": list(value.shape), "offset": offset}
+        offset += nbytes
+    header = {
+        "klass": _klass_name(package["klass"]),
+        "args": list(package["args"]),
+        "kwargs": package["kwargs"],
+        "training_args": package.get("training_args"),
+        "metrics": package.get("metrics"),
+        "tensors": tensors,
+    }
+    raw = json.dumps(header, default=_encode).encode()
+    start = (8 + len(raw) + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    raw += b" " * (start - 8 - len(raw))
+    path = Path(path)
+    tmp = path.parent / (path.name + ".tmp")
+    with open(tmp, "wb") as file:
+        file.write(struct.pack("<Q", len(raw)))
+        file.write(raw)
+        for key, value in state.items():
+            file.seek(start + tensors[key]["offset"])
+            file.write(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+        file.truncate(start + offset)
+    tmp.rename(path)
+
+
+def save_flat_with_checksum(package: dict, path: Path) -> Path:
+    """Same as `save_flat`, adding the sha256 prefix to the file name,
+    as `demucs.states.save_with_checksum` does. Returns the final path."""
+    save_flat(package, path)
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            buf = file.read(2**20)
+            if not buf:
+                break
+            sha.update(buf)
+    final = path.parent / (path.stem + "-" + sha.hexdigest()[:8] + path.suffix)
+    path.rename(final)
+    return final
+
+
+def read_flat(path: tp.Union[str, Path]) -> dict:
+    """
+    Read a flat file and return a package in the same format as `serialize_model`,
+    with the state tensors being views of the memory mapped file.
+    """
+    import torch
+    if sys.byteorder != "little":
+        raise RuntimeError("Flat models can only be loaded on little endian machines.")
+    with open(path, "rb") as file:
+        size, = struct.unpack("<Q", file.read(8))
+        header = json.loads(file.read(size), object_hook=_decode)
+        # Copy on write, so that tensors are writable without ever modifying the file.
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    start = 8 + size
+    state = {}
+    for key, info in header["tensors"].items():
+        dtype = getattr(torch, info["dtype"])
+        shape = info["shape"]
+        count = 1
+        for dim in shape:
+            count *= dim
+        if count == 0:
+            tensor = torch.empty(shape, dtype=dtype)
+        else:
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count,
+                                      offset=start + info["offset"]).view(shape)
+        state[key] = tensor
+    return {
+        "klass": _resolve_klass(header["klass"]),
+        "args": header["args"],
+        "kwargs": header["kwargs"],
+        "training_args": header["training_args"],
+        "metrics": header["metrics"],
+        "state": state,
+    }
+
+
+# Threads currently building a model in `_skip_init`, see `_skip_init`.
+_init_lock = threading.Lock()
+_init_local = threading.local()
+_init_users = 0
+_init_saved: tp.Dict[str, tp.Callable] = {}
+
+
+def _skippable(function):
+    @functools.wraps(function)
+    def _wrapped(tensor, *args, **kwargs):
+        if getattr(_init_local, "skip", False):
+            return tensor
+        return function(tensor, *args, **kwargs)
+    return _wrapped
+
+
+@contextmanager
+def _skip_init():
+    # Turn the functions from `torch.nn.init` into no-ops for the current thread,
+    # as all the weights will be overwritten by the stored ones. The functions are replaced
+    # while any thread is in this context, but still initialize the weights in other threads,
+    # e.g. when loading other models in parallel with `demucs.registry`.
+    global _init_users
+    import torch
+    with _init_lock:
+        if _init_users == 0:
+            for name in dir(torch.nn.init):
+                if name.endswith("_") and not name.startswith("_"):
+                    _init_saved[name] = getattr(torch.nn.init, name)
+                    setattr(torch.nn.init, name, _skippable(_init_saved[name]))
+        _init_users += 1
+    _init_local.skip = True
+    try:
+        yield
+    finally:
+        _init_local.skip = False
+        with _init_lock:
+            _init_users -= 1
+            if _init_users == 0:
+                for name, function in _init_saved.items():
+                    setattr(torch.nn.init, name, function)
+                _init_saved.clear()
+
+
+def build_mapped(klass, args, kwargs, state: dict) -> 'torch.nn.Module':
+    """
+    Build a model and load a state returned by `read_flat`. The random initialization
+    of the weights is skipped, and the mapped tensors are used directly as the model
+    weights when they already have the right dtype, instead of being copied.
+    """
+    with _skip_init():
+        model = klass(*args, **kwargs)
+    current = model.state_dict()
+    assign = "assign" in inspect.signature(model.load_state_dict).parameters
+    if assign and all(key in state and state[key].dtype == value.dtype
+                      for key, value in current.items()):
+        model.load_state_dict(state, assign=True)
+    else:
+        model.load_state_dict(state)
+    return model
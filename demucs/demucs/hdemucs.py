@@ -18,6 +18,7 @@ from torch.nn import functional as F
 from .demucs import DConv, rescale_module
 from .states import capture_init
 from .spec import spectro, ispectro
+from .utils import activation_checkpoint, no_autocast
 
 
 def pad1d(x: torch.Tensor, paddings: tp.Tuple[int, int], mode: str = 'constant', value: float = 0.):
@@ -88,6 +89,7 @@ class HEncLayer(nn.Module):
             rewrite: add 1x1 conv at the end of the layer.
         """
         super().__init__()
+        self.checkpoint = False  # see `demucs.train.set_checkpointing`.
         norm_fn = lambda d: nn.Identity()  # noqa
         if norm:
             norm_fn = lambda d: nn.GroupNorm(norm_groups, d)  # noqa
@@ -125,6 +127,11 @@ class HEncLayer(nn.Module):
         `inject` is used to inject the result from the time branch into the frequency branch,
         when both have the same stride.
         """
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return activation_checkpoint(self._forward, x, inject)
+        return self._forward(x, inject)
+
+    def _forward(self, x, inject=None):
         if not self.freq and x.dim() == 4:
             B, C, Fr, T = x.shape
             x = x.view(B, -1, T)
@@ -261,6 +268,7 @@ class HDecLayer(nn.Module):
         Same as HEncLayer but for decoder. See `HEncLayer` for documentation.
         """
         super().__init__()
+        self.checkpoint = False  # see `demucs.train.set_checkpointing`.
         norm_fn = lambda d: nn.Identity()  # noqa
         if norm:
             norm_fn = lambda d: nn.GroupNorm(norm_groups, d)  # noqa
@@ -302,6 +310,11 @@ class HDecLayer(nn.Module):
             self.dconv = DConv(chin, **dconv_kw)
 
     def forward(self, x, skip, length):
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return activation_checkpoint(self._forward, x, skip, length)
+        return self._forward(x, skip, length)
+
+    def _forward(self, x, skip, length):
         if self.freq and x.dim() == 3:
             B, C, T = x.shape
             x = x.view(B, self.chin, -1, T)
@@ -780,7 +793,9 @@ class HDemucs(nn.Module):
         if x_is_mps:
             x = x.cpu()
 
-        zout = self._mask(z, x)
+        # Masking and the iSTFT always run in float32, even with mixed precision.
+        with no_autocast(x.device.type):
+            zout = self._mask(z, x.float())
         x = self._ispec(zout, length)
 
         # back to mps device
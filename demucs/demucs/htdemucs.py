@@ -21,6 +21,7 @@ from .transformer import CrossTransformerEncoder
 from .demucs import rescale_module
 from .states import capture_init
 from .spec import spectro, ispectro
+from .utils import no_autocast
 from .hdemucs import pad1d, ScaledEmbedding, HEncLayer, MultiWrap, HDecLayer
 
 
@@ -633,7 +634,9 @@ class HTDemucs(nn.Module):
         if x_is_mps:
             x = x.cpu()
 
-        zout = self._mask(z, x)
+        # Masking and the iSTFT always run in float32, even with mixed precision.
+        with no_autocast(x.device.type):
+            zout = self._mask(z, x.float())
         if self.use_train_segment:
             if self.training:
                 x = self._ispec(zout, length)
@@ -0,0 +1,284 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Incremental metadata store for wav based datasets.
+
+The metadata of each track (length, sample rate and normalization statistics)
+is stored in a small SQLite database, along with the size and modification time
+of the files it was computed from. Only new or modified tracks are scanned again
+when the dataset changes, and statistics are computed by streaming the mixture
+in chunks rather than decoding it in one go.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+from pathlib import Path
+import sqlite3
+
+import torchaudio as ta
+import tqdm
+
+from .audio import AudioReader
+
+logger = logging.getLogger(__name__)
+
+MIXTURE = "mixture"
+EXT = ".wav"
+CHUNK_SIZE = 2**20
+
+
+def _streaming_stats(file, chunk_size=CHUNK_SIZE):
+    # Mean and unbiased std of the mono signal, merging chunk statistics
+    # with the parallel variance algorithm from Chan et al.
+    count = 0
+    mean = 0.
+    m2 = 0.
+    with AudioReader(file) as reader:
+        while True:
+            chunk = reader.read(chunk_size)
+            if chunk.shape[-1] == 0:
+                break
+            chunk = chunk.double().mean(0)
+            n = chunk.shape[-1]
+            chunk_mean = chunk.mean().item()
+            chunk_m2 = ((chunk - chunk_mean)**2).sum().item()
+            delta = chunk_mean - mean
+            total = count + n
+            mean += delta * n / total
+            m2 += chunk_m2 + delta**2 * count * n / total
+            count = total
+    if count < 2:
+        return mean, 0.
+    return mean, (m2 / (count - 1))**0.5
+
+
+def _write_mixture(track, sources, ext=EXT, chunk_size=CHUNK_SIZE):
+    # Write the mixture as the sum of the sources, chunk by chunk.
+    file = track / f"{MIXTURE}{ext}"
+    try:
+        import soundfile
+    except ImportError:
+        audio = 0
+        for source in sources:
+            sub_audio, sr = ta.load(track / f"{source}{ext}")
+            audio += sub_audio
+        would_clip = audio.abs().max() >= 1
+        if would_clip:
+            assert ta.get_audio_backend() == 'soundfile', 'use dset.backend=soundfile'
+        ta.save(file, audio, sr, encoding='PCM_F')
+        return
+    readers = [AudioReader(track / f"{source}{ext}") for source in sources]
+    channels = soundfile.info(str(readers[0].path)).channels
+    tmp = track / f".{MIXTURE}.tmp{ext}"
+    try:
+        with soundfile.SoundFile(str(tmp), 'w', samplerate=readers[0].samplerate,
+                                 channels=channels, subtype='FLOAT') as out:
+            while True:
+                chunks = [reader.read(chunk_size) for reader in readers]
+                length = min(chunk.shape[-1] for chunk in chunks)
+                if length == 0:
+                    break
+                out.write(sum(chunk[:, :length] for chunk in chunks).t().numpy())
+        tmp.rename(file)
+    finally:
+        for reader in readers:
+            reader.close()
+        if tmp.exists():
+            tmp.unlink()
+
+
+def track_metadata(track, sources, normalize=True, ext=EXT):
+    """
+    Compute the metadata for a single track folder, i.e. its length, sample rate,
+    and the mean and std of the mixture if `normalize` is True.
+    The mixture is created from the sources if missing.
+    """
+    track = Path(track)
+    track_length = None
+    track_samplerate = None
+    mean = 0
+    std = 1
+    for source in sources + [MIXTURE]:
+        file = track / f"{source}{ext}"
+        if source == MIXTURE and not file.exists():
+            _write_mixture(track, sources, ext)
+
+        try:
+            info = ta.info(str(file))
+        except RuntimeError:
+            logger.debug("Could not read the info of %s", file)
+            raise
+        length = info.num_frames
+        if track_length is None:
+            track_length = length
+            track_samplerate = info.sample_rate
+        elif track_length != length:
+            raise ValueError(
+                f"Invalid length for file {file}: "
+                f"expecting {track_length} but got {length}.")
+        elif info.sample_rate != track_samplerate:
+            raise ValueError(
+                f"Invalid sample rate for file {file}: "
+                f"expecting {track_samplerate} but got {info.sample_rate}.")
+        if source == MIXTURE and normalize:
+            try:
+                mean, std = _streaming_stats(file)
+            except RuntimeError:
+                logger.debug("Could not compute the statistics of %s", file)
+                raise
+
+    return {"length": length, "mean": mean, "std": std, "samplerate": track_samplerate}
+
+
+def _signature(track, sources, ext=EXT):
+    # (name, size, mtime) of each file the metadata depends on. A missing mixture
+    # is not an error, as it will be created when computing the metadata.
+    signature = []
+    for source in sources + [MIXTURE]:
+        file = track / f"{source}{ext}"
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            if source == MIXTURE:
+                continue
+            raise
+        signature.append([file.name, stat.st_size, stat.st_mtime_ns])
+    return json.dumps(signature)
+
+
+def _scan_track(track, sources, normalize, ext):
+    meta = track_metadata(track, sources, normalize, ext)
+    return meta, _signature(track, sources, ext)
+
+
+def list_tracks(path):
+    """List the track folders in `path`, as `(name, folder)` pairs,
+    in the same order as `demucs.wav.build_metadata`."""
+    path = Path(path)
+    for root, folders, files in os.walk(path, followlinks=True):
+        root = Path(root)
+        if root.name.startswith('.') or folders or root == path:
+            continue
+        yield str(root.relative_to(path)), root
+
+
+class MetadataStore:
+    def __init__(self, path):
+        """
+        SQLite backed store for the output of `demucs.wav.build_metadata`.
+
+        Each row is keyed by the dataset root, the metadata config (sources, normalization
+        and extension) and the track name, and records the size and mtime of the files
+        used, so that :method:`update` only scans tracks that were added or modified.
+
+        The store should only be updated from a single process at a time.
+
+        Args:
+            path (Path or str): path to the database, created if needed.
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "root TEXT, config TEXT, name TEXT, signature TEXT, meta TEXT, "
+            "PRIMARY KEY (root, config, name))")
+        self._db.commit()
+
+    def _config(self, sources, normalize, ext):
+        return json.dumps([list(sources), bool(normalize), ext])
+
+    def get(self, root, sources, normalize=True, ext=EXT):
+        """Return the stored metadata for the dataset in `root`, without scanning it."""
+        rows = self._db.execute(
+            "SELECT name, meta FROM tracks WHERE root = ? AND config = ? ORDER BY name",
+            (str(Path(root).resolve()), self._config(sources, normalize, ext)))
+        return {name: json.loads(meta) for name, meta in rows}
+
+    def import_metadata(self, root, metadata, sources, normalize=True, ext=EXT):
+        """
+        Import `metadata` for the dataset in `root`, in the format of
+        `demucs.wav.build_metadata`, e.g. from the JSON files cached by previous versions,
+        so that the tracks are not scanned again. This is only done if the store has
+        no metadata yet for this dataset, and assumes that `metadata` is up to date
+        with the files in `root`. Returns the number of imported tracks.
+        """
+        key = (str(Path(root).resolve()), self._config(sources, normalize, ext))
+        stored, = self._db.execute(
+            "SELECT COUNT(*) FROM tracks WHERE root = ? AND config = ?", key).fetchone()
+        if stored:
+            return 0
+        tracks = dict(list_tracks(root))
+        rows = []
+        for name, meta in metadata.items():
+            if name not in tracks:
+                continue
+            try:
+                signature = _signature(tracks[name], sources, ext)
+            except FileNotFoundError:
+                continue
+            rows.append(key + (name, signature, json.dumps(meta)))
+        self._db.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)", rows)
+        self._db.commit()
+        return len(rows)
+
+    def update(self, root, sources, normalize=True, ext=EXT, workers=8):
+        """
+        Bring the metadata for the dataset in `root` up to date and return it,
+        in the same format as `demucs.wav.build_metadata`. Tracks that are new,
+        or for which any file changed size or mtime, are scanned in a process pool,
+        and tracks that no longer exist are removed from the store.
+        """
+        key = (str(Path(root).resolve()), self._config(sources, normalize, ext))
+        stored = {
+            name: (signature, meta) for name, signature, meta in self._db.execute(
+                "SELECT name, signature, meta FROM tracks WHERE root = ? AND config = ?", key)}
+
+        meta = {}
+        todo = []
+        for name, track in list_tracks(root):
+            signature = _signature(track, sources, ext)
+            if name in stored and stored[name][0] == signature:
+                meta[name] = json.loads(stored[name][1])
+            else:
+                meta[name] = None
+                todo.append((name, track))
+
+        if todo:
+            logger.info("Scanning %d new or modified tracks out of %d in %s",
+                        len(todo), len(meta), root)
+            with ProcessPoolExecutor(workers) as pool:
+                pendings = [(name, pool.submit(_scan_track, track, sources, normalize, ext))
+                            for name, track in todo]
+                for idx, (name, pending) in enumerate(tqdm.tqdm(pendings, ncols=120)):
+                    track_meta, signature = pending.result()
+                    meta[name] = track_meta
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?)",
+                        key + (name, signature, json.dumps(track_meta)))
+                    if idx % 64 == 63:
+                        # Commit regularly so that an interrupted scan is not lost.
+                        self._db.commit()
+            self._db.commit()
+
+        removed = [name for name in stored if name not in meta]
+        if removed:
+            logger.info("Removing %d deleted tracks from %s", len(removed), root)
+            self._db.executemany(
+                "DELETE FROM tracks WHERE root = ? AND config = ? AND name = ?",
+                [key + (name,) for name in removed])
+            self._db.commit()
+        return meta
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
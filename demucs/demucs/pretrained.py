@@ -4,17 +4,17 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 """Loading pretrained models.
+
+Only `get_model` imports torch and the model code, so that parsing the model flags
+and listing models stay fast, e.g. for `python -m demucs --list-models`.
 """
 
+import functools
 import logging
 from pathlib import Path
 import typing as tp
 
-from dora.log import fatal, bold
-
-from .hdemucs import HDemucs
 from .repo import RemoteRepo, LocalRepo, ModelOnlyRepo, BagOnlyRepo, AnyModelRepo, ModelLoadingError  # noqa
-from .states import _check_diffq
 
 logger = logging.getLogger(__name__)
 ROOT_URL = "https://dl.fbaipublicfiles.com/demucs/"
@@ -25,6 +25,7 @@ DEFAULT_MODEL = 'htdemucs'
 
 
 def demucs_unittest():
+    from .hdemucs import HDemucs
     model = HDemucs(channels=4, sources=SOURCES)
     return model
 
@@ -38,7 +39,9 @@ def add_model_flags(parser):
                         help="Folder containing all pre-trained models for use with -n.")
 
 
+@functools.lru_cache()
 def _parse_remote_files(remote_file_list) -> tp.Dict[str, str]:
+    # Cached, as it is called every time a model is loaded. Callers must not modify the result.
     root: str = ''
     models: tp.Dict[str, str] = {}
     for line in remote_file_list.read_text().split('\n'):
@@ -56,13 +59,7 @@ def _parse_remote_files(remote_file_list) -> tp.Dict[str, str]:
     return models
 
 
-def get_model(name: str,
-              repo: tp.Optional[Path] = None):
-    """`name` must be a bag of models name or a pretrained signature
-    from the remote AWS model repo or the specified local repo if `repo` is not None.
-    """
-    if name == 'demucs_unittest':
-        return demucs_unittest()
+def _get_repos(repo: tp.Optional[Path] = None) -> tp.Tuple[ModelOnlyRepo, BagOnlyRepo]:
     model_repo: ModelOnlyRepo
     if repo is None:
         models = _parse_remote_files(REMOTE_ROOT / 'files.txt')
@@ -70,10 +67,30 @@ def get_model(name: str,
         bag_repo = BagOnlyRepo(REMOTE_ROOT, model_repo)
     else:
         if not repo.is_dir():
+            from dora.log import fatal
             fatal(f"{repo} must exist and be a directory.")
         model_repo = LocalRepo(repo)
         bag_repo = BagOnlyRepo(repo, model_repo)
-    any_repo = AnyModelRepo(model_repo, bag_repo)
+    return model_repo, bag_repo
+
+
+def list_models(repo: tp.Optional[Path] = None) -> tp.Dict[str, tp.Dict[str, tp.Union[str, Path]]]:
+    """Return the single models and bags of models from the remote AWS model repo,
+    or the specified local repo if `repo` is not None, without loading any of them.
+    """
+    model_repo, bag_repo = _get_repos(repo)
+    return {"single": model_repo.list_model(), "bag": bag_repo.list_model()}
+
+
+def get_model(name: str,
+              repo: tp.Optional[Path] = None):
+    """`name` must be a bag of models name or a pretrained signature
+    from the remote AWS model repo or the specified local repo if `repo` is not None.
+    """
+    from .states import _check_diffq
+    if name == 'demucs_unittest':
+        return demucs_unittest()
+    any_repo = AnyModelRepo(*_get_repos(repo))
     try:
         model = any_repo.get_model(name)
     except ImportError as exc:
@@ -89,6 +106,7 @@ def get_model_from_args(args):
     """
     Load local model package or pre-trained model.
     """
+    from dora.log import bold
     if args.name is None:
         args.name = DEFAULT_MODEL
         print(bold("Important: the default model was recently changed to `htdemucs`"),
@@ -0,0 +1,181 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Process wide registry of loaded pretrained models.
+
+Models are shared by everything that acquires them with the same name, repo
+and device, e.g. many `demucs.api.Separator` with different `shifts` or `overlap`,
+and are only loaded once. Each model is moved to its device once after loading,
+so that models in use are never moved from one device to another. Once a model
+is no longer used, it is kept in memory so that it can be acquired again without
+reloading it, as long as the total size of the unused models on its device stays
+below a budget, beyond which the least recently used ones are dropped.
+
+Shared models are only ever used for inference, and must not be modified or moved.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import threading
+import typing as tp
+
+import torch
+
+from .apply import BagOfModels, Model
+from .pretrained import get_model
+
+logger = logging.getLogger(__name__)
+
+AnyModel = tp.Union[Model, BagOfModels]
+Key = tp.Tuple[str, tp.Optional[str], str]
+
+# Default budget for models that are loaded but not used anymore, in bytes per device.
+DEFAULT_BUDGET = 2 * 2**30
+
+
+def model_size(model: AnyModel) -> int:
+    """Size in bytes of the parameters and buffers of `model`."""
+    size = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        size += tensor.numel() * tensor.element_size()
+    return size
+
+
+@dataclass
+class _Entry:
+    model: AnyModel
+    size: int
+    refs: int = 0
+
+
+class ModelRegistry:
+    def __init__(self, budget: tp.Optional[int] = DEFAULT_BUDGET):
+        """
+        Registry of loaded models, with reference counting.
+
+        Args:
+            budget (int or None): maximum total size in bytes of the models that are
+                kept loaded while not being used, for each device. Models in use are never
+                dropped and do not count towards the budget. If None, no model is ever dropped.
+        """
+        self.budget = budget
+        self._entries: tp.Dict[Key, _Entry] = {}
+        # Unused models, from the least to the most recently released.
+        self._idle: tp.OrderedDict[Key, None] = OrderedDict()
+        self._lock = threading.Lock()
+        # One lock per model being loaded, so that concurrent acquires of the same
+        # model only load it once, without blocking the acquires of other models.
+        self._loading: tp.Dict[Key, threading.Lock] = {}
+
+    @staticmethod
+    def _device(device: tp.Union[str, torch.device]) -> str:
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+        return str(device)
+
+    def _key(self, name: str, repo: tp.Optional[Path], device: tp.Union[str, torch.device]) -> Key:
+        return (name, None if repo is None else str(Path(repo).resolve()), self._device(device))
+
+    def acquire(self, name: str, repo: tp.Optional[Path] = None,
+                device: tp.Union[str, torch.device] = 'cpu') -> AnyModel:
+        """
+        Return the model `name` from `repo` on `device`, as `demucs.pretrained.get_model`
+        would, loading it only if it is not already in the registry for this device.
+        Each call must be matched by a call to :method:`release` with the same arguments
+        once the model is no longer used.
+        """
+        key = self._key(name, repo, device)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self._idle.pop(key, None)
+                    return entry.model
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = threading.Lock()
+                    loading.acquire()
+                    self._loading[key] = loading
+                    break
+            # Another thread is loading this model, wait for it and try again.
+            with loading:
+                pass
+
+        try:
+            model = get_model(name=name, repo=repo)
+            model.to(key[2])
+            entry = _Entry(model, model_size(model), refs=1)
+            logger.debug("Loaded model %s on %s (%.1f MB)", name, key[2], entry.size / 2**20)
+            with self._lock:
+                self._entries[key] = entry
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.release()
+        return model
+
+    def release(self, name: str, repo: tp.Optional[Path] = None,
+                device: tp.Union[str, torch.device] = 'cpu'):
+        """Release a model obtained with :method:`acquire`."""
+        key = self._key(name, repo, device)
+        with self._lock:
+            entry = self._entries[key]
+            assert entry.refs > 0, "Model released more times than acquired."
+            entry.refs -= 1
+            if entry.refs == 0:
+                self._idle[key] = None
+                self._evict()
+
+    def preload(self, names: tp.Iterable[str], repo: tp.Optional[Path] = None,
+                device: tp.Union[str, torch.device] = 'cpu'):
+        """Load the given models on `device` ahead of time, e.g. when starting a service,
+        so that later calls to :method:`acquire` are immediate. Preloaded models
+        are subject to the budget like any unused model."""
+        for name in names:
+            self.acquire(name, repo, device)
+            self.release(name, repo, device)
+
+    def idle_size(self, device: tp.Optional[tp.Union[str, torch.device]] = None) -> int:
+        """Total size in bytes of the models loaded but not in use,
+        on `device`, or on all the devices if None."""
+        with self._lock:
+            return sum(self._entries[key].size for key in self._idle
+                       if device is None or key[2] == self._device(device))
+
+    def _evict(self):
+        if self.budget is None:
+            return
+        idle = {}
+        for key in self._idle:
+            idle[key[2]] = idle.get(key[2], 0) + self._entries[key].size
+        for key in list(self._idle):
+            device = key[2]
+            if idle[device] > self.budget:
+                del self._idle[key]
+                entry = self._entries.pop(key)
+                idle[device] -= entry.size
+                logger.debug("Dropped model %s from %s (%.1f MB)",
+                             key[0], device, entry.size / 2**20)
+
+    def set_budget(self, budget: tp.Optional[int]):
+        """Change the budget, immediately dropping unused models if needed."""
+        with self._lock:
+            self.budget = budget
+            self._evict()
+
+    def clear(self):
+        """Drop all the unused models."""
+        with self._lock:
+            budget = self.budget
+            self.budget = 0
+            self._evict()
+            self.budget = budget
+
+
+registry = ModelRegistry()
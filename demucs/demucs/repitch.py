@@ -5,22 +5,38 @@
 # LICENSE file in the root directory of this source tree.
 """Utility for on the fly pitch/tempo change for data augmentation."""
 
+import bisect
+import hashlib
+import json
+from pathlib import Path
 import random
 import subprocess as sp
 import tempfile
 
+import numpy as np
 import torch
 import torchaudio as ta
+from torch.nn import functional as F
+from torch.utils.data import ConcatDataset, IterableDataset, Subset
+import tqdm
 
 from .audio import save_audio
+from .wav import MemmapWavset, Wavset, write_packed
+
+BANK_INDEX = "bank.json"
 
 
 class RepitchedWrapper:
     """
     Wrap a dataset to apply online change of pitch / tempo.
+
+    If `bank` is provided, it must be a folder created with `build_bank`
+    (see `tools/repitch_bank.py`), and pre-rendered variants are read from it instead
+    of calling `soundstretch`. The wrapped dataset must then be a map style dataset
+    made of `Wavset` or `MemmapWavset`, possibly within `ConcatDataset` or `Subset`.
     """
     def __init__(self, dataset, proba=0.2, max_pitch=2, max_tempo=12,
-                 tempo_std=5, vocals=[3], same=True):
+                 tempo_std=5, vocals=[3], same=True, bank=None):
         self.dataset = dataset
         self.proba = proba
         self.max_pitch = max_pitch
@@ -28,12 +44,30 @@ class RepitchedWrapper:
         self.tempo_std = tempo_std
         self.same = same
         self.vocals = vocals
+        self.bank = None
+        if bank is not None:
+            if isinstance(dataset, IterableDataset):
+                raise ValueError("A repitch bank requires a map style dataset.")
+            self.bank = RepitchBank(bank)
+            for leaf in _leaves(dataset):
+                self.bank.check(leaf)
 
     def __len__(self):
         return len(self.dataset)
 
     def __getitem__(self, index):
+        if self.bank is None:
+            return self._augment(self.dataset[index])
+        if random.random() < self.proba:
+            leaf, index = _locate(self.dataset, index)
+            track, offset, length = leaf.get_segment(index)
+            out_length = int((1 - 0.01 * self.max_tempo) * length)
+            return self.bank.sample(leaf.names[track], leaf.sources, offset, out_length,
+                                    same=self.same)
         streams = self.dataset[index]
+        return streams[..., :int((1 - 0.01 * self.max_tempo) * streams.shape[-1])]
+
+    def _augment(self, streams):
         in_length = streams.shape[-1]
         out_length = int((1 - 0.01 * self.max_tempo) * in_length)
 
@@ -56,6 +90,188 @@ class RepitchedWrapper:
         return streams
 
 
+def _locate(dataset, index):
+    # Find the leaf dataset, and the index within it, for the given index.
+    while True:
+        if isinstance(dataset, ConcatDataset):
+            idx = bisect.bisect_right(dataset.cumulative_sizes, index)
+            if idx > 0:
+                index -= dataset.cumulative_sizes[idx - 1]
+            dataset = dataset.datasets[idx]
+        elif isinstance(dataset, Subset):
+            index = dataset.indices[index]
+            dataset = dataset.dataset
+        else:
+            return dataset, index
+
+
+def _leaves(dataset):
+    # Unique leaf datasets, i.e. `Wavset` or `MemmapWavset`.
+    if isinstance(dataset, ConcatDataset):
+        seen = set()
+        for sub in dataset.datasets:
+            for leaf in _leaves(sub):
+                if id(leaf) not in seen:
+                    seen.add(id(leaf))
+                    yield leaf
+    elif isinstance(dataset, Subset):
+        yield from _leaves(dataset.dataset)
+    elif isinstance(dataset, (Wavset, MemmapWavset)):
+        yield dataset
+    else:
+        raise ValueError(f"Unsupported dataset {type(dataset).__name__} for a repitch bank.")
+
+
+class RepitchBank:
+    """
+    Pre-rendered pitch / tempo variants of full tracks, created by `build_bank`.
+    Each variant is stored in the same layout as `demucs.wav.pack_wavset`, i.e. one
+    memory mappable `[S, C, T]` array, along with the pitch and tempo change used.
+    """
+    def __init__(self, root):
+        self.root = Path(root)
+        index = json.load(open(self.root / BANK_INDEX))
+        self.sources = index['sources']
+        self.samplerate = index['samplerate']
+        self.channels = index['channels']
+        self.normalize = index['normalize']
+        self.tracks = index['tracks']
+        self._arrays = {}
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_arrays'] = {}
+        return state
+
+    def check(self, dset):
+        """Check that the bank can replace examples from the given dataset."""
+        for key in ['samplerate', 'channels', 'normalize']:
+            if getattr(self, key) != getattr(dset, key):
+                raise ValueError(f"Repitch bank {self.root} has {key}={getattr(self, key)} "
+                                 f"but dataset has {getattr(dset, key)}.")
+        missing = set(dset.sources) - set(self.sources)
+        if missing:
+            raise ValueError(f"Sources {missing} are not in the repitch bank {self.root}.")
+        missing = set(dset.names) - set(self.tracks)
+        if missing:
+            raise ValueError(f"{len(missing)} tracks are not in the repitch bank {self.root}, "
+                             "e.g. " + next(iter(missing)))
+
+    def _array(self, entry):
+        file = entry['file']
+        if file not in self._arrays:
+            shape = (len(self.sources), self.channels, entry['length'])
+            self._arrays[file] = np.memmap(
+                self.root / file, dtype=entry['dtype'], mode='r', shape=shape)
+        return self._arrays[file]
+
+    def sample(self, name, sources, offset, length, same=True):
+        """
+        Return a random variant of the given track, of shape `[len(sources), C, length]`,
+        starting at the position matching `offset` in the original track.
+        If `same` is False, a different variant is picked for each source.
+        """
+        variants = self.tracks[name]
+        variant = random.choice(variants)
+        streams = []
+        for idx, source in enumerate(sources):
+            if idx > 0 and not same:
+                variant = random.choice(variants)
+            start = int(offset / (1 + 0.01 * variant['tempo']))
+            chunk = self._array(variant)[self.sources.index(source), :, start:start + length]
+            stream = torch.from_numpy(np.array(chunk, dtype=np.float32))
+            if variant['scale'] != 1:
+                stream *= variant['scale']
+            streams.append(F.pad(stream, (0, length - stream.shape[-1])))
+        return torch.stack(streams)
+
+
+def _render_variant(dset, index, file, pitch, tempo, vocals, dtype):
+    streams = dset[index]
+    outs = [repitch(stream, pitch, tempo, voice=idx in vocals, samplerate=dset.samplerate)
+            for idx, stream in enumerate(streams)]
+    length = min(out.shape[-1] for out in outs)
+    example = torch.stack([out[:, :length] for out in outs]).numpy()
+    return write_packed(example, file, dtype)
+
+
+def build_bank(wrapper, root, variants=4, dtype='float16', workers=8, seed=42):
+    """
+    Render `variants` pitch / tempo changes of every track used by the given
+    `RepitchedWrapper`, with the same distribution of changes as it would use online,
+    and store them into `root`, to be used with `RepitchedWrapper(..., bank=root)`.
+    The pitch and tempo change is the same for all the sources of a variant.
+    Tracks that already have enough variants in `root` are skipped.
+
+    Args:
+        wrapper (RepitchedWrapper): provides the dataset and the augmentation parameters.
+        root (Path or str): output folder.
+        variants (int): number of variants per track.
+        dtype (str): storage type, see `demucs.wav.pack_wavset`.
+        workers (int): number of processes calling `soundstretch`.
+        seed (int): seed for the pitch and tempo changes of each variant.
+    """
+    root = Path(root)
+    root.mkdir(exist_ok=True, parents=True)
+    index_file = root / BANK_INDEX
+    index = None
+    if index_file.exists():
+        index = json.load(open(index_file))
+    pendings = []
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        for leaf in _leaves(wrapper.dataset):
+            if isinstance(leaf, Wavset):
+                full = Wavset(leaf.root, leaf.metadata, leaf.sources, segment=None,
+                              normalize=leaf.normalize, samplerate=leaf.samplerate,
+                              channels=leaf.channels, ext=leaf.ext, open_files=leaf.open_files)
+            else:
+                full = MemmapWavset(leaf.root, leaf.sources, leaf.names, normalize=leaf.normalize,
+                                    samplerate=leaf.samplerate, channels=leaf.channels)
+            header = {"sources": list(full.sources), "samplerate": full.samplerate,
+                      "channels": full.channels, "normalize": full.normalize}
+            if index is None:
+                index = dict(header, tracks={})
+            for key, value in header.items():
+                if index[key] != value:
+                    raise ValueError(f"Cannot merge into {root}, mismatch for {key}: "
+                                     f"expected {index[key]} but got {value}.")
+            vocals = [full.sources.index(leaf.sources[idx]) for idx in wrapper.vocals
+                      if idx < len(leaf.sources)]
+            for track, name in enumerate(full.names):
+                done = len(index['tracks'].get(name, []))
+                for variant in range(done, variants):
+                    rng = random.Random(f"{seed}-{name}-{variant}")
+                    pitch = rng.randint(-wrapper.max_pitch, wrapper.max_pitch)
+                    tempo = rng.gauss(0, wrapper.tempo_std)
+                    tempo = min(max(-wrapper.max_tempo, tempo), wrapper.max_tempo)
+                    key = hashlib.sha1(name.encode()).hexdigest()[:16]
+                    file = root / f"{key}-{variant}.bin"
+                    pending = pool.submit(_render_variant, full, track, file,
+                                          pitch, tempo, vocals, dtype)
+                    pendings.append((name, pitch, tempo, pending))
+        for name, pitch, tempo, pending in tqdm.tqdm(pendings, ncols=120):
+            entry = pending.result()
+            entry.update(dtype=dtype, pitch=pitch, tempo=tempo)
+            index['tracks'].setdefault(name, []).append(entry)
+    assert index is not None
+    tmp = index_file.with_suffix(".tmp")
+    json.dump(index, open(tmp, "w"))
+    tmp.rename(index_file)
+
+
+class IterableRepitchedWrapper(RepitchedWrapper, IterableDataset):
+    """
+    Same as `RepitchedWrapper`, for iterable datasets such as `demucs.shards.ShardedDataset`.
+    """
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch)
+
+    def __iter__(self):
+        for streams in self.dataset:
+            yield self._augment(streams)
+
+
 def repitch(wav, pitch, tempo, voice=False, quick=False, samplerate=44100):
     """
     tempo is a relative delta in percentage, so tempo=10 means tempo at 110%!
@@ -6,27 +6,52 @@
 """Represents a model repository, including pre-trained models and bags of models.
 A repo can either be the main remote repository stored in AWS, or a local repository
 with your own models.
+
+Listing and scanning repos does not import torch or the model code,
+which are only imported once a model is actually loaded.
 """
 
 from hashlib import sha256
+import json
+import os
 from pathlib import Path
 import typing as tp
 
-import torch
 import yaml
 
-from .apply import BagOfModels, Model
-from .states import load_model
-
+from .flat import FLAT_SUFFIX
 
-AnyModel = tp.Union[Model, BagOfModels]
+if tp.TYPE_CHECKING:
+    from .apply import BagOfModels, Model
+    AnyModel = tp.Union[Model, BagOfModels]
 
 
 class ModelLoadingError(RuntimeError):
     pass
 
 
-def check_checksum(path: Path, checksum: str):
+# sha256 of the files already checked, keyed by (path, size, mtime), and saved across runs.
+_checksums: tp.Optional[tp.Dict[str, str]] = None
+
+
+def _checksums_file() -> Path:
+    import torch
+    return Path(torch.hub.get_dir()) / 'demucs_checksums.json'
+
+
+def _file_sha256(path: Path) -> str:
+    global _checksums
+    stat = path.stat()
+    key = json.dumps([str(path.resolve()), stat.st_size, stat.st_mtime_ns])
+    if _checksums is None:
+        try:
+            _checksums = json.loads(_checksums_file().read_text())
+        except (OSError, ValueError):
+            _checksums = {}
+    assert _checksums is not None
+    if key in _checksums:
+        return _checksums[key]
+
     sha = sha256()
     with open(path, 'rb') as file:
         while True:
@@ -34,7 +59,20 @@ def check_checksum(path: Path, checksum: str):
             if not buf:
                 break
             sha.update(buf)
-    actual_checksum = sha.hexdigest()[:len(checksum)]
+    _checksums[key] = sha.hexdigest()
+    try:
+        cache = _checksums_file()
+        cache.parent.mkdir(exist_ok=True, parents=True)
+        tmp = cache.parent / (cache.name + f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps(_checksums))
+        tmp.rename(cache)
+    except OSError:
+        pass
+    return _checksums[key]
+
+
+def check_checksum(path: Path, checksum: str):
+    actual_checksum = _file_sha256(path)[:len(checksum)]
     if actual_checksum != checksum:
         raise ModelLoadingError(f'Invalid checksum for file {path}, '
                                 f'expected {checksum} but got {actual_checksum}')
@@ -46,7 +84,7 @@ class ModelOnlyRepo:
     def has_model(self, sig: str) -> bool:
         raise NotImplementedError()
 
-    def get_model(self, sig: str) -> Model:
+    def get_model(self, sig: str) -> 'Model':
         raise NotImplementedError()
 
     def list_model(self) -> tp.Dict[str, tp.Union[str, Path]]:
@@ -55,12 +93,14 @@ class ModelOnlyRepo:
 
 class RemoteRepo(ModelOnlyRepo):
     def __init__(self, models: tp.Dict[str, str]):
-        self._models = models
+        self._models = dict(models)
 
     def has_model(self, sig: str) -> bool:
         return sig in self._models
 
-    def get_model(self, sig: str) -> Model:
+    def get_model(self, sig: str) -> 'Model':
+        import torch
+        from .states import load_model
         try:
             url = self._models[sig]
         except KeyError:
@@ -81,23 +121,27 @@ class LocalRepo(ModelOnlyRepo):
     def scan(self):
         self._models = {}
         self._checksums = {}
-        for file in self.root.iterdir():
-            if file.suffix == '.th':
+        # Models in the flat format (see `demucs.flat`) are preferred, as they load faster.
+        for file in sorted(self.root.iterdir(), key=lambda file: file.suffix == FLAT_SUFFIX):
+            if file.suffix in ['.th', FLAT_SUFFIX]:
                 if '-' in file.stem:
                     xp_sig, checksum = file.stem.split('-')
-                    self._checksums[xp_sig] = checksum
                 else:
-                    xp_sig = file.stem
-                if xp_sig in self._models:
+                    xp_sig, checksum = file.stem, None
+                if xp_sig in self._models and self._models[xp_sig].suffix == file.suffix:
                     raise ModelLoadingError(
                         f'Duplicate pre-trained model exist for signature {xp_sig}. '
                         'Please delete all but one.')
+                self._checksums.pop(xp_sig, None)
+                if checksum is not None:
+                    self._checksums[xp_sig] = checksum
                 self._models[xp_sig] = file
 
     def has_model(self, sig: str) -> bool:
         return sig in self._models
 
-    def get_model(self, sig: str) -> Model:
+    def get_model(self, sig: str) -> 'Model':
+        from .states import load_model
         try:
             file = self._models[sig]
         except KeyError:
@@ -128,7 +172,8 @@ class BagOnlyRepo:
     def has_model(self, name: str) -> bool:
         return name in self._bags
 
-    def get_model(self, name: str) -> BagOfModels:
+    def get_model(self, name: str) -> 'BagOfModels':
+        from .apply import BagOfModels
         try:
             yaml_file = self._bags[name]
         except KeyError:
@@ -153,7 +198,7 @@ class AnyModelRepo:
     def has_model(self, name_or_sig: str) -> bool:
         return self.model_repo.has_model(name_or_sig) or self.bag_repo.has_model(name_or_sig)
 
-    def get_model(self, name_or_sig: str) -> AnyModel:
+    def get_model(self, name_or_sig: str) -> 'AnyModel':
         if self.model_repo.has_model(name_or_sig):
             return self.model_repo.get_model(name_or_sig)
         else:
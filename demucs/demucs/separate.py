@@ -3,19 +3,17 @@
 #
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
+"""Command line interface for separating tracks.
+
+Torch and the model code are only imported once tracks are actually separated,
+so that `--help` and `--list-models` return immediately.
+"""
 
 import argparse
 import sys
 from pathlib import Path
 
-from dora.log import fatal
-import torch as th
-
-from .api import Separator, save_audio, list_models
-
-from .apply import BagOfModels
-from .htdemucs import HTDemucs
-from .pretrained import add_model_flags, ModelLoadingError
+from .pretrained import add_model_flags, list_models, ModelLoadingError
 
 
 def get_parser():
@@ -41,7 +39,7 @@ def get_parser():
                         'Default is "{track}/{stem}.{ext}".')
     parser.add_argument("-d",
                         "--device",
-                        default="cuda" if th.cuda.is_available() else "cpu",
+                        default=None,
                         help="Device to use, default is cuda if available else cpu")
     parser.add_argument("--shifts",
                         default=1,
@@ -75,14 +73,22 @@ def get_parser():
                              help="Save wav output as 24 bits wav.")
     depth_group.add_argument("--float32", action="store_true",
                              help="Save wav output as float32 (2x bigger).")
-    parser.add_argument("--clip-mode", default="rescale", choices=["rescale", "clamp", "none"],
+    parser.add_argument("--clip-mode", default="rescale",
+                        choices=["rescale", "clamp", "limiter", "none"],
                         help="Strategy for avoiding clipping: rescaling entire signal "
-                             "if necessary  (rescale) or hard clipping (clamp).")
+                             "if necessary  (rescale), hard clipping (clamp) or only "
+                             "attenuating the loudest parts with a peak limiter (limiter).")
     format_group = parser.add_mutually_exclusive_group()
     format_group.add_argument("--flac", action="store_true",
                               help="Convert the output wavs to flac.")
     format_group.add_argument("--mp3", action="store_true",
                               help="Convert the output wavs to mp3.")
+    parser.add_argument("--container", choices=["mka", "mp4"],
+                        help="Save all the stems of each track as the streams of a single "
+                             "{track}.mka or {track}.mp4 file, named after the stems, instead of "
+                             "one file per stem. The codec is flac or mp3 with --flac or --mp3, "
+                             "otherwise pcm for mka and alac for mp4. "
+                             "Can be read with demucs.audio.StemsFile.")
     parser.add_argument("--mp3-bitrate",
                         default=320,
                         type=int,
@@ -95,6 +101,10 @@ def get_parser():
                         type=int,
                         help="Number of jobs. This can increase memory usage but will "
                              "be much faster when multiple cores are available.")
+    parser.add_argument("--encode-jobs", type=int,
+                        help="Number of processes encoding and saving the stems, while the "
+                             "next track is being separated. Default is one per stem, "
+                             "0 to save them sequentially.")
 
     return parser
 
@@ -113,6 +123,17 @@ def main(opts=None):
         print("error: the following arguments are required: tracks", file=sys.stderr)
         sys.exit(1)
 
+    from dora.log import fatal
+    import torch as th
+
+    from .api import Separator
+    from .audio import AudioWriter
+    from .apply import BagOfModels
+    from .htdemucs import HTDemucs
+
+    if args.device is None:
+        args.device = "cuda" if th.cuda.is_available() else "cpu"
+
     try:
         separator = Separator(model=args.name,
                               repo=args.repo,
@@ -151,6 +172,10 @@ def main(opts=None):
     out = args.out / args.name
     out.mkdir(parents=True, exist_ok=True)
     print(f"Separated tracks will be stored in {out.resolve()}")
+    encode_jobs = args.encode_jobs
+    if encode_jobs is None:
+        encode_jobs = len(separator.model.sources)
+    writer = AudioWriter(encode_jobs)
     for track in args.tracks:
         if not track.exists():
             print(f"File {track} does not exist. If the path contains spaces, "
@@ -159,7 +184,10 @@ def main(opts=None):
             continue
         print(f"Separating track {track}")
 
-        origin, res = separator.separate_audio_file(track)
+        # Peaks of the stems recorded during the separation, so that clipping can be
+        # prevented in a single pass when writing them.
+        peaks = {}
+        origin, res = separator.separate_audio_file(track, peaks)
 
         if args.mp3:
             ext = "mp3"
@@ -170,52 +198,46 @@ def main(opts=None):
         kwargs = {
             "samplerate": separator.samplerate,
             "bitrate": args.mp3_bitrate,
-            "preset": args.mp3_preset,
             "clip": args.clip_mode,
             "as_float": args.float32,
             "bits_per_sample": 24 if args.int24 else 16,
         }
         if args.stem is None:
-            for name, source in res.items():
-                stem = out / args.filename.format(
-                    track=track.name.rsplit(".", 1)[0],
-                    trackext=track.name.rsplit(".", 1)[-1],
-                    stem=name,
-                    ext=ext,
-                )
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(source, str(stem), **kwargs)
+            stems = res
         else:
-            stem = out / args.filename.format(
-                track=track.name.rsplit(".", 1)[0],
-                trackext=track.name.rsplit(".", 1)[-1],
-                stem="minus_" + args.stem,
-                ext=ext,
-            )
+            stems = {}
             if args.other_method == "minus":
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(origin - res[args.stem], str(stem), **kwargs)
+                stems["minus_" + args.stem] = origin - res[args.stem]
+            stems[args.stem] = res.pop(args.stem)
+            # Warning : after poping the stem, selected stem is no longer in the dict 'res'
+            if args.other_method == "add":
+                other_stem = th.zeros_like(next(iter(res.values())))
+                for i in res.values():
+                    other_stem += i
+                stems["no_" + args.stem] = other_stem
+
+        if args.container is not None:
+            if ext == "wav":
+                codec = "pcm" if args.container == "mka" else "alac"
+            else:
+                codec = ext
+            path = out / (track.name.rsplit(".", 1)[0] + "." + args.container)
+            writer.save_stems(stems, path, codec=codec, peaks=peaks, **kwargs)
+            continue
+        files = []
+        file_peaks = []
+        for name, source in stems.items():
             stem = out / args.filename.format(
                 track=track.name.rsplit(".", 1)[0],
                 trackext=track.name.rsplit(".", 1)[-1],
-                stem=args.stem,
+                stem=name,
                 ext=ext,
             )
             stem.parent.mkdir(parents=True, exist_ok=True)
-            save_audio(res.pop(args.stem), str(stem), **kwargs)
-            # Warning : after poping the stem, selected stem is no longer in the dict 'res'
-            if args.other_method == "add":
-                other_stem = th.zeros_like(next(iter(res.values())))
-                for i in res.values():
-                    other_stem += i
-                stem = out / args.filename.format(
-                    track=track.name.rsplit(".", 1)[0],
-                    trackext=track.name.rsplit(".", 1)[-1],
-                    stem="no_" + args.stem,
-                    ext=ext,
-                )
-                stem.parent.mkdir(parents=True, exist_ok=True)
-                save_audio(other_stem, str(stem), **kwargs)
+            files.append((source, stem))
+            file_peaks.append(peaks.get(name))
+        writer.save(files, file_peaks, preset=args.mp3_preset, **kwargs)
+    writer.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Sharded dataset format, for fast sequential reads on network file systems.
+
+Training examples of fixed shape `[S, C, T]` are written one after the other
+in a few large shard files, along with a small JSON index. `ShardedDataset`
+then streams whole shards sequentially, with a shuffle buffer for randomness,
+instead of performing many small random reads on thousands of audio files.
+"""
+
+import json
+import logging
+from pathlib import Path
+import random
+import typing as tp
+
+import numpy as np
+import torch as th
+from torch.utils.data import DataLoader, IterableDataset
+import tqdm
+
+from . import distrib
+
+logger = logging.getLogger(__name__)
+
+SHARDS_INDEX = "index.json"
+SHARDS_DTYPES = ["float16", "float32"]
+
+
+def write_shards(dataset, root, shard_size=512, dtype='float16', workers=8, seed=42,
+                 config: tp.Optional[dict] = None):
+    """
+    Write all the examples from `dataset` into shards in the folder `root`.
+
+    Args:
+        dataset: any map style dataset returning tensors of a fixed shape `[S, C, T]`,
+            e.g. a `Wavset` with a segment, or a `ConcatDataset` of those.
+        root (Path or str): output folder.
+        shard_size (float): target size of each shard in MB.
+        dtype (str): one of `float16` or `float32`.
+        workers (int): number of loader workers used for decoding the examples.
+        seed (int): examples are written in a random order based on that seed,
+            so that each shard covers many tracks.
+        config (dict or None): extra information stored in the index, checked when loading.
+    """
+    if dtype not in SHARDS_DTYPES:
+        raise ValueError(f"Invalid dtype {dtype}, must be one of {SHARDS_DTYPES}")
+    root = Path(root)
+    root.mkdir(exist_ok=True, parents=True)
+    generator = th.Generator().manual_seed(seed)
+    loader = DataLoader(dataset, batch_size=None, shuffle=True, num_workers=workers,
+                        generator=generator)
+    shards: tp.List[dict] = []
+    shape = None
+    per_shard = None
+    out = None
+    try:
+        for example in tqdm.tqdm(loader, ncols=120):
+            example = example.numpy().astype(dtype)
+            if shape is None:
+                shape = list(example.shape)
+                per_shard = max(1, int(shard_size * 2**20 // example.nbytes))
+            elif list(example.shape) != shape:
+                raise ValueError(f"All examples must have shape {shape}, got {example.shape}.")
+            if out is None or shards[-1]['examples'] == per_shard:
+                if out is not None:
+                    out.close()
+                name = f"shard-{len(shards):05d}.bin"
+                out = open(root / name, "wb")
+                shards.append({"file": name, "examples": 0})
+            example.tofile(out)
+            shards[-1]['examples'] += 1
+    finally:
+        if out is not None:
+            out.close()
+    index = {"shape": shape, "dtype": dtype, "shards": shards, "config": config or {}}
+    tmp = root / (SHARDS_INDEX + ".tmp")
+    json.dump(index, open(tmp, "w"))
+    tmp.rename(root / SHARDS_INDEX)
+    logger.info("Wrote %d examples in %d shards to %s",
+                sum(shard['examples'] for shard in shards), len(shards), root)
+
+
+class ShardedDataset(IterableDataset):
+    def __init__(self, root, shuffle_buffer=64, seed=42, config: tp.Optional[dict] = None):
+        """
+        Iterable dataset streaming examples from shards written by `write_shards`.
+
+        Shards are split between distributed workers (see `demucs.distrib`) and then
+        between DataLoader workers, and each of them is read sequentially.
+        Each distributed worker yields exactly `len(self)` examples per epoch, reusing
+        some of its shards if needed, so that all workers run the same number of batches.
+
+        Args:
+            root (Path or str): folder created by `write_shards`.
+            shuffle_buffer (int): number of examples kept in memory for shuffling.
+                The shard order is also shuffled for each epoch.
+            seed (int): base seed, combined with the epoch set with `set_epoch`.
+            config (dict or None): if provided, checked against the config stored
+                in the index, to detect stale shards.
+        """
+        self.root = Path(root)
+        index = json.load(open(self.root / SHARDS_INDEX))
+        if config is not None:
+            for key, value in config.items():
+                if index['config'].get(key) != value:
+                    raise ValueError(f"Shards in {root} have {key}={index['config'].get(key)} "
+                                     f"but {value} was requested, please rewrite them.")
+        self.shards = index['shards']
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.total = sum(shard['examples'] for shard in self.shards)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.total // distrib.world_size
+
+    def _assignment(self):
+        """Return the shards to read, and the number of examples to yield,
+        for the current distributed and DataLoader worker."""
+        info = th.utils.data.get_worker_info()
+        workers, worker_id = (1, 0) if info is None else (info.num_workers, info.id)
+        readers = distrib.world_size * workers
+        reader = distrib.rank * workers + worker_id
+        order = list(range(len(self.shards)))
+        random.Random(self.seed + self.epoch).shuffle(order)
+        mine = order[reader::readers]
+        if not mine:
+            mine = [order[reader % len(order)]]
+        quota = len(self) // workers + int(worker_id < len(self) % workers)
+        return [self.shards[idx] for idx in mine], quota, reader
+
+    def _read(self, shard):
+        count = int(np.prod(self.shape))
+        with open(self.root / shard['file'], "rb") as file:
+            for _ in range(shard['examples']):
+                example = np.fromfile(file, dtype=self.dtype, count=count)
+                yield th.from_numpy(example.astype(np.float32).reshape(self.shape))
+
+    def __iter__(self):
+        if not self.shards:
+            return
+        shards, quota, reader = self._assignment()
+        rng = random.Random(self.seed + 1000 * self.epoch + reader)
+        buffer = []
+        produced = 0
+
+        def _stream():
+            while True:
+                for shard in shards:
+                    yield from self._read(shard)
+
+        for example in _stream():
+            if produced + len(buffer) == quota:
+                break
+            buffer.append(example)
+            if len(buffer) >= self.shuffle_buffer:
+                idx = rng.randrange(len(buffer))
+                buffer[idx], buffer[-1] = buffer[-1], buffer[idx]
+                yield buffer.pop()
+                produced += 1
+        rng.shuffle(buffer)
+        yield from buffer
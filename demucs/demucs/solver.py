@@ -5,20 +5,21 @@
 # LICENSE file in the root directory of this source tree.
 """Main training loop."""
 
+from contextlib import ExitStack
 import logging
 
 from dora import get_xp
-from dora.utils import write_and_rename
 from dora.log import LogProgress, bold
 import torch
 import torch.nn.functional as F
 
 from . import augment, distrib, states, pretrained
 from .apply import apply_model
+from .checkpoint import CheckpointWriter
 from .ema import ModelEMA
-from .evaluate import evaluate, new_sdr
+from .evaluate import evaluate, framewise_sdr, new_sdr
 from .svd import svd_penalty
-from .utils import pull_metric, EMA
+from .utils import grad_norm, pull_metric, EMA
 
 logger = logging.getLogger(__name__)
 
@@ -27,6 +28,36 @@ def _summary(metrics):
     return " | ".join(f"{key.capitalize()}={val}" for key, val in metrics.items())
 
 
+def get_augment(args):
+    """Return the training data augmentation from the XP arguments."""
+    shift = int(args.dset.samplerate * args.dset.shift)
+    if args.augment.fused:
+        augments = [augment.FusedAugment(
+            shift=shift, shift_same=args.augment.shift_same, flip=args.augment.flip,
+            scale_proba=args.augment.scale.proba, scale_min=args.augment.scale.min,
+            scale_max=args.augment.scale.max, remix_proba=args.augment.remix.proba,
+            remix_group_size=args.augment.remix.group_size, seed=args.seed + distrib.rank,
+            profile=args.augment.profile)]
+    else:
+        augments = [augment.Shift(shift=shift, same=args.augment.shift_same)]
+        if args.augment.flip:
+            augments += [augment.FlipChannels(), augment.FlipSign()]
+        for aug in ['scale', 'remix']:
+            kw = getattr(args.augment, aug)
+            if kw.proba:
+                augments.append(getattr(augment, aug.capitalize())(**kw))
+    if args.augment.repitch.proba and args.augment.repitch.backend == 'torch':
+        # Must come first, as the dataset is not wrapped and returns longer examples.
+        kw = dict(args.augment.repitch)
+        kw.pop('backend')
+        if kw.pop('bank'):
+            raise ValueError("augment.repitch.bank requires the soundstretch backend.")
+        augments.insert(0, augment.Repitch(**kw))
+    elif args.augment.repitch.backend not in ['soundstretch', 'torch']:
+        raise ValueError(f"Invalid repitch backend {args.augment.repitch.backend}")
+    return torch.nn.Sequential(*augments)
+
+
 class Solver(object):
     def __init__(self, loaders, model, optimizer, args):
         self.args = args
@@ -46,19 +77,18 @@ class Solver(object):
             decays = getattr(args.ema, kind)
             device = self.device if kind == 'batch' else 'cpu'
             if decays:
+                every = args.ema.every if kind == 'batch' else 1
                 for decay in decays:
-                    self.emas[kind].append(ModelEMA(self.model, decay, device=device))
+                    self.emas[kind].append(
+                        ModelEMA(self.model, decay, device=device, every=every))
+
+        # Mixed precision, with float16 and gradient scaling on GPU, or bfloat16 on CPU.
+        self.amp_dtype = torch.float16 if self.device.type == 'cuda' else torch.bfloat16
+        self.scaler = torch.amp.GradScaler(
+            'cuda', enabled=bool(args.optim.amp) and self.amp_dtype == torch.float16)
 
         # data augment
-        augments = [augment.Shift(shift=int(args.dset.samplerate * args.dset.shift),
-                                  same=args.augment.shift_same)]
-        if args.augment.flip:
-            augments += [augment.FlipChannels(), augment.FlipSign()]
-        for aug in ['scale', 'remix']:
-            kw = getattr(args.augment, aug)
-            if kw.proba:
-                augments.append(getattr(augment, aug.capitalize())(**kw))
-        self.augment = torch.nn.Sequential(*augments)
+        self.augment = get_augment(args)
 
         xp = get_xp()
         self.folder = xp.folder
@@ -66,6 +96,7 @@ class Solver(object):
         self.checkpoint_file = xp.folder / 'checkpoint.th'
         self.best_file = xp.folder / 'best.th'
         logger.debug("Checkpoint will be saved to %s", self.checkpoint_file.resolve())
+        self.writer = CheckpointWriter(args.misc.async_save)
         self.best_state = None
         self.best_changed = False
 
@@ -78,27 +109,27 @@ class Solver(object):
         package = {}
         package['state'] = self.model.state_dict()
         package['optimizer'] = self.optimizer.state_dict()
+        package['scaler'] = self.scaler.state_dict()
         package['history'] = self.history
         package['best_state'] = self.best_state
         package['args'] = self.args
         for kind, emas in self.emas.items():
             for k, ema in enumerate(emas):
                 package[f'ema_{kind}_{k}'] = ema.state_dict()
-        with write_and_rename(self.checkpoint_file) as tmp:
-            torch.save(package, tmp)
-
+        paths = [self.checkpoint_file]
         save_every = self.args.save_every
         if save_every and (epoch + 1) % save_every == 0 and epoch + 1 != self.args.epochs:
-            with write_and_rename(self.folder / f'checkpoint_{epoch + 1}.th') as tmp:
-                torch.save(package, tmp)
+            paths.append(self.folder / f'checkpoint_{epoch + 1}.th')
+        files = [(package, paths)]
 
         if self.best_changed:
             # Saving only the latest best model.
-            with write_and_rename(self.best_file) as tmp:
-                package = states.serialize_model(self.model, self.args)
-                package['state'] = self.best_state
-                torch.save(package, tmp)
+            best = states.serialize_model(self.model, self.args)
+            best['state'] = self.best_state
+            files.append((best, [self.best_file]))
             self.best_changed = False
+        # Copied to host memory right away, and written in the background.
+        self.writer.save(files)
 
     def _reset(self):
         """Reset state of the solver, potentially using checkpoint."""
@@ -107,6 +138,8 @@ class Solver(object):
             package = torch.load(self.checkpoint_file, 'cpu')
             self.model.load_state_dict(package['state'])
             self.optimizer.load_state_dict(package['optimizer'])
+            if package.get('scaler'):
+                self.scaler.load_state_dict(package['scaler'])
             self.history[:] = package['history']
             self.best_state = package['best_state']
             for kind, emas in self.emas.items():
@@ -131,6 +164,26 @@ class Solver(object):
             if self.args.continue_opt:
                 self.optimizer.load_state_dict(package['optimizer'])
 
+    def _framewise_metrics(self, metrics: dict) -> dict:
+        """Replace the sums and counts of the framewise medians logged on the valid set
+        by their average, for each source, and weighted over the sources."""
+        metrics = dict(metrics)
+        for kind in ['nsdr_frames', 'sisdr_frames']:
+            total = 0.
+            total_weight = 0.
+            for source, weight in zip(self.model.sources, self.args.weights):
+                if f'{kind}_{source}_count' not in metrics:
+                    break
+                median_sum = metrics.pop(f'{kind}_{source}_sum')
+                count = metrics.pop(f'{kind}_{source}_count')
+                if count > 0:
+                    metrics[f'{kind}_{source}'] = median_sum / count
+                    total += weight * metrics[f'{kind}_{source}']
+                    total_weight += weight
+            if total_weight > 0:
+                metrics[kind] = total / total_weight
+        return metrics
+
     def _format_train(self, metrics: dict) -> dict:
         """Formatting for train/valid metrics."""
         losses = {
@@ -139,6 +192,8 @@ class Solver(object):
         }
         if 'nsdr' in metrics:
             losses['nsdr'] = format(metrics['nsdr'], ".3f")
+        if 'nsdr_frames' in metrics:
+            losses['nsdr_frames'] = format(metrics['nsdr_frames'], ".3f")
         if self.quantizer is not None:
             losses['ms'] = format(metrics['ms'], ".2f")
         if 'grad' in metrics:
@@ -217,7 +272,7 @@ class Solver(object):
                         metrics['valid'][name] = valid
                         a = valid[key]
                         b = bvalid[key]
-                        if key.startswith('nsdr'):
+                        if key.startswith(('nsdr', 'sisdr')):
                             a = -a
                             b = -b
                         if a < b:
@@ -229,7 +284,7 @@ class Solver(object):
 
             valid_loss = metrics['valid'][key]
             mets = pull_metric(self.link.history, f'valid.{key}') + [valid_loss]
-            if key.startswith('nsdr'):
+            if key.startswith(('nsdr', 'sisdr')):
                 best_loss = max(mets)
             else:
                 best_loss = min(mets)
@@ -284,14 +339,16 @@ class Solver(object):
             if distrib.rank == 0:
                 # Save model each epoch
                 self._serialize(epoch)
-                logger.debug("Checkpoint saved to %s", self.checkpoint_file.resolve())
             if is_last:
                 break
+        self.writer.wait()
 
     def _run_one_epoch(self, epoch, train=True):
         args = self.args
         data_loader = self.loaders['train'] if train else self.loaders['valid']
-        if distrib.world_size > 1 and train:
+        if train and hasattr(data_loader.dataset, 'set_epoch'):
+            data_loader.dataset.set_epoch(epoch)
+        elif distrib.world_size > 1 and train:
             data_loader.sampler.set_epoch(epoch)
 
         label = ["Valid", "Train"][train]
@@ -302,8 +359,22 @@ class Solver(object):
         logprog = LogProgress(logger, data_loader, total=total,
                               updates=self.args.misc.num_prints, name=name)
         averager = EMA()
+        # Gradients are accumulated over `accumulate` batches for each optimizer step.
+        accumulate = args.optim.accumulate if train else 1
+        count = len(data_loader)
+        if args.max_batches:
+            count = min(count, args.max_batches + 1)
+        pending = False
 
         for idx, sources in enumerate(logprog):
+            # The last step of the epoch can have fewer batches.
+            first = idx - idx % accumulate
+            batches = min(accumulate, count - first)
+            step = idx + 1 == first + batches
+            sync = ExitStack()
+            if train and not step and distrib.world_size > 1:
+                # No need to all reduce the gradients before the last batch of the step.
+                sync.enter_context(self.dmodel.no_sync())
             sources = sources.to(self.device)
             if train:
                 sources = self.augment(sources)
@@ -315,7 +386,11 @@ class Solver(object):
             if not train and self.args.valid_apply:
                 estimate = apply_model(self.model, mix, split=self.args.test.split, overlap=0)
             else:
-                estimate = self.dmodel(mix)
+                with torch.autocast(self.device.type, dtype=self.amp_dtype,
+                                    enabled=train and bool(args.optim.amp)):
+                    estimate = self.dmodel(mix)
+                # The loss is always computed in float32.
+                estimate = estimate.float()
             if train and hasattr(self.model, 'transform_target'):
                 sources = self.model.transform_target(mix, sources)
             assert estimate.shape == sources.shape, (estimate.shape, sources.shape)
@@ -352,44 +427,59 @@ class Solver(object):
                     losses[f'nsdr_{source}'] = nsdr
                     total += w * nsdr
                 losses['nsdr'] = total / weights.sum()
-
-            if train and args.svd.penalty > 0:
+                if args.test.valid_framewise:
+                    # Median over the 1 second windows of each example, as for the test SDR.
+                    # Examples are full tracks with `dset.full_cv`, otherwise segments.
+                    # Examples without any non silent window are ignored. As every rank must
+                    # log the same keys, we log the sum and count of the medians,
+                    # see `_framewise_metrics`.
+                    kinds = ['nsdr_frames'] + ['sisdr_frames'] * bool(args.test.valid_sisdr)
+                    for kind in kinds:
+                        scores = framewise_sdr(sources, estimate.detach(), self.model.samplerate,
+                                               scale_invariant=kind == 'sisdr_frames')
+                        medians = scores.nanmedian(dim=-1).values
+                        sums = medians.nan_to_num().sum(0)
+                        counts = (~medians.isnan()).sum(0)
+                        for source, median_sum, count in zip(self.model.sources, sums, counts):
+                            losses[f'{kind}_{source}_sum'] = median_sum
+                            losses[f'{kind}_{source}_count'] = count
+
+            if train and step and args.svd.penalty > 0:
                 kw = dict(args.svd)
                 kw.pop('penalty')
                 penalty = svd_penalty(self.model, **kw)
                 losses['penalty'] = penalty
-                loss += args.svd.penalty * penalty
-
-            losses['loss'] = loss
+                penalty = args.svd.penalty * penalty
+                losses['loss'] = loss + penalty
+                # Only computed once per optimizer step, hence not divided by `batches`.
+                loss = loss + batches * penalty
+            else:
+                losses['loss'] = loss
 
             for k, source in enumerate(self.model.sources):
                 losses[f'reco_{source}'] = reco[k]
 
             # optimize model in training mode
             if train:
-                loss.backward()
-                grad_norm = 0
-                grads = []
-                for p in self.model.parameters():
-                    if p.grad is not None:
-                        grad_norm += p.grad.data.norm()**2
-                        grads.append(p.grad.data)
-                losses['grad'] = grad_norm ** 0.5
-                if args.optim.clip_grad:
-                    torch.nn.utils.clip_grad_norm_(
-                        self.model.parameters(),
-                        args.optim.clip_grad)
+                self.scaler.scale(loss / batches).backward()
+                pending = True
+            sync.close()
+            if train and step:
+                self.scaler.unscale_(self.optimizer)
+                losses['grad'] = grad_norm(self.model.parameters(), args.optim.clip_grad)
 
                 if self.args.flag == 'uns':
                     for n, p in self.model.named_parameters():
                         if p.grad is None:
                             print('no grad', n)
-                self.optimizer.step()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 self.optimizer.zero_grad()
+                pending = False
                 for ema in self.emas['batch']:
                     ema.update()
-            losses = averager(losses)
-            logs = self._format_train(losses)
+            averages = averager(losses)
+            logs = self._format_train(self._framewise_metrics(averages))
             logprog.update(**logs)
             # Just in case, clear some memory
             del loss, estimate, reco, ms
@@ -399,7 +489,14 @@ class Solver(object):
                 break
             if self.args.flag == 'debug':
                 break
+        if pending:
+            # Drop the gradients of a step interrupted by a debug flag.
+            self.optimizer.zero_grad()
         if train:
             for ema in self.emas['epoch']:
                 ema.update()
-        return distrib.average(losses, idx + 1)
+            for module in self.augment:
+                if isinstance(module, augment.FusedAugment) and module.profile:
+                    logger.info("Augmentation | %s", module.report())
+                    module.stats.clear()
+        return self._framewise_metrics(distrib.average(averages, idx + 1))
@@ -7,6 +7,8 @@
 
 import torch as th
 
+from .utils import no_autocast
+
 
 def spectro(x, n_fft=512, hop_length=None, pad=0):
     *other, length = x.shape
@@ -14,15 +16,17 @@ def spectro(x, n_fft=512, hop_length=None, pad=0):
     is_mps = x.device.type == 'mps'
     if is_mps:
         x = x.cpu()
-    z = th.stft(x,
-                n_fft * (1 + pad),
-                hop_length or n_fft // 4,
-                window=th.hann_window(n_fft).to(x),
-                win_length=n_fft,
-                normalized=True,
-                center=True,
-                return_complex=True,
-                pad_mode='reflect')
+    with no_autocast(x.device.type):
+        x = x.float()
+        z = th.stft(x,
+                    n_fft * (1 + pad),
+                    hop_length or n_fft // 4,
+                    window=th.hann_window(n_fft).to(x),
+                    win_length=n_fft,
+                    normalized=True,
+                    center=True,
+                    return_complex=True,
+                    pad_mode='reflect')
     _, freqs, frame = z.shape
     return z.view(*other, freqs, frame)
 
@@ -35,13 +39,14 @@ def ispectro(z, hop_length=None, length=None, pad=0):
     is_mps = z.device.type == 'mps'
     if is_mps:
         z = z.cpu()
-    x = th.istft(z,
-                 n_fft,
-                 hop_length,
-                 window=th.hann_window(win_length).to(z.real),
-                 win_length=win_length,
-                 normalized=True,
-                 length=length,
-                 center=True)
+    with no_autocast(z.device.type):
+        x = th.istft(z,
+                     n_fft,
+                     hop_length,
+                     window=th.hann_window(win_length).to(z.real),
+                     win_length=win_length,
+                     normalized=True,
+                     length=length,
+                     center=True)
     _, length = x.shape
     return x.view(*other, length)
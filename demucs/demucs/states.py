@@ -19,6 +19,8 @@ from omegaconf import OmegaConf
 from dora.log import fatal
 import torch
 
+from .flat import FLAT_SUFFIX, build_mapped, read_flat
+
 
 def _check_diffq():
     try:
@@ -49,9 +51,13 @@ def get_quantizer(model, args, optimizer=None):
 
 def load_model(path_or_package, strict=False):
     """Load a model from the given serialized model, either given as a dict (already loaded)
-    or a path to a file on disk."""
+    or a path to a file on disk, possibly in the flat format (see `demucs.flat`)."""
+    mapped = False
     if isinstance(path_or_package, dict):
         package = path_or_package
+    elif isinstance(path_or_package, (str, Path)) and Path(path_or_package).suffix == FLAT_SUFFIX:
+        package = read_flat(path_or_package)
+        mapped = True
     elif isinstance(path_or_package, (str, Path)):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
@@ -64,18 +70,18 @@ def load_model(path_or_package, strict=False):
     args = package["args"]
     kwargs = package["kwargs"]
 
-    if strict:
-        model = klass(*args, **kwargs)
-    else:
+    if not strict:
         sig = inspect.signature(klass)
         for key in list(kwargs):
             if key not in sig.parameters:
                 warnings.warn("Dropping inexistant parameter " + key)
                 del kwargs[key]
-        model = klass(*args, **kwargs)
 
     state = package["state"]
 
+    if mapped:
+        return build_mapped(klass, args, kwargs, state)
+    model = klass(*args, **kwargs)
     set_state(model, state)
     return model
 
@@ -132,6 +138,17 @@ def serialize_model(model, training_args, quantizer=None, half=True):
     }
 
 
+def state_hash(state) -> str:
+    """Return a sha1 hash of the content of the given state dict."""
+    sig = hashlib.sha1()
+    for key, value in sorted(state.items()):
+        sig.update(key.encode())
+        value = value.detach().cpu().contiguous()
+        sig.update(str((value.dtype, tuple(value.shape))).encode())
+        sig.update(value.view(-1).view(torch.uint8).numpy().tobytes())
+    return sig.hexdigest()
+
+
 def copy_state(state):
     return {k: v.cpu().clone() for k, v in state.items()}
 
@@ -4,7 +4,10 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 """Ways to make the model stronger."""
+from collections import defaultdict
 import random
+import weakref
+
 import torch
 
 
@@ -28,8 +31,75 @@ def power_iteration(m, niters=1, bs=1):
 penalty_rng = random.Random(1234)
 
 
+# Per model state for `svd_penalty`: number of calls so far, and last singular
+# vectors for each group of weights with the same shape, for the warm start.
+_warm_states: "weakref.WeakKeyDictionary[torch.nn.Module, dict]" = weakref.WeakKeyDictionary()
+
+
+def _penalized_weights(model, min_size=0.1, convtr=True, conv_only=False):
+    # Yield the weights to penalize, reshaped as 2D matrices.
+    for m in model.modules():
+        for name, p in m.named_parameters(recurse=False):
+            if p.numel() / 2**18 < min_size:
+                continue
+            if convtr:
+                if isinstance(m, (torch.nn.ConvTranspose1d, torch.nn.ConvTranspose2d)):
+                    if p.dim() in [3, 4]:
+                        p = p.transpose(0, 1).contiguous()
+            if p.dim() == 3:
+                p = p.view(len(p), -1)
+            elif p.dim() == 4:
+                p = p.view(len(p), -1)
+            elif p.dim() == 1:
+                continue
+            elif conv_only:
+                continue
+            assert p.dim() == 2, (name, p.shape)
+            yield p
+
+
+def warm_power_iteration(weights, vectors, niters=1):
+    """
+    Batched power iteration on the `[B, N, M]` tensor `weights`, starting from the right
+    singular vectors `vectors` of shape `[B, M]` estimated at the previous call, if any.
+    Returns the squared largest singular value of each matrix, differentiable with
+    respect to `weights`, and the new right singular vectors.
+    """
+    with torch.no_grad():
+        w = weights.detach()
+        if vectors is None:
+            vectors = torch.randn(w.shape[0], w.shape[2], device=w.device, dtype=w.dtype)
+        v = vectors
+        for _ in range(niters):
+            u = torch.bmm(w, v[:, :, None])[:, :, 0]
+            u = u / (1e-10 + u.norm(dim=1, keepdim=True))
+            v = torch.bmm(u[:, None], w)[:, 0]
+            v = v / (1e-10 + v.norm(dim=1, keepdim=True))
+        # Left singular vectors matching the final `v`, also defined when `niters` is 0.
+        u = torch.bmm(w, v[:, :, None])[:, :, 0]
+        u = u / (1e-10 + u.norm(dim=1, keepdim=True))
+    sigma = torch.bmm(u[:, None], torch.bmm(weights, v[:, :, None])).view(-1)
+    return sigma.pow(2), v
+
+
+def _warm_penalty(model, weights, niters):
+    state = _warm_states.setdefault(model, {'calls': 0, 'vectors': {}})['vectors']
+    groups = defaultdict(list)
+    for p in weights:
+        groups[tuple(p.shape)].append(p)
+    total = 0
+    for shape, group in groups.items():
+        vectors = state.get(shape)
+        if vectors is not None and (len(vectors) != len(group) or
+                                    vectors.device != group[0].device):
+            vectors = None
+        estimates, state[shape] = warm_power_iteration(torch.stack(group), vectors, niters)
+        total += estimates.sum()
+    return total
+
+
 def svd_penalty(model, min_size=0.1, dim=1, niters=2, powm=False, convtr=True,
-                proba=1, conv_only=False, exact=False, bs=1):
+                proba=1, conv_only=False, exact=False, bs=1, warm=False, every=1):
     """
     Penalty on the largest singular value for a layer.
     Args:
@@ -46,38 +116,38 @@ def svd_penalty(model, min_size=0.1, dim=1, niters=2, powm=False, convtr=True,
             (might not be reliable for other models than Demucs).
         - exact: use exact SVD (slow but useful at validation).
         - bs: batch_size for power method.
+        - warm: use a batched power method over all the weights with the same shape,
+            starting from the singular vectors found at the previous call,
+            in which case `niters=1` is usually enough. Ignores `dim`, `powm` and `bs`.
+        - every: only apply the penalty once every that many calls.
     """
     total = 0
     if penalty_rng.random() > proba:
         return 0.
+    if not exact and every > 1:
+        state = _warm_states.setdefault(model, {'calls': 0, 'vectors': {}})
+        state['calls'] += 1
+        if state['calls'] % every:
+            return 0.
 
-    for m in model.modules():
-        for name, p in m.named_parameters(recurse=False):
-            if p.numel() / 2**18 < min_size:
-                continue
-            if convtr:
-                if isinstance(m, (torch.nn.ConvTranspose1d, torch.nn.ConvTranspose2d)):
-                    if p.dim() in [3, 4]:
-                        p = p.transpose(0, 1).contiguous()
-            if p.dim() == 3:
-                p = p.view(len(p), -1)
-            elif p.dim() == 4:
-                p = p.view(len(p), -1)
-            elif p.dim() == 1:
-                continue
-            elif conv_only:
-                continue
-            assert p.dim() == 2, (name, p.shape)
-            if exact:
-                estimate = torch.svd(p, compute_uv=False)[1].pow(2).max()
-            elif powm:
-                a, b = p.shape
-                if a < b:
-                    n = p.mm(p.t())
-                else:
-                    n = p.t().mm(p)
-                estimate = power_iteration(n, niters, bs)
+    weights = _penalized_weights(model, min_size, convtr, conv_only)
+    if warm and not exact:
+        total = _warm_penalty(model, weights, niters)
+        return total * every / proba
+
+    for p in weights:
+        if exact:
+            estimate = torch.svd(p, compute_uv=False)[1].pow(2).max()
+        elif powm:
+            a, b = p.shape
+            if a < b:
+                n = p.mm(p.t())
             else:
-                estimate = torch.svd_lowrank(p, dim, niters)[1][0].pow(2)
-            total += estimate
+                n = p.t().mm(p)
+            estimate = power_iteration(n, niters, bs)
+        else:
+            estimate = torch.svd_lowrank(p, dim, niters)[1][0].pow(2)
+        total += estimate
+    if not exact:
+        total = total * every
     return total / proba
@@ -22,12 +22,14 @@ from torch.utils.data import ConcatDataset
 
 from . import distrib
 from .wav import get_wav_datasets, get_musdb_wav_datasets
-from .demucs import Demucs
-from .hdemucs import HDemucs
+from .demucs import Demucs, DConv
+from .hdemucs import HDemucs, HEncLayer, HDecLayer
 from .htdemucs import HTDemucs
-from .repitch import RepitchedWrapper
+from .repitch import RepitchedWrapper, IterableRepitchedWrapper
+from .shards import ShardedDataset
 from .solver import Solver
 from .states import capture_init
+from .transformer import CrossTransformerEncoderLayer, MyTransformerEncoderLayer
 from .utils import random_subset
 
 logger = logging.getLogger(__name__)
@@ -69,9 +71,34 @@ def get_model(args):
     }[args.model]
     kw = OmegaConf.to_container(getattr(args, args.model), resolve=True)
     model = klass(**extra, **kw)
+    set_checkpointing(model, **args.checkpointing)
     return model
 
 
+def set_checkpointing(model, encoder=False, decoder=False, dconv=False, transformer=False):
+    """
+    Enable activation checkpointing on the given kind of layers, i.e. their activations
+    are recomputed during the backward instead of being kept in memory. This is not
+    stored with the model, and has no effect on the output.
+
+    Args:
+        encoder: `HEncLayer` of both branches.
+        decoder: `HDecLayer` of both branches.
+        dconv: `DConv` residual branches, also used by `Demucs`.
+        transformer: self and cross attention layers of the `HTDemucs` transformer.
+    """
+    kinds = [
+        (HEncLayer, encoder),
+        (HDecLayer, decoder),
+        (DConv, dconv),
+        ((MyTransformerEncoderLayer, CrossTransformerEncoderLayer), transformer),
+    ]
+    for module in model.modules():
+        for klass, enabled in kinds:
+            if isinstance(module, klass):
+                module.checkpoint = enabled
+
+
 def get_optimizer(model, args):
     seen_params = set()
     other_params = []
@@ -106,6 +133,13 @@ def get_optimizer(model, args):
         raise ValueError("Invalid optimizer %s", args.optim.optimizer)
 
 
+def get_shards_config(args):
+    """Dataset parameters stored along with the shards, to detect stale shards."""
+    keys = ['sources', 'segment', 'shift', 'samplerate', 'channels', 'normalize']
+    dset = OmegaConf.to_container(args.dset, resolve=True)
+    return {key: dset[key] for key in keys}
+
+
 def get_datasets(args):
     if args.dset.backend:
         torchaudio.set_audio_backend(args.dset.backend)
@@ -143,6 +177,9 @@ def get_datasets(args):
                 valid_set = ConcatDataset([valid_set, extra_valid_set])
     if args.dset.valid_samples is not None:
         valid_set = random_subset(valid_set, args.dset.valid_samples)
+    if args.dset.shards:
+        train_set = ShardedDataset(args.dset.shards, shuffle_buffer=args.dset.shuffle_buffer,
+                                   seed=args.seed, config=get_shards_config(args))
     assert len(train_set)
     assert len(valid_set)
     return train_set, valid_set
@@ -171,20 +208,33 @@ def get_solver(args, model_only=False):
 
     assert args.batch_size % distrib.world_size == 0
     args.batch_size //= distrib.world_size
+    # batch_size is the effective batch size, each step accumulating several smaller batches.
+    assert args.batch_size % args.optim.accumulate == 0
+    args.batch_size //= args.optim.accumulate
+    if args.augment.remix.proba and args.augment.remix.group_size:
+        # Remix shuffles the sources within groups of each of the smaller batches.
+        assert args.batch_size % args.augment.remix.group_size == 0, \
+            f"Batch size {args.batch_size} per gpu and accumulated batch must be divisible by " \
+            f"the remix group size {args.augment.remix.group_size}."
 
     if model_only:
         return Solver(None, model, optimizer, args)
 
     train_set, valid_set = get_datasets(args)
 
-    if args.augment.repitch.proba:
+    if args.augment.repitch.proba and args.augment.repitch.backend == 'soundstretch':
         vocals = []
         if 'vocals' in args.dset.sources:
             vocals.append(args.dset.sources.index('vocals'))
         else:
             logger.warning('No vocal source found')
         if args.augment.repitch.proba:
-            train_set = RepitchedWrapper(train_set, vocals=vocals, **args.augment.repitch)
+            kw = dict(args.augment.repitch)
+            kw.pop('backend')
+            klass = RepitchedWrapper
+            if isinstance(train_set, ShardedDataset):
+                klass = IterableRepitchedWrapper
+            train_set = klass(train_set, vocals=vocals, **kw)
 
     logger.info("train/valid set size: %d %d", len(train_set), len(valid_set))
     train_loader = distrib.loader(
@@ -15,6 +15,8 @@ import numpy as np
 import math
 from einops import rearrange
 
+from .utils import activation_checkpoint
+
 
 def create_sin_embedding(
     length: int, dim: int, shift: int = 0, device="cpu", max_period=10000
@@ -306,6 +308,7 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
             device=device,
             dtype=dtype,
         )
+        self.checkpoint = False  # see `demucs.train.set_checkpointing`.
         self.sparse = sparse
         self.auto_sparsity = auto_sparsity
         if sparse:
@@ -341,6 +344,11 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
         if batch_first = False, src shape is (T, B, C)
         the case where batch_first=True is not covered
         """
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return activation_checkpoint(self._forward, src, src_mask, src_key_padding_mask)
+        return self._forward(src, src_mask, src_key_padding_mask)
+
+    def _forward(self, src, src_mask=None, src_key_padding_mask=None):
         device = src.device
         x = src
         T, B, C = x.shape
@@ -404,6 +412,7 @@ class CrossTransformerEncoderLayer(nn.Module):
     ):
         factory_kwargs = {"device": device, "dtype": dtype}
         super().__init__()
+        self.checkpoint = False  # see `demucs.train.set_checkpointing`.
 
         self.sparse = sparse
         self.auto_sparsity = auto_sparsity
@@ -471,6 +480,11 @@ class CrossTransformerEncoderLayer(nn.Module):
             mask: tensor of shape (T, S)
 
         """
+        if self.checkpoint and self.training and torch.is_grad_enabled():
+            return activation_checkpoint(self._forward, q, k, mask)
+        return self._forward(q, k, mask)
+
+    def _forward(self, q, k, mask=None):
         device = q.device
         T, B, C = q.shape
         S, B, C = k.shape
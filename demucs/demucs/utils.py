@@ -7,6 +7,7 @@
 from collections import defaultdict
 from concurrent.futures import CancelledError
 from contextlib import contextmanager
+import inspect
 import math
 import os
 import tempfile
@@ -85,6 +86,57 @@ def EMA(beta: float = 1):
     return _update
 
 
+def grad_norm(parameters, clip: float = 0.) -> torch.Tensor:
+    """
+    Return the total L2 norm of the gradients of `parameters`, computed with fused
+    multi-tensor kernels when available. The norm is returned as a tensor on the device
+    of the gradients, so that computing and clipping it does not wait for the device,
+    but reading its value does, as the solver does for logging, together with the loss.
+    If `clip` is positive, the gradients are also rescaled in place, in the same way as
+    `torch.nn.utils.clip_grad_norm_`, reusing the same norm.
+    """
+    grads = [p.grad for p in parameters if p.grad is not None]
+    if not grads:
+        return torch.zeros(())
+    if hasattr(torch, '_foreach_norm'):
+        norms = list(torch._foreach_norm(grads))
+    else:
+        norms = [grad.norm() for grad in grads]
+    total = torch.stack(norms).norm()
+    if clip > 0:
+        coef = (clip / (total + 1e-6)).clamp(max=1.)
+        try:
+            torch._foreach_mul_(grads, coef)
+        except (AttributeError, TypeError, RuntimeError):
+            # Older versions of torch only support Python scalars.
+            for grad in grads:
+                grad.mul_(coef)
+    return total
+
+
+def activation_checkpoint(function, *args):
+    """
+    Call `function(*args)` without keeping its intermediate activations for the backward,
+    which will recompute them instead. This uses the non reentrant implementation
+    when available, so that it works even when no input requires gradients.
+    """
+    from torch.utils import checkpoint
+    if 'use_reentrant' in inspect.signature(checkpoint.checkpoint).parameters:
+        return checkpoint.checkpoint(function, *args, use_reentrant=False)
+    return checkpoint.checkpoint(function, *args)
+
+
+@contextmanager
+def no_autocast(device_type: str):
+    """Disable autocast within the context, e.g. for STFTs, masks and losses
+    that must run in float32 during mixed precision training."""
+    if device_type not in ['cuda', 'cpu']:
+        yield
+        return
+    with torch.autocast(device_type, enabled=False):
+        yield
+
+
 def sizeof_fmt(num: float, suffix: str = 'B'):
     """
     Given `num` bytes, return human readable size.
@@ -5,8 +5,11 @@
 # LICENSE file in the root directory of this source tree.
 """Loading wav based datasets, including MusdbHQ."""
 
+import array
+import bisect
 from collections import OrderedDict
 import hashlib
+import logging
 import math
 import json
 import os
@@ -15,64 +18,18 @@ import tqdm
 
 import musdb
 import julius
+import numpy as np
 import torch as th
-from torch import distributed
 import torchaudio as ta
 from torch.nn import functional as F
 
-from .audio import convert_audio_channels
+from .audio import AudioReader, convert_audio_channels
+from .metadata import EXT, MIXTURE, MetadataStore, list_tracks, track_metadata
 from . import distrib
 
-MIXTURE = "mixture"
-EXT = ".wav"
-
-
-def _track_metadata(track, sources, normalize=True, ext=EXT):
-    track_length = None
-    track_samplerate = None
-    mean = 0
-    std = 1
-    for source in sources + [MIXTURE]:
-        file = track / f"{source}{ext}"
-        if source == MIXTURE and not file.exists():
-            audio = 0
-            for sub_source in sources:
-                sub_file = track / f"{sub_source}{ext}"
-                sub_audio, sr = ta.load(sub_file)
-                audio += sub_audio
-            would_clip = audio.abs().max() >= 1
-            if would_clip:
-                assert ta.get_audio_backend() == 'soundfile', 'use dset.backend=soundfile'
-            ta.save(file, audio, sr, encoding='PCM_F')
-
-        try:
-            info = ta.info(str(file))
-        except RuntimeError:
-            print(file)
-            raise
-        length = info.num_frames
-        if track_length is None:
-            track_length = length
-            track_samplerate = info.sample_rate
-        elif track_length != length:
-            raise ValueError(
-                f"Invalid length for file {file}: "
-                f"expecting {track_length} but got {length}.")
-        elif info.sample_rate != track_samplerate:
-            raise ValueError(
-                f"Invalid sample rate for file {file}: "
-                f"expecting {track_samplerate} but got {info.sample_rate}.")
-        if source == MIXTURE and normalize:
-            try:
-                wav, _ = ta.load(str(file))
-            except RuntimeError:
-                print(file)
-                raise
-            wav = wav.mean(0)
-            mean = wav.mean().item()
-            std = wav.std().item()
-
-    return {"length": length, "mean": mean, "std": std, "samplerate": track_samplerate}
+logger = logging.getLogger(__name__)
+
+METADATA_STORE = "metadata.db"
 
 
 def build_metadata(path, sources, normalize=True, ext=EXT):
@@ -88,28 +45,72 @@ def build_metadata(path, sources, normalize=True, ext=EXT):
     """
 
     meta = {}
-    path = Path(path)
     pendings = []
     from concurrent.futures import ThreadPoolExecutor
     with ThreadPoolExecutor(8) as pool:
-        for root, folders, files in os.walk(path, followlinks=True):
-            root = Path(root)
-            if root.name.startswith('.') or folders or root == path:
-                continue
-            name = str(root.relative_to(path))
-            pendings.append((name, pool.submit(_track_metadata, root, sources, normalize, ext)))
-            # meta[name] = _track_metadata(root, sources, normalize, ext)
+        for name, root in list_tracks(path):
+            pendings.append((name, pool.submit(track_metadata, root, sources, normalize, ext)))
         for name, pending in tqdm.tqdm(pendings, ncols=120):
             meta[name] = pending.result()
     return meta
 
 
+class SegmentTable:
+    def __init__(self, durations, segment=None, shift=None):
+        """
+        Precomputed table of the examples for a list of tracks, shared by all
+        the datasets cutting tracks into segments of `segment` seconds with a stride of `shift`
+        seconds. Counts are stored as compact integer arrays, and an example index is mapped
+        to its track with a binary search.
+
+        Args:
+            durations (list[float]): duration in seconds of each track.
+            segment (None or float): segment length in seconds, or `None` for one
+                example per track.
+            shift (None or float): stride in seconds, default to `segment`.
+        """
+        self.segment = segment
+        self.shift = shift or segment
+        self.num_examples = array.array('q')
+        self.starts = array.array('q', [0])
+        for duration in durations:
+            if segment is None or duration < segment:
+                examples = 1
+            else:
+                examples = int(math.ceil((duration - self.segment) / self.shift) + 1)
+            self.num_examples.append(examples)
+            self.starts.append(self.starts[-1] + examples)
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def locate(self, index: int):
+        """Return `(track, example)` with `track` the track index and `example`
+        the index of the example within that track."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {index} out of range for {len(self)} examples.")
+        track = bisect.bisect_right(self.starts, index) - 1
+        return track, index - self.starts[track]
+
+    def track_range(self, track: int):
+        """Range of the example indexes belonging to the given track."""
+        return range(self.starts[track], self.starts[track + 1])
+
+    def offset(self, example: int, samplerate: float):
+        """Offset in samples of the given example within its track."""
+        if self.segment is None:
+            return 0
+        return int(samplerate * self.shift * example)
+
+
 class Wavset:
     def __init__(
             self,
             root, metadata, sources,
             segment=None, shift=None, normalize=True,
-            samplerate=44100, channels=2, ext=EXT):
+            samplerate=44100, channels=2, ext=EXT, open_files=0):
         """
         Waveset (or mp3 set for that matter). Can be used to train
         with arbitrary sources. Each track should be one folder inside of `path`.
@@ -128,6 +129,11 @@ class Wavset:
             channels (int): target nb of channels. if different, will be
                 changed onthe fly.
             ext (str): extension for audio files (default is .wav).
+            open_files (int): if non zero, keep up to that many decoders open
+                (see `demucs.audio.AudioReader`) and serve successive examples from them,
+                instead of opening and parsing each file again with `torchaudio.load`.
+                Decoders are never shared between processes: those inherited by forked
+                DataLoader workers are dropped, and new ones are opened by each worker.
 
         samplerate and channels are converted on the fly.
         """
@@ -140,76 +146,339 @@ class Wavset:
         self.channels = channels
         self.samplerate = samplerate
         self.ext = ext
-        self.num_examples = []
-        for name, meta in self.metadata.items():
-            track_duration = meta['length'] / meta['samplerate']
-            if segment is None or track_duration < segment:
-                examples = 1
-            else:
-                examples = int(math.ceil((track_duration - self.segment) / self.shift) + 1)
-            self.num_examples.append(examples)
+        self.open_files = open_files
+        self._readers = OrderedDict()
+        self._pid = os.getpid()
+        self.names = list(self.metadata)
+        self.table = SegmentTable(
+            [meta['length'] / meta['samplerate'] for meta in self.metadata.values()],
+            segment, shift)
+        self.num_examples = self.table.num_examples
 
     def __len__(self):
-        return sum(self.num_examples)
+        return len(self.table)
+
+    def get_segment(self, index):
+        """
+        Return `(track, offset, length)` for the given example without loading any audio,
+        with `offset` and `length` in samples at `self.samplerate`, and `track` an index
+        into `self.names`.
+        """
+        track, example = self.table.locate(index)
+        offset = self.table.offset(example, self.samplerate)
+        if self.segment is None:
+            meta = self.metadata[self.names[track]]
+            length = int(meta['length'] * self.samplerate / meta['samplerate'])
+        else:
+            length = int(self.segment * self.samplerate)
+        return track, offset, length
 
     def get_file(self, name, source):
         return self.root / name / f"{source}{self.ext}"
 
+    def __getstate__(self):
+        # Open decoders cannot be sent to DataLoader workers.
+        state = dict(self.__dict__)
+        state['_readers'] = OrderedDict()
+        return state
+
+    def _load(self, file, offset, num_frames):
+        if not self.open_files:
+            wav, _ = ta.load(str(file), frame_offset=offset, num_frames=num_frames)
+            return wav
+        if self._pid != os.getpid():
+            # Forked worker, the decoders opened so far share their state with the parent.
+            self._readers = OrderedDict()
+            self._pid = os.getpid()
+        reader = self._readers.pop(file, None)
+        if reader is None:
+            while len(self._readers) >= self.open_files:
+                _, oldest = self._readers.popitem(last=False)
+                oldest.close()
+            reader = AudioReader(file)
+        self._readers[file] = reader
+        return reader.read(num_frames, offset=offset)
+
     def __getitem__(self, index):
-        for name, examples in zip(self.metadata, self.num_examples):
-            if index >= examples:
-                index -= examples
-                continue
+        track, example_index = self.table.locate(index)
+        name = self.names[track]
+        meta = self.metadata[name]
+        num_frames = -1
+        offset = self.table.offset(example_index, meta['samplerate'])
+        if self.segment is not None:
+            num_frames = int(math.ceil(meta['samplerate'] * self.segment))
+        wavs = []
+        for source in self.sources:
+            file = self.get_file(name, source)
+            wav = self._load(file, offset, num_frames)
+            wav = convert_audio_channels(wav, self.channels)
+            wavs.append(wav)
+
+        example = th.stack(wavs)
+        example = julius.resample_frac(example, meta['samplerate'], self.samplerate)
+        if self.normalize:
+            example = (example - meta['mean']) / meta['std']
+        if self.segment:
+            length = int(self.segment * self.samplerate)
+            example = example[..., :length]
+            example = F.pad(example, (0, length - example.shape[-1]))
+        return example
+
+
+PACKED_INDEX = "index.json"
+PACKED_DTYPES = ["float16", "int16", "float32"]
+
+
+def write_packed(example, file, dtype):
+    """Write an `[S, C, T]` array in the `pack_wavset` format and return its entry
+    for the index, without the metadata of the original track."""
+    scale = 1.
+    if dtype == 'int16':
+        scale = max(float(abs(example).max()), 1e-8) / (2**15 - 1)
+        example = (example / scale).round()
+    example.astype(dtype).tofile(file)
+    return {"file": file.name, "length": example.shape[-1], "scale": scale}
+
+
+def _pack_track(dset, index, file, dtype):
+    return write_packed(dset[index].numpy(), file, dtype)
+
+
+def pack_wavset(dset, root, dtype='float16', workers=8):
+    """
+    Pack all the tracks of a `Wavset` into `root`, each track being stored as one
+    contiguous `[S, C, T]` array file, already resampled, channel converted and normalized.
+    The result can be read back with `MemmapWavset`. Packing several `Wavset`
+    into the same `root` will merge them, as long as they share the same sources,
+    sample rate, channels and normalization.
+
+    Args:
+        dset (Wavset): dataset to pack, `dset.segment` is ignored.
+        root (Path or str): output folder.
+        dtype (str): one of `float16`, `int16` (with per track scale) or `float32`.
+        workers (int): number of processes used for decoding and resampling.
+    """
+    if dtype not in PACKED_DTYPES:
+        raise ValueError(f"Invalid dtype {dtype}, must be one of {PACKED_DTYPES}")
+    root = Path(root)
+    root.mkdir(exist_ok=True, parents=True)
+    index_file = root / PACKED_INDEX
+    header = {
+        "sources": list(dset.sources),
+        "samplerate": dset.samplerate,
+        "channels": dset.channels,
+        "normalize": dset.normalize,
+    }
+    if index_file.exists():
+        index = json.load(open(index_file))
+        for key, value in header.items():
+            if index[key] != value:
+                raise ValueError(f"Cannot merge into {root}, mismatch for {key}: "
+                                 f"expected {index[key]} but got {value}.")
+    else:
+        index = dict(header, tracks={})
+
+    full = Wavset(dset.root, dset.metadata, dset.sources, segment=None,
+                  normalize=dset.normalize, samplerate=dset.samplerate,
+                  channels=dset.channels, ext=dset.ext, open_files=dset.open_files)
+    pendings = []
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(workers) as pool:
+        for track, name in enumerate(full.metadata):
+            file = root / (hashlib.sha1(name.encode()).hexdigest()[:16] + ".bin")
+            pendings.append((name, pool.submit(_pack_track, full, track, file, dtype)))
+        for name, pending in tqdm.tqdm(pendings, ncols=120):
+            entry = pending.result()
+            meta = full.metadata[name]
+            entry.update(dtype=dtype, origin_length=meta['length'],
+                         origin_samplerate=meta['samplerate'])
+            index["tracks"][name] = entry
+    tmp = index_file.with_suffix(".tmp")
+    json.dump(index, open(tmp, "w"))
+    tmp.rename(index_file)
+
+
+class MemmapWavset:
+    def __init__(
+            self,
+            root, sources, tracks=None,
+            segment=None, shift=None, normalize=True,
+            samplerate=44100, channels=2):
+        """
+        Dataset over tracks packed with `pack_wavset`, returning the same examples as
+        `Wavset` would, but serving them by slicing memory mapped arrays rather than
+        decoding, resampling and normalizing audio on the fly.
+
+        Args:
+            root (Path or str): folder created by `pack_wavset`.
+            sources (list[str]): list of source names, must be packed.
+            tracks (None or list[str]): tracks to use, default to all packed tracks.
+            segment, shift: see `Wavset`.
+            normalize, samplerate, channels: only checked against the packed corpus,
+                as conversion happens at packing time.
+        """
+        self.root = Path(root)
+        index = json.load(open(self.root / PACKED_INDEX))
+        for key, value in [('samplerate', samplerate), ('channels', channels),
+                           ('normalize', normalize)]:
+            if index[key] != value:
+                raise ValueError(f"Packed dataset {root} has {key}={index[key]} "
+                                 f"but {value} was requested.")
+        missing = set(sources) - set(index['sources'])
+        if missing:
+            raise ValueError(f"Sources {missing} were not packed in {root}.")
+        if tracks is None:
+            tracks = list(index['tracks'])
+        self.metadata = OrderedDict((name, index['tracks'][name]) for name in tracks)
+        self.packed_sources = index['sources']
+        self.sources = sources
+        self.segment = segment
+        self.shift = shift or segment
+        self.normalize = normalize
+        self.samplerate = samplerate
+        self.channels = channels
+
+        indexes = [self.packed_sources.index(source) for source in sources]
+        self._source_index = indexes
+        if indexes == list(range(indexes[0], indexes[0] + len(indexes))):
+            # Contiguous sources can be sliced without copy.
+            self._source_index = slice(indexes[0], indexes[0] + len(indexes))
+        self._arrays = {}
+
+        self.names = list(self.metadata)
+        self.table = SegmentTable(
+            [meta['origin_length'] / meta['origin_samplerate']
+             for meta in self.metadata.values()],
+            segment, shift)
+        self.num_examples = self.table.num_examples
+
+    def __len__(self):
+        return len(self.table)
+
+    def get_segment(self, index):
+        """See `Wavset.get_segment`."""
+        track, example = self.table.locate(index)
+        offset = self.table.offset(example, self.samplerate)
+        if self.segment is None:
+            length = self.metadata[self.names[track]]['length']
+        else:
+            length = int(self.segment * self.samplerate)
+        return track, offset, length
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_arrays'] = {}
+        return state
+
+    def _array(self, name):
+        if name not in self._arrays:
             meta = self.metadata[name]
-            num_frames = -1
-            offset = 0
-            if self.segment is not None:
-                offset = int(meta['samplerate'] * self.shift * index)
-                num_frames = int(math.ceil(meta['samplerate'] * self.segment))
-            wavs = []
-            for source in self.sources:
-                file = self.get_file(name, source)
-                wav, _ = ta.load(str(file), frame_offset=offset, num_frames=num_frames)
-                wav = convert_audio_channels(wav, self.channels)
-                wavs.append(wav)
-
-            example = th.stack(wavs)
-            example = julius.resample_frac(example, meta['samplerate'], self.samplerate)
-            if self.normalize:
-                example = (example - meta['mean']) / meta['std']
-            if self.segment:
-                length = int(self.segment * self.samplerate)
-                example = example[..., :length]
-                example = F.pad(example, (0, length - example.shape[-1]))
-            return example
+            shape = (len(self.packed_sources), self.channels, meta['length'])
+            self._arrays[name] = np.memmap(
+                self.root / meta['file'], dtype=meta['dtype'], mode='r', shape=shape)
+        return self._arrays[name]
+
+    def __getitem__(self, index):
+        track, offset, length = self.get_segment(index)
+        name = self.names[track]
+        meta = self.metadata[name]
+        chunk = self._array(name)[self._source_index, :, offset:offset + length]
+        example = th.from_numpy(np.array(chunk, dtype=np.float32))
+        if meta['scale'] != 1:
+            example *= meta['scale']
+        if self.segment:
+            example = F.pad(example, (0, length - example.shape[-1]))
+        return example
+
+
+def _packed_root(args, prefix, sig):
+    if not args.packed:
+        return None
+    root = Path(args.packed) / (prefix + sig)
+    if not (root / PACKED_INDEX).exists() and not (root / "train" / PACKED_INDEX).exists():
+        raise ValueError(f"Could not find packed dataset {root}, run `python -m tools.pack` first.")
+    return root
+
+
+def pack_datasets(args, dtype='float16', workers=8):
+    """
+    Pack the MusDB and custom wav datasets from the XP `dset` arguments into `args.packed`,
+    so that `get_wav_datasets` and `get_musdb_wav_datasets` will use `MemmapWavset`.
+    """
+    import copy
+    assert args.packed, "dset.packed must be set."
+    unpacked = copy.deepcopy(args)
+    unpacked.packed = None
+    todo = []
+    if args.use_musdb:
+        sig = hashlib.sha1(str(args.musdb).encode()).hexdigest()[:8]
+        for dset in get_musdb_wav_datasets(unpacked):
+            todo.append((dset, Path(args.packed) / ('musdb_' + sig)))
+    for name in ['wav', 'wav2']:
+        path = getattr(args, name)
+        if path:
+            sig = hashlib.sha1(str(path).encode()).hexdigest()[:8]
+            train_set, valid_set = get_wav_datasets(unpacked, name)
+            todo.append((train_set, Path(args.packed) / ('wav_' + sig) / "train"))
+            todo.append((valid_set, Path(args.packed) / ('wav_' + sig) / "valid"))
+    for dset, root in todo:
+        # We always pack the mixture, as it is required by the valid set.
+        dset = Wavset(dset.root, dset.metadata, [MIXTURE] + list(args.sources),
+                      normalize=args.normalize, samplerate=args.samplerate,
+                      channels=args.channels, ext=dset.ext, open_files=args.open_files)
+        pack_wavset(dset, root, dtype=dtype, workers=workers)
+
+
+def _get_metadata(args, roots, legacy):
+    # Update the metadata store on the first worker only, and share the result.
+    # `legacy` is the JSON file previous versions cached the metadata of `roots` in,
+    # which is imported into the store the first time.
+    metadata = None
+    if distrib.rank == 0:
+        with MetadataStore(Path(args.metadata) / METADATA_STORE) as store:
+            if legacy.is_file():
+                legacy_metadata = json.load(open(legacy))
+                if len(roots) == 1:
+                    legacy_metadata = [legacy_metadata]
+                for root, meta in zip(roots, legacy_metadata):
+                    count = store.import_metadata(root, meta, args.sources)
+                    if count:
+                        logger.info("Imported the metadata of %d tracks in %s from %s",
+                                    count, root, legacy)
+            metadata = [store.update(root, args.sources) for root in roots]
+    return distrib.share(metadata)
 
 
 def get_wav_datasets(args, name='wav'):
     """Extract the wav datasets from the XP arguments."""
     path = getattr(args, name)
     sig = hashlib.sha1(str(path).encode()).hexdigest()[:8]
-    metadata_file = Path(args.metadata) / ('wav_' + sig + ".json")
-    train_path = Path(path) / "train"
-    valid_path = Path(path) / "valid"
-    if not metadata_file.is_file() and distrib.rank == 0:
-        metadata_file.parent.mkdir(exist_ok=True, parents=True)
-        train = build_metadata(train_path, args.sources)
-        valid = build_metadata(valid_path, args.sources)
-        json.dump([train, valid], open(metadata_file, "w"))
-    if distrib.world_size > 1:
-        distributed.barrier()
-    train, valid = json.load(open(metadata_file))
     if args.full_cv:
         kw_cv = {}
     else:
         kw_cv = {'segment': args.segment, 'shift': args.shift}
+    packed = _packed_root(args, 'wav_', sig)
+    if packed is not None:
+        train_set = MemmapWavset(packed / "train", args.sources,
+                                 segment=args.segment, shift=args.shift,
+                                 samplerate=args.samplerate, channels=args.channels,
+                                 normalize=args.normalize)
+        valid_set = MemmapWavset(packed / "valid", [MIXTURE] + list(args.sources),
+                                 samplerate=args.samplerate, channels=args.channels,
+                                 normalize=args.normalize, **kw_cv)
+        return train_set, valid_set
+
+    train_path = Path(path) / "train"
+    valid_path = Path(path) / "valid"
+    legacy = Path(args.metadata) / ('wav_' + sig + ".json")
+    train, valid = _get_metadata(args, [train_path, valid_path], legacy)
     train_set = Wavset(train_path, train, args.sources,
                        segment=args.segment, shift=args.shift,
                        samplerate=args.samplerate, channels=args.channels,
-                       normalize=args.normalize)
+                       normalize=args.normalize, open_files=args.open_files)
     valid_set = Wavset(valid_path, valid, [MIXTURE] + list(args.sources),
                        samplerate=args.samplerate, channels=args.channels,
-                       normalize=args.normalize, **kw_cv)
+                       normalize=args.normalize, open_files=args.open_files, **kw_cv)
     return train_set, valid_set
 
 
@@ -224,31 +493,40 @@ def _get_musdb_valid():
 def get_musdb_wav_datasets(args):
     """Extract the musdb dataset from the XP arguments."""
     sig = hashlib.sha1(str(args.musdb).encode()).hexdigest()[:8]
-    metadata_file = Path(args.metadata) / ('musdb_' + sig + ".json")
+    valid_tracks = _get_musdb_valid()
+    if args.full_cv:
+        kw_cv = {}
+    else:
+        kw_cv = {'segment': args.segment, 'shift': args.shift}
+    packed = _packed_root(args, 'musdb_', sig)
+    if packed is not None:
+        tracks = json.load(open(packed / PACKED_INDEX))['tracks']
+        train_tracks = [name for name in tracks
+                        if args.train_valid or name not in valid_tracks]
+        train_set = MemmapWavset(packed, args.sources, train_tracks,
+                                 segment=args.segment, shift=args.shift,
+                                 samplerate=args.samplerate, channels=args.channels,
+                                 normalize=args.normalize)
+        valid_set = MemmapWavset(packed, [MIXTURE] + list(args.sources),
+                                 [name for name in tracks if name in valid_tracks],
+                                 samplerate=args.samplerate, channels=args.channels,
+                                 normalize=args.normalize, **kw_cv)
+        return train_set, valid_set
+
     root = Path(args.musdb) / "train"
-    if not metadata_file.is_file() and distrib.rank == 0:
-        metadata_file.parent.mkdir(exist_ok=True, parents=True)
-        metadata = build_metadata(root, args.sources)
-        json.dump(metadata, open(metadata_file, "w"))
-    if distrib.world_size > 1:
-        distributed.barrier()
-    metadata = json.load(open(metadata_file))
+    legacy = Path(args.metadata) / ('musdb_' + sig + ".json")
+    metadata, = _get_metadata(args, [root], legacy)
 
-    valid_tracks = _get_musdb_valid()
     if args.train_valid:
         metadata_train = metadata
     else:
         metadata_train = {name: meta for name, meta in metadata.items() if name not in valid_tracks}
     metadata_valid = {name: meta for name, meta in metadata.items() if name in valid_tracks}
-    if args.full_cv:
-        kw_cv = {}
-    else:
-        kw_cv = {'segment': args.segment, 'shift': args.shift}
     train_set = Wavset(root, metadata_train, args.sources,
                        segment=args.segment, shift=args.shift,
                        samplerate=args.samplerate, channels=args.channels,
-                       normalize=args.normalize)
+                       normalize=args.normalize, open_files=args.open_files)
     valid_set = Wavset(root, metadata_valid, [MIXTURE] + list(args.sources),
                        samplerate=args.samplerate, channels=args.channels,
-                       normalize=args.normalize, **kw_cv)
+                       normalize=args.normalize, open_files=args.open_files, **kw_cv)
     return train_set, valid_set
@@ -55,13 +55,17 @@ with xp.enter():
     model = solver.model
     model.cuda()
     x = torch.randn(2, xp.cfg.dset.channels, int(10 * model.samplerate), device='cuda')
-    with bench() as res:
-        y = model(x)
-        y.sum().backward()
-    del y
-    for p in model.parameters():
-        p.grad = None
-    print(f"FB: {res.mem:.1f} MB, {res.tim * 1000:.1f} ms")
+    for amp in [False, True]:
+        # Forward backward, in float32 and with mixed precision, as used with optim.amp.
+        scaler = torch.amp.GradScaler('cuda', enabled=amp)
+        with bench() as res:
+            with torch.autocast('cuda', dtype=torch.float16, enabled=amp):
+                y = model(x)
+            scaler.scale(y.float().sum()).backward()
+        del y
+        for p in model.parameters():
+            p.grad = None
+        print(f"FB{' (AMP)' if amp else ''}: {res.mem:.1f} MB, {res.tim * 1000:.1f} ms")
 
     x = torch.randn(1, xp.cfg.dset.channels, int(model.segment * model.samplerate), device='cuda')
     with bench() as res:
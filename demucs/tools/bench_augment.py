@@ -0,0 +1,71 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Compare the time spent in each stage of the training augmentation of an XP, with
+the separate modules and with `augment.fused=true`, on random batches:
+
+    python3 -m tools.bench_augment -r 20 augment.remix.group_size=2
+"""
+from argparse import ArgumentParser
+import copy
+import time
+
+import torch
+
+from demucs import augment, train
+from demucs.solver import get_augment
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = ArgumentParser("tools.bench_augment",
+                            description="Benchmark the training data augmentation of an XP.")
+    parser.add_argument('-r', '--repeats', type=int, default=10)
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('overrides', nargs='*', help='Dora overrides.')
+    args = parser.parse_args()
+
+    xp = train.main.get_xp(args.overrides)
+    device = torch.device(args.device)
+    with xp.enter():
+        cfg = xp.cfg
+        length = int(cfg.dset.samplerate * (cfg.dset.segment + cfg.dset.shift))
+        if cfg.augment.repitch.proba and cfg.augment.repitch.backend == 'torch':
+            length = int(length / (1 - 0.01 * cfg.augment.repitch.max_tempo))
+        shape = (cfg.batch_size, len(cfg.dset.sources), cfg.dset.channels, length)
+        batch = torch.randn(*shape, device=device)
+        print(f"Batch of shape {list(shape)}")
+
+        for fused in [False, True]:
+            args_ = copy.deepcopy(cfg)
+            args_.augment.fused = fused
+            pipeline = get_augment(args_).to(device)
+            timings = [0.] * len(pipeline)
+            for module in pipeline:
+                if isinstance(module, augment.FusedAugment):
+                    module.profile = True
+            for _ in range(args.repeats):
+                wav = batch.clone()
+                for idx, module in enumerate(pipeline):
+                    _sync(device)
+                    begin = time.time()
+                    wav = module(wav)
+                    _sync(device)
+                    timings[idx] += time.time() - begin
+            print("Fused" if fused else "Separate modules")
+            for module, timing in zip(pipeline, timings):
+                print(f"  {type(module).__name__}: {1000 * timing / args.repeats:.2f}ms")
+                if isinstance(module, augment.FusedAugment):
+                    print(f"    {module.report()}")
+            print(f"  Total: {1000 * sum(timings) / args.repeats:.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
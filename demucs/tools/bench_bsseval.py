@@ -0,0 +1,59 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Compare `museval.metrics.bss_eval` with `demucs.bsseval.bss_eval`
+(`test.bsseval=torch`), in speed and values, on random correlated signals:
+
+    python3 -m tools.bench_bsseval -l 60
+"""
+from argparse import ArgumentParser
+import time
+
+import museval
+import numpy as np
+import torch
+
+from demucs import bsseval
+
+
+def main():
+    parser = ArgumentParser("tools.bench_bsseval",
+                            description="Benchmark the BSS Eval implementations.")
+    parser.add_argument('-s', '--sources', type=int, default=4)
+    parser.add_argument('-l', '--length', type=float, default=30.,
+                        help="Length of the track in seconds.")
+    parser.add_argument('--samplerate', type=int, default=44100)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    sr = args.samplerate
+    length = int(args.length * sr)
+    # Brownian noise for the references, so that successive samples are correlated.
+    references = 0.05 * torch.randn(args.sources, 2, length, dtype=torch.float64).cumsum(-1)
+    references -= references.mean(-1, keepdim=True)
+    mix = references.sum(0)
+    estimates = 0.8 * references + 0.2 * mix / args.sources
+    estimates += 0.01 * torch.randn_like(estimates)
+    references = references.transpose(1, 2)
+    estimates = estimates.transpose(1, 2)
+
+    begin = time.time()
+    expected = museval.metrics.bss_eval(
+        references.numpy(), estimates.numpy(), compute_permutation=False,
+        window=sr, hop=sr, framewise_filters=False, bsseval_sources_version=False)[:-1]
+    print(f"museval: {time.time() - begin:.1f}s")
+
+    begin = time.time()
+    scores = bsseval.bss_eval(references, estimates, window=sr, hop=sr)
+    print(f"torch ({torch.get_num_threads()} threads): {time.time() - begin:.1f}s")
+
+    for name, ref, value in zip(['SDR', 'ISR', 'SIR', 'SAR'], expected, scores):
+        print(f"{name}: max abs. difference {np.nanmax(np.abs(ref - value)):.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Memory / step time trade-off of activation checkpointing (see the `checkpointing`
+config group) for the model of an XP, e.g.
+
+    python3 -m tools.bench_checkpointing -b 4 model=htdemucs
+
+prints a table with the peak memory and time of a forward and backward pass
+for a few combinations of checkpointed layers.
+"""
+from argparse import ArgumentParser
+import time
+
+import torch
+
+from demucs import train
+
+PRESETS = {
+    'none': {},
+    'dconv': {'dconv': True},
+    'transformer': {'transformer': True},
+    'encoder+decoder': {'encoder': True, 'decoder': True},
+    'all': {'encoder': True, 'decoder': True, 'transformer': True},
+}
+
+
+def main():
+    parser = ArgumentParser("tools.bench_checkpointing",
+                            description="Benchmark activation checkpointing for an XP.")
+    parser.add_argument('-b', '--batch_size', type=int, default=4)
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('overrides', nargs='*', help='Dora overrides.')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    cuda = device.type == 'cuda'
+    xp = train.main.get_xp(args.overrides)
+    with xp.enter():
+        cfg = xp.cfg
+        torch.manual_seed(cfg.seed)
+        model = train.get_model(cfg).to(device)
+        model.train()
+        length = int(cfg.dset.segment * cfg.dset.samplerate)
+        mix = torch.randn(args.batch_size, cfg.dset.channels, length, device=device)
+
+        print("| checkpointing | peak memory | step time |")
+        print("|---|---|---|")
+        for name, preset in PRESETS.items():
+            train.set_checkpointing(model, **preset)
+            timings = []
+            for step in range(args.repeats + 1):
+                if cuda:
+                    torch.cuda.synchronize()
+                    torch.cuda.reset_peak_memory_stats()
+                begin = time.time()
+                model(mix).abs().mean().backward()
+                if cuda:
+                    torch.cuda.synchronize()
+                if step > 0:
+                    # The first step is only a warmup.
+                    timings.append(time.time() - begin)
+                model.zero_grad(set_to_none=True)
+            memory = f"{torch.cuda.max_memory_allocated() / 2**20:.0f} MB" if cuda else "n/a"
+            print(f"| {name} | {memory} | {1000 * sum(timings) / len(timings):.0f} ms |")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Measure the startup time of the command line interface, and check that
+torch is not imported for `--help` and `--list-models`:
+
+    python3 -m tools.bench_import -r 5
+"""
+from argparse import ArgumentParser
+import subprocess
+import sys
+import time
+
+HEAVY = ['torch', 'torchaudio', 'julius', 'lameenc', 'dora', 'openunmix']
+COMMANDS = {
+    'import demucs.separate': ['-c', 'import demucs.separate'],
+    'demucs --help': ['-m', 'demucs', '--help'],
+    'demucs --list-models': ['-m', 'demucs', '--list-models'],
+    'import demucs.api': ['-c', 'import demucs.api'],
+}
+
+
+def _imported(stderr: str):
+    # Output of `-X importtime`, with lines `import time: self | cumulative | module`.
+    modules = set()
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip())
+    return [name for name in HEAVY if name in modules]
+
+
+def main():
+    parser = ArgumentParser("tools.bench_import",
+                            description="Benchmark the startup time of the CLI.")
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    for name, command in COMMANDS.items():
+        durations = []
+        for _ in range(args.repeats):
+            begin = time.time()
+            subprocess.run([sys.executable] + command, check=True, stdout=subprocess.DEVNULL)
+            durations.append(time.time() - begin)
+        proc = subprocess.run([sys.executable, '-X', 'importtime'] + command, check=True,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        heavy = ', '.join(_imported(proc.stderr)) or 'none'
+        print(f"{name}: {min(durations) * 1000:.0f}ms (best of {args.repeats}), "
+              f"heavy imports: {heavy}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Measure the cold start time to load a pretrained model, each time in a new process,
+e.g. to compare a local repo of `.th` files with the same models converted
+with `tools.export --flat --convert`:
+
+    python3 -m tools.bench_load -n htdemucs_ft --repo models --repo flat_models
+
+Local repos must contain the bag of models YAML files, e.g. copied from `demucs/remote`.
+"""
+from argparse import ArgumentParser
+import json
+import subprocess as sp
+import sys
+
+_SCRIPT = """
+import json, sys, time
+begin = time.time()
+from demucs.pretrained import get_model
+# Torch and the model code are only imported when loading, see `demucs.pretrained`.
+import demucs.states, demucs.htdemucs, demucs.hdemucs  # noqa
+from pathlib import Path
+repo = Path(sys.argv[2]) if len(sys.argv) > 2 else None
+imported = time.time()
+get_model(sys.argv[1], repo)
+print(json.dumps([imported - begin, time.time() - imported]))
+"""
+
+
+def main():
+    parser = ArgumentParser("tools.bench_load",
+                            description="Benchmark the cold start loading time of models.")
+    parser.add_argument('-n', '--name', default='htdemucs_ft')
+    parser.add_argument('--repo', action='append', default=[],
+                        help="Local repos to compare, default to the remote one.")
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for repo in args.repo or [None]:
+        times = []
+        for _ in range(args.repeats):
+            cmd = [sys.executable, '-c', _SCRIPT, args.name] + ([repo] if repo else [])
+            out = sp.run(cmd, check=True, capture_output=True, text=True).stdout
+            times.append(json.loads(out.strip().split('\n')[-1]))
+        imports = min(t[0] for t in times)
+        loads = min(t[1] for t in times)
+        print(f"{repo or 'remote'}: import {imports:.2f}s, load {loads:.2f}s "
+              f"(best of {len(times)})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Measure the read throughput of the train loader for a given XP config, e.g. to compare
+the original datasets with `dset.packed` or `dset.shards`:
+
+    python3 -m tools.bench_loader -b 200 dset.shards=/path/to/shards
+"""
+from argparse import ArgumentParser
+import logging
+import sys
+import time
+
+from demucs import distrib, train
+from demucs.utils import sizeof_fmt
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = ArgumentParser("tools.bench_loader",
+                            description="Benchmark the train data loader of an XP.")
+    parser.add_argument('-b', '--batches', type=int, default=100,
+                        help="Number of batches to read.")
+    parser.add_argument('overrides', nargs='*', help='Dora overrides.')
+    args = parser.parse_args()
+
+    xp = train.main.get_xp(args.overrides)
+    with xp.enter():
+        cfg = xp.cfg
+        train_set, _ = train.get_datasets(cfg)
+        loader = distrib.loader(train_set, batch_size=cfg.batch_size, shuffle=True,
+                                num_workers=cfg.misc.num_workers, drop_last=True)
+        begin = time.time()
+        first = None
+        examples = 0
+        size = 0
+        for idx, batch in enumerate(loader):
+            if first is None:
+                first = time.time() - begin
+            examples += len(batch)
+            size += batch.numel() * batch.element_size()
+            if idx + 1 == args.batches:
+                break
+        duration = time.time() - begin
+    print(f"{type(train_set).__name__}: {examples} examples in {duration:.1f}s, "
+          f"first batch after {first:.2f}s")
+    print(f"Throughput: {examples / duration:.1f} examples/s, "
+          f"{sizeof_fmt(size / duration)}/s (float32)")
+
+
+if __name__ == '__main__':
+    main()
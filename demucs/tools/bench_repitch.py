@@ -0,0 +1,71 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Compare the throughput of pitch/tempo augmentation with the `soundstretch` subprocess
+(`augment.repitch.backend=soundstretch`) and with the in process torch implementation
+(`augment.repitch.backend=torch`), on random examples:
+
+    python3 -m tools.bench_repitch -b 16 -d cuda
+"""
+from argparse import ArgumentParser
+import time
+
+import torch
+
+from demucs.augment import Repitch
+from demucs.repitch import RepitchedWrapper
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def main():
+    parser = ArgumentParser("tools.bench_repitch",
+                            description="Benchmark pitch/tempo augmentation backends.")
+    parser.add_argument('-b', '--batch_size', type=int, default=16)
+    parser.add_argument('-s', '--sources', type=int, default=4)
+    parser.add_argument('-l', '--length', type=float, default=11.,
+                        help="Length of the examples in seconds.")
+    parser.add_argument('-r', '--repeats', type=int, default=5,
+                        help="Number of batches for the torch backend.")
+    parser.add_argument('-d', '--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--samplerate', type=int, default=44100)
+    parser.add_argument('--no_soundstretch', action='store_false', dest='soundstretch',
+                        help="Only benchmark the torch backend.")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (args.batch_size, args.sources, 2, int(args.length * args.samplerate))
+    batch = 0.1 * torch.randn(*shape)
+
+    repitch = Repitch(proba=1.).to(device)
+    wav = batch.to(device)
+    repitch(wav)  # warmup
+    _sync(device)
+    begin = time.time()
+    for _ in range(args.repeats):
+        repitch(wav)
+    _sync(device)
+    duration = (time.time() - begin) / args.repeats
+    print(f"torch ({device}): {args.batch_size / duration:.1f} examples/s")
+
+    if args.soundstretch:
+        wrapper = RepitchedWrapper(batch, proba=1.)
+        begin = time.time()
+        try:
+            for example in batch:
+                wrapper._augment(example)
+        except FileNotFoundError:
+            print("soundstretch: not installed")
+            return
+        duration = time.time() - begin
+        print(f"soundstretch (1 process): {args.batch_size / duration:.1f} examples/s")
+
+
+if __name__ == '__main__':
+    main()
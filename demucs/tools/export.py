@@ -7,7 +7,16 @@
 """Export a trained model from the full checkpoint (with optimizer etc.) to
 a final checkpoint, with only the model itself. The model is always stored as
 half float to gain space, and because this has zero impact on the final loss.
-When DiffQ was used for training, the model will actually be quantized and bitpacked."""
+When DiffQ was used for training, the model will actually be quantized and bitpacked.
+
+With `--flat`, models are exported in the flat format from `demucs.flat`, which loads
+faster as it is memory mapped. Weights are then stored as float32 rather than half
+float, so that the model can use them without any copy. Existing model files can also
+be converted, e.g.
+
+    python3 -m tools.export --flat --sign -o flat_models \
+        --convert ~/.cache/torch/hub/checkpoints/*.th
+"""
 from argparse import ArgumentParser
 from fractions import Fraction
 import logging
@@ -16,6 +25,7 @@ import sys
 import torch
 
 from demucs import train
+from demucs.flat import FLAT_SUFFIX, save_flat, save_flat_with_checksum
 from demucs.states import serialize_model, save_with_checksum
 
 
@@ -31,17 +41,38 @@ def main():
                         help="Path where to store release models (default release_models)")
     parser.add_argument('-s', '--sign', action='store_true',
                         help='Add sha256 prefix checksum to the filename.')
+    parser.add_argument('--flat', action='store_true',
+                        help='Use the memory mappable flat format.')
+    parser.add_argument('-c', '--convert', nargs='+', type=Path, default=[],
+                        help='Existing model files to convert, instead of XP signatures.')
 
     args = parser.parse_args()
     args.out.mkdir(exist_ok=True, parents=True)
 
+    def _save(pkg, sig):
+        if args.flat:
+            out_path = args.out / (sig + FLAT_SUFFIX)
+            if args.sign:
+                save_flat_with_checksum(pkg, out_path)
+            else:
+                save_flat(pkg, out_path)
+        else:
+            out_path = args.out / (sig + ".th")
+            if args.sign:
+                save_with_checksum(pkg, out_path)
+            else:
+                torch.save(pkg, out_path)
+
+    for path in args.convert:
+        sig = path.stem.split('-')[0]
+        logger.info('Converting %s', path)
+        _save(torch.load(path, 'cpu'), sig)
+
     for sig in args.signatures:
         xp = train.main.get_xp_from_sig(sig)
         name = train.main.get_name(xp)
         logger.info('Handling %s/%s', sig, name)
 
-        out_path = args.out / (sig + ".th")
-
         solver = train.get_solver_from_sig(sig)
         if len(solver.history) < solver.args.epochs:
             logger.warning(
@@ -61,10 +92,7 @@ def main():
             if 'test' in m:
                 test = m['test']
         pkg['metrics'] = (valid, test)
-        if args.sign:
-            save_with_checksum(pkg, out_path)
-        else:
-            torch.save(pkg, out_path)
+        _save(pkg, sig)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,51 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Pack the training datasets of an XP into memory mappable arrays, already resampled
+and normalized, see `demucs.wav.MemmapWavset`. This must be run once for a given
+`dset.packed` folder, e.g.
+
+    python3 -m tools.pack dset.packed=/path/to/packed dset=extra44
+
+then train with the same `dset.packed` override.
+"""
+from argparse import ArgumentParser
+import logging
+import sys
+
+from demucs import train
+from demucs.wav import pack_datasets, PACKED_DTYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = ArgumentParser("tools.pack",
+                            description="Pack the datasets of an XP for faster loading.")
+    parser.add_argument('--dtype', choices=PACKED_DTYPES, default='float16',
+                        help="Storage type, int16 uses a per track scale (default float16).")
+    parser.add_argument('-j', '--workers', type=int, default=8,
+                        help="Number of processes used for decoding.")
+    parser.add_argument('overrides', nargs='*',
+                        help='Dora overrides, must at least contain dset.packed.')
+    args = parser.parse_args()
+
+    xp = train.main.get_xp(args.overrides)
+    with xp.enter():
+        dset = xp.cfg.dset
+        if dset.backend:
+            import torchaudio
+            torchaudio.set_audio_backend(dset.backend)
+        if not dset.packed:
+            parser.error("You must provide dset.packed=FOLDER.")
+        logger.info("Packing datasets into %s", dset.packed)
+        pack_datasets(dset, dtype=args.dtype, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
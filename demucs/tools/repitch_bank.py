@@ -0,0 +1,67 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Pre-render pitch/tempo variants of every train track with `soundstretch`, so that
+training reads them with a memory map instead of calling `soundstretch` in the
+loader workers, see `demucs.repitch.build_bank`, e.g.
+
+    python3 -m tools.repitch_bank -n 8 augment.repitch.bank=/path/to/bank
+
+then train with the same `augment.repitch.bank` override. Running it again with a larger
+`-n` only renders the missing variants.
+"""
+from argparse import ArgumentParser
+import logging
+import sys
+
+from demucs import train
+from demucs.repitch import RepitchedWrapper, build_bank
+from demucs.wav import PACKED_DTYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = ArgumentParser("tools.repitch_bank",
+                            description="Render a bank of repitched variants for an XP.")
+    parser.add_argument('-n', '--variants', type=int, default=4,
+                        help="Number of variants per track.")
+    parser.add_argument('--dtype', choices=PACKED_DTYPES, default='float16',
+                        help="Storage type, int16 uses a per variant scale (default float16).")
+    parser.add_argument('-j', '--workers', type=int, default=8,
+                        help="Number of soundstretch processes.")
+    parser.add_argument('overrides', nargs='*',
+                        help='Dora overrides, must at least contain augment.repitch.bank.')
+    args = parser.parse_args()
+
+    xp = train.main.get_xp(args.overrides)
+    with xp.enter():
+        cfg = xp.cfg
+        if cfg.dset.backend:
+            import torchaudio
+            torchaudio.set_audio_backend(cfg.dset.backend)
+        if not cfg.augment.repitch.bank:
+            parser.error("You must provide augment.repitch.bank=FOLDER.")
+        if cfg.dset.shards:
+            parser.error("A repitch bank cannot be used with dset.shards.")
+        train_set, _ = train.get_datasets(cfg)
+        vocals = []
+        if 'vocals' in cfg.dset.sources:
+            vocals.append(cfg.dset.sources.index('vocals'))
+        kw = dict(cfg.augment.repitch)
+        kw.pop('backend')
+        kw.pop('bank')
+        wrapper = RepitchedWrapper(train_set, vocals=vocals, **kw)
+        logger.info("Rendering %d variants per track into %s",
+                    args.variants, cfg.augment.repitch.bank)
+        build_bank(wrapper, cfg.augment.repitch.bank, variants=args.variants,
+                   dtype=args.dtype, workers=args.workers, seed=cfg.seed)
+
+
+if __name__ == '__main__':
+    main()
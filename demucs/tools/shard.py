@@ -0,0 +1,55 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+"""Write the training set of an XP into large shards, for sequential reads on
+network file systems, see `demucs.shards`. This must be run once for a given
+`dset.shards` folder, e.g.
+
+    python3 -m tools.shard dset.shards=/path/to/shards dset=extra44
+
+then train with the same `dset.shards` override. Only the train set is sharded,
+the valid set is still read from the original datasets.
+"""
+from argparse import ArgumentParser
+import logging
+import sys
+
+from demucs import train
+from demucs.shards import write_shards, SHARDS_DTYPES
+
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    parser = ArgumentParser("tools.shard",
+                            description="Write the train set of an XP into shards.")
+    parser.add_argument('--dtype', choices=SHARDS_DTYPES, default='float16',
+                        help="Storage type (default float16).")
+    parser.add_argument('--shard-size', type=float, default=512,
+                        help="Target shard size in MB (default 512).")
+    parser.add_argument('-j', '--workers', type=int, default=8,
+                        help="Number of loader workers used for decoding.")
+    parser.add_argument('overrides', nargs='*',
+                        help='Dora overrides, must at least contain dset.shards.')
+    args = parser.parse_args()
+
+    xp = train.main.get_xp(args.overrides)
+    with xp.enter():
+        cfg = xp.cfg
+        root = cfg.dset.shards
+        if not root:
+            parser.error("You must provide dset.shards=FOLDER.")
+        cfg.dset.shards = None
+        train_set, _ = train.get_datasets(cfg)
+        logger.info("Writing %d examples to %s", len(train_set), root)
+        write_shards(train_set, root, shard_size=args.shard_size, dtype=args.dtype,
+                     workers=args.workers, seed=cfg.seed, config=train.get_shards_config(cfg))
+
+
+if __name__ == '__main__':
+    main()